@@ -41,9 +41,12 @@ INSTALLED_APPS = [
     "tickets.apps.TicketsConfig",
     "contacts.apps.ContactsConfig",
     "system_messages.apps.MessagesConfig",
+    "jobs.apps.JobsConfig",
+    "benchmarks.apps.BenchmarksConfig",
 ]
 
 MIDDLEWARE = [
+    "utils.instrumentation.InstrumentationMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -122,6 +125,64 @@ STATIC_URL = "static/"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 
+# a CACHES alias shared by every process (memcached, redis, database) in which permission_check keeps users,
+# their roles and role versions for PERMISSION_CACHE_TTL seconds. process-local backends are refused,
+# since a revoked or deleted user would stay authorized in the other processes; unset, users are read on every request
+PERMISSION_CACHE = None
+PERMISSION_CACHE_TTL = 300
+
+# sign the role names and RoleVersion of the user into login tokens,
+# so that permission_check can authorize role-only views without loading the user
+JWT_ROLE_CLAIMS = True
+
+# background jobs, see jobs.queue: attempts before a job is kept as failed,
+# seconds before the first retry (doubled on every further one),
+# seconds a running job may go without finishing before run_workers hands it to another worker,
+# and seconds an idle worker waits before looking for due jobs again, registration mail waits at most that long
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 30
+JOB_LOCK_TIMEOUT = 600
+JOB_POLL_INTERVAL = 0.5
+
+# seconds utils.mail.pool keeps the idle SMTP connection of a worker thread open
+MAIL_IDLE_TIMEOUT = 5
+
+# rows per page of cursor paginated lists, see utils.pagination, and the most a client may ask for
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# seconds an unread message count may be served from the cache. counts of listed receivers are invalidated
+# when they change, audience messages can reach a reader later on (a ticket bought, a role granted) and rely on this
+INBOX_COUNTER_TTL = 60
+
+# stations and carriages are served from in-process catalogs, see schedules.catalog. name a CACHES alias here
+# to share them and their versions between processes, which then see a change within CATALOG_CHECK_INTERVAL seconds
+CATALOG_CACHE = None
+CATALOG_CHECK_INTERVAL = 1
+
+# time requests and count their sql statements in utils.instrumentation.InstrumentationMiddleware,
+# reported in a Server-Timing header, a log line per request and on /metrics
+REQUEST_INSTRUMENTATION = False
+
+# the per request json lines of utils.instrumentation are logged at INFO, below what python prints by default,
+# so the logger gets a handler of its own writing them to stderr
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {
+            "class": "logging.StreamHandler",
+        },
+    },
+    "loggers": {
+        "utils.instrumentation": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+    },
+}
+
 AVG_KM_BETWEEN_STATION = decimal.Decimal(300)
 ADDITION_COST_PER_KM = decimal.Decimal(0.05861)
 
@@ -17,6 +17,8 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from utils import instrumentation
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("users/", include("users.urls")),
@@ -25,4 +27,5 @@ urlpatterns = [
     path("tickets/", include("tickets.urls")),
     path("contacts/", include("contacts.urls")),
     path("messages/", include("system_messages.urls")),
+    path("metrics", instrumentation.metrics),
 ]
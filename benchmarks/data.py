@@ -0,0 +1,246 @@
+import decimal
+import random
+from collections import Counter
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import timezone
+
+from accounts.models import Account
+from contacts.models import Contact
+from schedules.models import (
+    Carriage, Schedule, ScheduleRoute, ScheduleToCarriage, ScheduleToStation, Station, cumulative_distances,
+    fare_for_distance, segment_distances,
+)
+from schedules.catalog import station_catalog
+from system_messages.models import Message
+from tickets.models import Ticket
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _insert_rows(model, field_names, rows, batch_size):
+    """
+    plain executemany INSERT of value tuples, several times faster than bulk_create
+    for the largest tables since no model instances are built
+    """
+    db = connections[DEFAULT_DB_ALIAS]
+    fields = [model._meta.get_field(name) for name in field_names]
+    # integers, booleans and strings go to the driver as they are, only these need the backend's conversion
+    prepared = [field.get_internal_type() in ('DateTimeField', 'DateField', 'DecimalField') for field in fields]
+    quote = db.ops.quote_name
+    sql = (f"INSERT INTO {quote(model._meta.db_table)} ({', '.join(quote(field.column) for field in fields)}) "
+           f"VALUES ({', '.join(['%s'] * len(fields))})")
+
+    with transaction.atomic(), db.cursor() as cursor:
+        for chunk in _chunks(rows, batch_size):
+            cursor.executemany(sql, [
+                [field.get_db_prep_save(value, db) if prepare else value
+                 for field, prepare, value in zip(fields, prepared, row)]
+                for row in chunk
+            ])
+
+
+def _default_start():
+    return timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def build_timetable(schedule_num, station_num, stop_num, seed=0, batch_size=1000, prefix="B", start=None):
+    """
+    bulk insert stations and schedules with random stop lists, returns the stations.
+    stops and routes are written batch_size schedules at a time, so memory doesn't grow with schedule_num
+    """
+    rand = random.Random(seed)
+    start = start or _default_start()
+
+    Station.objects.bulk_create(
+        (Station(station_no=f"{prefix}S{i:05d}", name=f"站点{i}") for i in range(station_num)),
+        batch_size=batch_size,
+    )
+    # bulk inserts send no post_save
+    station_catalog.invalidate()
+    # not every backend returns primary keys from bulk_create
+    stations = list(Station.objects.filter(station_no__startswith=f"{prefix}S").order_by('id'))
+
+    for chunk in _chunks(range(schedule_num), batch_size):
+        with transaction.atomic():
+            _build_schedules(chunk, stations, stop_num, rand, start, batch_size, prefix)
+
+    return stations
+
+
+def _build_schedules(chunk, stations, stop_num, rand, start, batch_size, prefix):
+    schedules = [
+        Schedule(schedule_no=f"{prefix}{i:07d}", departure_time=start + timedelta(minutes=10 * i)) for i in chunk
+    ]
+    Schedule.objects.bulk_create(schedules)
+    schedules = Schedule.objects.filter(schedule_no__in=[schedule.schedule_no for schedule in schedules]).order_by('id')
+
+    # every segment gets the average length, so a route's fare only depends on its number of stops
+    distances = [decimal.Decimal(0)] + segment_distances(None, stop_num)
+    cumulative = cumulative_distances(distances[1:])
+    fares = [fare_for_distance(cumulative[n]) for n in range(stop_num)]
+    stops, routes = [], []
+    for schedule_id, departure_time in schedules.values_list('id', 'departure_time'):
+        station_ids = [station.id for station in rand.sample(stations, stop_num)]
+        stops.extend(
+            (schedule_id, station_id, order, departure_time + timedelta(hours=order),
+             distances[order], cumulative[order])
+            for order, station_id in enumerate(station_ids)
+        )
+        routes.extend(
+            (schedule_id, station_ids[i], station_ids[j], i, j, fares[j - i])
+            for i in range(stop_num) for j in range(i + 1, stop_num)
+        )
+
+    _insert_rows(ScheduleToStation, ['schedule', 'station', 'order', 'arrival_time', 'distance', 'cumulative_distance'],
+                 stops, batch_size)
+    _insert_rows(ScheduleRoute, ['schedule', 'ori_station', 'dst_station', 'ori_order', 'dst_order', 'base_fare'],
+                 routes, batch_size)
+
+
+def build_compositions(kind_num=3, carriage_num=4, seat_num=100, seed=0, batch_size=1000, prefix="B"):
+    """
+    create kind_num carriage types and give every schedule without carriages carriage_num carriages drawn from them
+    """
+    rand = random.Random(seed)
+
+    carriages = [
+        Carriage.objects.create(
+            name=f"{prefix}车厢{i}", seat_num=seat_num, increase_rate=decimal.Decimal(1 + i) / 2)
+        for i in range(kind_num)
+    ]
+
+    schedule_ids = list(
+        Schedule.objects.filter(scheduletocarriage__isnull=True).order_by('id').values_list('id', flat=True))
+    for chunk in _chunks(schedule_ids, batch_size):
+        schedule2carriages = []
+        for schedule_id in chunk:
+            composition = Counter(rand.choice(carriages) for _ in range(carriage_num))
+            schedule2carriages.extend(
+                ScheduleToCarriage(schedule_id=schedule_id, carriage=carriage, num=num, capacity=num * carriage.seat_num)
+                for carriage, num in composition.items()
+            )
+        ScheduleToCarriage.objects.bulk_create(schedule2carriages)
+
+    return carriages
+
+
+def build_users(user_num, contact_num=1, account_num=1, batch_size=1000, prefix="B"):
+    """
+    bulk insert users with their contacts and payment accounts, returns the users
+    """
+    User.objects.bulk_create(
+        (User(username=f"{prefix}user{i:07d}", email=f"{prefix}user{i:07d}@example.com") for i in range(user_num)),
+        batch_size=batch_size,
+    )
+    users = list(User.objects.filter(username__startswith=f"{prefix}user").order_by('id'))
+
+    for chunk in _chunks(users, batch_size):
+        Contact.objects.bulk_create(
+            Contact(name=f"乘客{user.id}-{i}", birthdate='2000-01-01', id_card=f"{prefix}{user.id:012d}{i:03d}", user=user)
+            for user in chunk for i in range(contact_num)
+        )
+        Account.objects.bulk_create(
+            Account(name=f"账户{i}", card_id=f"{user.id:012d}{i:04d}", amount=10000, user=user)
+            for user in chunk for i in range(account_num)
+        )
+
+    return users
+
+
+def build_tickets(ticket_num, users, seed=0, batch_size=1000, start=None):
+    """
+    bulk insert ticket_num paid tickets on random spans of random schedules for random users and their contacts,
+    then rebuild the seat inventory of every carriage from them. a ticket is dropped when its carriage is full
+    """
+    rand = random.Random(seed)
+    start = start or _default_start()
+
+    stops = {}
+    cumulative = {}
+    for schedule_id, station_id, distance in ScheduleToStation.objects.order_by('schedule_id', 'order').values_list(
+            'schedule_id', 'station_id', 'cumulative_distance'):
+        stops.setdefault(schedule_id, []).append(station_id)
+        cumulative.setdefault(schedule_id, []).append(distance)
+
+    schedule2carriages = {}
+    for schedule2carriage in ScheduleToCarriage.objects.select_related('carriage').order_by('id'):
+        schedule2carriages.setdefault(schedule2carriage.schedule_id, []).append(schedule2carriage)
+    schedule_ids = [schedule_id for schedule_id in schedule2carriages if len(stops.get(schedule_id, [])) > 1]
+
+    contacts = {}
+    for user_id, contact_id in Contact.objects.filter(user__in=users).order_by('id').values_list('user_id', 'id'):
+        contacts.setdefault(user_id, contact_id)
+
+    next_seat = Counter()
+    tickets = []
+    for _ in range(ticket_num):
+        schedule_id = rand.choice(schedule_ids)
+        schedule2carriage = rand.choice(schedule2carriages[schedule_id])
+        if next_seat[schedule2carriage.id] >= schedule2carriage.capacity:
+            continue
+        ori, dst = sorted(rand.sample(range(len(stops[schedule_id])), 2))
+        user_id = rand.choice(users).id
+
+        tickets.append((
+            schedule2carriage.fare(fare_for_distance(cumulative[schedule_id][dst] - cumulative[schedule_id][ori])),
+            start - timedelta(minutes=rand.randrange(60 * 24 * 30)),
+            True,
+            False,
+            next_seat[schedule2carriage.id],
+            schedule_id,
+            schedule2carriage.carriage_id,
+            stops[schedule_id][ori],
+            stops[schedule_id][dst],
+            user_id,
+            contacts[user_id],
+        ))
+        next_seat[schedule2carriage.id] += 1
+
+        if len(tickets) >= batch_size:
+            _insert_tickets(tickets, batch_size)
+            tickets = []
+    _insert_tickets(tickets, batch_size)
+
+    all_schedule2carriages = [s2c for chunk in schedule2carriages.values() for s2c in chunk]
+    for chunk in _chunks(all_schedule2carriages, batch_size):
+        ScheduleToCarriage.rebuild_seats(chunk)
+
+    return sum(next_seat.values())
+
+
+def _insert_tickets(tickets, batch_size):
+    _insert_rows(Ticket, [
+        'amount', 'create_time', 'is_paid', 'is_schedule_modified', 'seat_no',
+        'schedule', 'carriage', 'ori_station', 'dst_station', 'user', 'contact',
+    ], tickets, batch_size)
+
+
+def build_messages(message_num, users, seed=0, batch_size=1000):
+    """
+    bulk insert message_num messages, each to one random user
+    """
+    rand = random.Random(seed)
+    MessageToUser = Message.to_users.through
+
+    for chunk in _chunks(range(message_num), batch_size):
+        Message.objects.bulk_create(Message(message=f"通知{i}") for i in chunk)
+        messages = Message.objects.order_by('-id').values_list('id', flat=True)[:len(chunk)]
+        MessageToUser.objects.bulk_create(
+            MessageToUser(message_id=message_id, user_id=rand.choice(users).id) for message_id in messages)
+
+
+def build_bookings(user_num, ticket_num, message_num=0, carriage_num=4, seat_num=100, seed=0, batch_size=1000):
+    """
+    carriages for every schedule, users with a contact and an account, tickets and messages, returns the users
+    """
+    build_compositions(carriage_num=carriage_num, seat_num=seat_num, seed=seed, batch_size=batch_size)
+    users = build_users(user_num, batch_size=batch_size)
+    build_tickets(ticket_num, users, seed=seed, batch_size=batch_size)
+    build_messages(message_num, users, seed=seed, batch_size=batch_size)
+    return users
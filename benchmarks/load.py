@@ -0,0 +1,223 @@
+import math
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group, User
+from django.db import connection
+from django.test import Client
+
+from accounts.models import Account
+from benchmarks.data import _default_start, build_compositions, build_messages, build_timetable, build_users
+from benchmarks.runner import QueryCounter
+from contacts.models import Contact
+from schedules.models import ScheduleRoute, ScheduleToCarriage
+
+# in the order one round of a worker sends them, every round books a ticket and gives it back
+SCENARIOS = ['login', 'search', 'purchase', 'pay', 'change', 'cancel', 'inbox']
+
+PASSWORD = 'bench'
+
+
+def seed_load(schedule_num, station_num, stop_num, user_num, message_num=0, trip_num=200, seed=0, prefix="H"):
+    """
+    seed a timetable, users that can log in with PASSWORD and messages, returns (users, trips).
+    users are dicts of name, contact_id and account_id, trips are dicts of a bookable schedule, carriage and span.
+    schedules leave two days from now on, so their tickets can still be changed and cancelled
+    """
+    rand = random.Random(seed)
+    build_timetable(schedule_num, station_num, stop_num, seed=seed, prefix=prefix,
+                    start=_default_start() + timedelta(days=2))
+    build_compositions(seat_num=1000, seed=seed, prefix=prefix)
+    users = build_users(user_num, prefix=prefix)
+    build_messages(message_num, users, seed=seed)
+
+    user_ids = [user.id for user in users]
+    User.objects.filter(id__in=user_ids).update(password=make_password(PASSWORD))
+    # enough money for every round, a changed ticket is deleted without a refund
+    Account.objects.filter(user__in=user_ids).update(amount=10 ** 7)
+    common_user, _ = Group.objects.get_or_create(name='Common User')
+    UserToGroup = User.groups.through
+    UserToGroup.objects.bulk_create(UserToGroup(user_id=user_id, group=common_user) for user_id in user_ids)
+
+    contacts = dict(Contact.objects.filter(user__in=user_ids).order_by('-id').values_list('user_id', 'id'))
+    accounts = dict(Account.objects.filter(user__in=user_ids).order_by('-id').values_list('user_id', 'id'))
+    users = [
+        {'name': user.username, 'contact_id': contacts[user.id], 'account_id': accounts[user.id]} for user in users
+    ]
+
+    schedule_ids = list(ScheduleToCarriage.objects.order_by('schedule_id').values_list('schedule_id', flat=True).distinct())
+    schedule_ids = rand.sample(schedule_ids, min(trip_num, len(schedule_ids)))
+    routes, carriages = {}, {}
+    for route in ScheduleRoute.objects.filter(schedule_id__in=schedule_ids).order_by('id'):
+        routes.setdefault(route.schedule_id, []).append(route)
+    for schedule_id, carriage_id in ScheduleToCarriage.objects.filter(
+            schedule_id__in=schedule_ids).order_by('id').values_list('schedule_id', 'carriage_id'):
+        carriages.setdefault(schedule_id, []).append(carriage_id)
+
+    trips = []
+    for schedule_id in schedule_ids:
+        route = rand.choice(routes[schedule_id])
+        trips.append({
+            'schedule_id': schedule_id,
+            'carriage_id': rand.choice(carriages[schedule_id]),
+            'ori_station_id': route.ori_station_id,
+            'dst_station_id': route.dst_station_id,
+        })
+
+    return users, trips
+
+
+class Worker:
+    """
+    one simulated client: logs in as its user and runs rounds of SCENARIOS through the url routes,
+    recording (ms, sql statements, error message or None) for every request
+    """
+
+    def __init__(self, user, trips, seed=0):
+        self.user = user
+        self.trips = trips
+        self.rand = random.Random(seed)
+        self.client = Client(HTTP_HOST='localhost')
+        self.counter = QueryCounter()
+        self.jwt = None
+        self.samples = {name: [] for name in SCENARIOS}
+
+    def call(self, name, method, path, data=None):
+        headers = {'HTTP_JWT': self.jwt} if self.jwt else {}
+        self.counter.count = 0
+        start = time.perf_counter()
+        try:
+            if method == 'get':
+                response = self.client.get(path, data, **headers)
+            else:
+                response = getattr(self.client, method)(path, data, content_type='application/json', **headers)
+            body = response.json()
+            error = body.get('message', None) if body.get('result', 0) else None
+            if response.status_code != 200:
+                error = f"status {response.status_code}"
+        except Exception as e:
+            body, error = None, repr(e)
+        self.samples[name].append(((time.perf_counter() - start) * 1000, self.counter.count, error))
+        return None if error else body
+
+    def login(self):
+        body = self.call('login', 'post', '/users/login', {'name': self.user['name'], 'passwd': PASSWORD})
+        if body:
+            self.jwt = body['jwt']
+
+    def round(self):
+        self.login()
+
+        trip = self.rand.choice(self.trips)
+        self.call('search', 'get', '/schedules/', {'ori': trip['ori_station_id'], 'dst': trip['dst_station_id']})
+
+        body = self.call('purchase', 'post', '/tickets/', dict(trip, contact_id=self.user['contact_id']))
+        if body:
+            path = f"/tickets/{body['ticket_id']}"
+            self.call('pay', 'patch', path, {'account_id': self.user['account_id']})
+            # the same schedule passes the change checks, and the ticket ends up unpaid
+            self.call('change', 'put', path, {'new_schedule_id': trip['schedule_id'], 'carriage_id': trip['carriage_id']})
+            self.call('cancel', 'delete', path, {'account_id': self.user['account_id']})
+
+        self.call('inbox', 'get', '/messages/')
+
+    def run(self, rounds):
+        with connection.execute_wrapper(self.counter):
+            for _ in range(rounds):
+                self.round()
+        return self.samples
+
+
+def _run_thread(worker, rounds):
+    try:
+        return worker.run(rounds)
+    finally:
+        connection.close()
+
+
+def run_load(users, trips, workers=4, rounds=10, seed=0):
+    """
+    run rounds of SCENARIOS on workers threads at once, each as its own user, returns the stats of every scenario.
+    a single worker runs in the calling thread
+    """
+    pool = [Worker(users[i % len(users)], trips, seed + i) for i in range(workers)]
+
+    start = time.perf_counter()
+    if workers == 1:
+        results = [pool[0].run(rounds)]
+    else:
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(_run_thread, pool, [rounds] * workers))
+    elapsed = time.perf_counter() - start
+
+    return {
+        name: scenario_stats([sample for samples in results for sample in samples[name]], elapsed)
+        for name in SCENARIOS
+    }
+
+
+def percentile(values, p):
+    """
+    nearest-rank percentile of a non-empty list
+    """
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def scenario_stats(samples, elapsed):
+    if not samples:
+        return {'requests': 0, 'errors': 0}
+
+    timings = [ms for ms, _, _ in samples]
+    errors = [error for _, _, error in samples if error]
+    return {
+        'requests': len(samples),
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'p50_ms': percentile(timings, 50),
+        'p95_ms': percentile(timings, 95),
+        'p99_ms': percentile(timings, 99),
+        'rps': len(samples) / elapsed,
+        # the first request of a worker also fills the permission cache, the median is the steady state
+        'queries': statistics.median_low([queries for _, queries, _ in samples]),
+    }
+
+
+def format_stats(name, stats):
+    if not stats['requests']:
+        return f"{name:<10} no requests"
+    return (f"{name:<10} {stats['requests']:6d} req {stats['errors']:4d} err   "
+            f"p50 {stats['p50_ms']:8.2f}   p95 {stats['p95_ms']:8.2f}   p99 {stats['p99_ms']:8.2f} ms   "
+            f"{stats['rps']:8.1f} req/s   {stats['queries']:3d} queries/req")
+
+
+def to_baseline(stats):
+    return {
+        name: {'p95_ms': round(scenario['p95_ms'], 2), 'queries': scenario['queries']}
+        for name, scenario in stats.items() if scenario['requests']
+    }
+
+
+def regressions(stats, baseline, tolerance=0.5):
+    """
+    compare stats with a baseline of {scenario: {'p95_ms': ..., 'queries': ...}}, returns what got worse.
+    latency may exceed the baseline by tolerance, as a fraction of it, sql statements and errors may not
+    """
+    problems = []
+    for name, limits in baseline.items():
+        scenario = stats.get(name, None)
+        if not scenario or not scenario['requests']:
+            problems.append(f"{name}: no requests")
+            continue
+        if scenario['errors']:
+            problems.append(f"{name}: {scenario['errors']} of {scenario['requests']} requests failed, "
+                            f"first with {scenario['first_error']}")
+        if 'queries' in limits and scenario['queries'] > limits['queries']:
+            problems.append(f"{name}: {scenario['queries']} queries/req, baseline {limits['queries']}")
+        if 'p95_ms' in limits and scenario['p95_ms'] > limits['p95_ms'] * (1 + tolerance):
+            problems.append(f"{name}: p95 {scenario['p95_ms']:.2f} ms, baseline {limits['p95_ms']:.2f} ms")
+    return problems
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+
+import jwt
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from benchmarks.runner import measure, scratch_database, summary
+from users.models import RoleVersion
+from utils.perm import invalidate_user, permission_check
+
+
+@permission_check(['Common User'])
+def authorized(request):
+    return None
+
+
+class Command(BaseCommand):
+    help = "compare the latency of permission_check with and without the database on a scratch database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            user = User.objects.create_user('bench', 'bench@example.com', 'bench')
+            for name in ['Common User', 'Train Admin', 'System Admin']:
+                user.groups.add(Group.objects.get_or_create(name=name)[0])
+            version = RoleVersion.objects.create(user=user).version
+
+            expire = (datetime.now() + timedelta(hours=2)).isoformat()
+            plain_jwt = jwt.encode({'id': user.id, 'expire': expire}, settings.SECRET_KEY)
+            claims_jwt = jwt.encode({
+                'id': user.id, 'expire': expire, 'role_version': version, 'roles': ['Common User'],
+            }, settings.SECRET_KEY)
+
+            plain_request = RequestFactory().get('/', HTTP_JWT=plain_jwt)
+            claims_request = RequestFactory().get('/', HTTP_JWT=claims_jwt)
+
+            def uncached(request):
+                invalidate_user(user.id)
+                return authorized(request)
+
+            if not settings.PERMISSION_CACHE:
+                self.stderr.write("settings.PERMISSION_CACHE names no shared cache, every case reads the database")
+            cache.clear()
+            cases = [
+                ("database", lambda: uncached(plain_request)),
+                ("user cache", lambda: authorized(plain_request)),
+                ("role claims, cold", lambda: uncached(claims_request)),
+                ("role claims", lambda: authorized(claims_request)),
+            ]
+            for name, func in cases:
+                timings, queries, _ = measure(func, options['repeat'])
+                self.stdout.write(summary(name, timings, queries))
@@ -0,0 +1,68 @@
+import random
+
+from django.core.management.base import BaseCommand
+from django.db import connection, models
+from django.utils import timezone
+
+from benchmarks.data import build_bookings, build_timetable
+from benchmarks.runner import measure, scratch_database, summary
+from schedules.models import Schedule, ScheduleRoute, ScheduleToCarriage, SeatOccupancy
+from system_messages.models import Message
+from tickets.models import Ticket
+
+
+def hot_queries(ori_station, dst_station, user, schedule2carriage):
+    """
+    the statements behind search, purchase and the ticket and message lists, as unevaluated querysets
+    """
+    route = ScheduleRoute.objects.filter(schedule_id=schedule2carriage.schedule_id).first()
+
+    return {
+        'search': Schedule.objects.passing(ori_station, dst_station)
+        .filter(departure_time__gte=timezone.now()).distinct().order_by('departure_time', 'id')[:20],
+        'search one station': Schedule.objects.passing(ori_station, None).order_by('departure_time', 'id')[:20],
+        'purchase carriage': ScheduleToCarriage.objects.filter(
+            schedule_id=schedule2carriage.schedule_id, carriage_id=schedule2carriage.carriage_id),
+        'purchase route': ScheduleRoute.objects.filter(
+            schedule_id=route.schedule_id, ori_station_id=route.ori_station_id, dst_station_id=route.dst_station_id),
+        'purchase free seat': SeatOccupancy.objects.filter(schedule2carriage=schedule2carriage)
+        .alias(busy=models.F('legs').bitand(route.legs)).filter(busy=0).order_by('seat_no')[:1],
+        'seat rebuild tickets': Ticket.objects.filter(
+            schedule_id=schedule2carriage.schedule_id, carriage_id=schedule2carriage.carriage_id),
+        'ticket list': Ticket.objects.filter(user=user).order_by('-create_time')[:20],
+        'inbox page': Message.objects.inbox(user).order_by('-send_time', '-id')[:20],
+    }
+
+
+class Command(BaseCommand):
+    help = "print the EXPLAIN plan and timings of the hot query shapes on a seeded scratch database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--schedules', type=int, default=2000)
+        parser.add_argument('--stations', type=int, default=200)
+        parser.add_argument('--stops', type=int, default=12)
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--tickets', type=int, default=20000)
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--analyze', action='store_true', help="pass ANALYZE to EXPLAIN where the database supports it")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            stations = build_timetable(options['schedules'], options['stations'], options['stops'], options['seed'])
+            users = build_bookings(options['users'], options['tickets'], options['messages'], seed=options['seed'])
+
+            rand = random.Random(options['seed'])
+            ori_station, dst_station = rand.sample(stations, 2)
+            user = rand.choice(users)
+            schedule2carriage = ScheduleToCarriage.objects.order_by('-sold').first()
+
+            self.stdout.write(f"{connection.vendor}: {options['schedules']} schedules, {options['tickets']} tickets, "
+                              f"{options['messages']} messages")
+
+            explain_options = {'analyze': True} if options['analyze'] else {}
+            for name, queryset in hot_queries(ori_station, dst_station, user, schedule2carriage).items():
+                timings, queries, _ = measure(lambda: list(queryset.all()), options['repeat'])
+                self.stdout.write(f"\n== {summary(name, timings, queries)}")
+                self.stdout.write(queryset.explain(**explain_options))
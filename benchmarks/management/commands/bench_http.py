@@ -0,0 +1,64 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from benchmarks.load import SCENARIOS, format_stats, regressions, run_load, seed_load, to_baseline
+from benchmarks.runner import scratch_database
+
+DEFAULT_BASELINE = Path(__file__).resolve().parents[2] / 'http_baseline.json'
+
+
+class Command(BaseCommand):
+    help = ("drive login, search, purchase, pay, change, cancel and inbox through the url routes from several threads "
+            "on a seeded scratch database, report latency percentiles, throughput and sql statements per request "
+            "and fail when the baseline regresses")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--schedules', type=int, default=2000)
+        parser.add_argument('--stations', type=int, default=200)
+        parser.add_argument('--stops', type=int, default=12)
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--workers', type=int, default=4, help="threads sending requests at once")
+        parser.add_argument('--rounds', type=int, default=20, help="rounds of every scenario per worker")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--baseline', default=str(DEFAULT_BASELINE))
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help="fraction by which p95 latency may exceed the baseline")
+        parser.add_argument('--write-baseline', action='store_true', help="save this run as the baseline")
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            users, trips = seed_load(options['schedules'], options['stations'], options['stops'], options['users'],
+                                     options['messages'], seed=options['seed'])
+
+            workers = options['workers']
+            if connection.vendor == 'sqlite' and workers > 1:
+                # the in-memory test database locks whole tables, concurrent writers would only measure the lock
+                self.stderr.write("sqlite can't take concurrent writes, running a single worker")
+                workers = 1
+
+            self.stdout.write(f"{connection.vendor}: {options['schedules']} schedules, {options['users']} users, "
+                              f"{workers} workers x {options['rounds']} rounds")
+
+            stats = run_load(users, trips, workers, options['rounds'], options['seed'])
+
+        for name in SCENARIOS:
+            self.stdout.write(format_stats(name, stats[name]))
+
+        baseline_path = Path(options['baseline'])
+        if options['write_baseline']:
+            baseline_path.write_text(json.dumps(to_baseline(stats), indent=4) + '\n')
+            self.stdout.write(f"baseline written to {baseline_path}")
+            return
+
+        if not baseline_path.exists():
+            self.stdout.write(f"no baseline at {baseline_path}, nothing to compare")
+            return
+
+        problems = regressions(stats, json.loads(baseline_path.read_text()), options['tolerance'])
+        if problems:
+            raise CommandError("regressed against the baseline:\n" + "\n".join(problems))
+        self.stdout.write("within the baseline")
@@ -0,0 +1,56 @@
+import random
+
+from django.core.management.base import BaseCommand
+
+from benchmarks.data import build_timetable
+from benchmarks.runner import measure, scratch_database, summary
+from schedules.models import Schedule
+
+
+def legacy_search(ori_station, dst_station):
+    """
+    the schedule search before the route index: two ScheduleToStation lookups per schedule
+    """
+    def is_option_schedule(schedule):
+        self_ori = schedule.scheduletostation_set.filter(station=ori_station).first()
+        self_dst = schedule.scheduletostation_set.filter(station=dst_station).first()
+        return bool(self_ori and self_dst and self_ori.order < self_dst.order)
+
+    return [schedule.id for schedule in Schedule.objects.all() if is_option_schedule(schedule)]
+
+
+def indexed_search(ori_station, dst_station):
+    return list(Schedule.objects.passing(ori_station, dst_station).distinct().values_list('id', flat=True))
+
+
+class Command(BaseCommand):
+    help = "compare the per-schedule search against the single-statement search on a scratch database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--schedules', type=int, default=10000)
+        parser.add_argument('--stations', type=int, default=200)
+        parser.add_argument('--stops', type=int, default=12)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--legacy-repeat', type=int, default=1)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            stations = build_timetable(options['schedules'], options['stations'], options['stops'], options['seed'])
+            ori_station, dst_station = random.Random(options['seed']).sample(stations, 2)
+
+            self.stdout.write(f"{options['schedules']} schedules, {options['stops']} stops each, "
+                              f"searching {ori_station.station_no} -> {dst_station.station_no}")
+
+            legacy_timings, legacy_queries, legacy_result = measure(
+                lambda: legacy_search(ori_station, dst_station), options['legacy_repeat'])
+            indexed_timings, indexed_queries, indexed_result = measure(
+                lambda: indexed_search(ori_station, dst_station), options['repeat'])
+
+            if sorted(legacy_result) != sorted(indexed_result):
+                self.stderr.write("search results differ")
+                return
+
+            self.stdout.write(f"{len(indexed_result)} matching schedules")
+            self.stdout.write(summary("legacy (per schedule)", legacy_timings, legacy_queries))
+            self.stdout.write(summary("single statement", indexed_timings, indexed_queries))
@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from benchmarks.data import build_compositions, build_messages, build_tickets, build_timetable, build_users
+from schedules.models import Station
+
+
+class Command(BaseCommand):
+    help = ("fill the configured database with a synthetic timetable, users and tickets for load tests. "
+            "the same seed on the same empty database gives the same rows")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stations', type=int, default=500)
+        parser.add_argument('--schedules', type=int, default=10000)
+        parser.add_argument('--stops', type=int, default=12)
+        parser.add_argument('--carriage-kinds', type=int, default=3)
+        parser.add_argument('--carriages', type=int, default=8, help="carriages per schedule")
+        parser.add_argument('--seats', type=int, default=100, help="seats per carriage")
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--contacts', type=int, default=2, help="contacts per user")
+        parser.add_argument('--accounts', type=int, default=1, help="accounts per user")
+        parser.add_argument('--tickets', type=int, default=100000)
+        parser.add_argument('--messages', type=int, default=0)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--prefix', default="L", help="prefix of generated numbers and names, change it to load again")
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        batch_size = options['batch_size']
+        seed = options['seed']
+
+        if options['stops'] > options['stations']:
+            raise CommandError("--stops can't exceed --stations")
+        if Station.objects.filter(station_no__startswith=f"{prefix}S").exists():
+            raise CommandError(f"data with prefix {prefix} was already generated, pass another --prefix")
+
+        def step(name, build):
+            start = time.perf_counter()
+            result = build()
+            self.stdout.write(f"{name:<12} {time.perf_counter() - start:8.1f} s")
+            return result
+
+        step("timetable", lambda: build_timetable(
+            options['schedules'], options['stations'], options['stops'], seed, batch_size, prefix))
+        step("carriages", lambda: build_compositions(
+            options['carriage_kinds'], options['carriages'], options['seats'], seed, batch_size, prefix))
+        users = step("users", lambda: build_users(
+            options['users'], options['contacts'], options['accounts'], batch_size, prefix))
+        sold = step("tickets", lambda: build_tickets(options['tickets'], users, seed, batch_size))
+        step("messages", lambda: build_messages(options['messages'], users, seed, batch_size))
+
+        self.stdout.write(f"{options['schedules']} schedules, {len(users)} users, {sold} tickets sold")
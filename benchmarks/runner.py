@@ -0,0 +1,51 @@
+import statistics
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+
+
+@contextmanager
+def scratch_database(verbosity=0):
+    """
+    run the benchmark against a freshly migrated test database, so the configured one is never touched
+    """
+    old_config = setup_databases(verbosity, interactive=False)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity)
+
+
+class QueryCounter:
+    """
+    connection.execute_wrapper hook counting sql statements, works without DEBUG and without a log size limit
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def measure(func, repeat):
+    """
+    call func repeat times, return (timings in ms, sql statements issued by one call, result of the last call)
+    """
+    timings = []
+    result = None
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter):
+        for _ in range(repeat):
+            counter.count = 0
+            start = time.perf_counter()
+            result = func()
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings, counter.count, result
+
+
+def summary(name, timings, queries):
+    return (f"{name:<24} median {statistics.median(timings):10.2f} ms   "
+            f"min {min(timings):10.2f} ms   {queries:6d} queries")
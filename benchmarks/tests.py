@@ -0,0 +1,44 @@
+from django.test import TestCase
+
+from benchmarks.load import SCENARIOS, percentile, regressions, run_load, seed_load, to_baseline
+
+
+class LoadTestCase(TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 99), 7)
+
+    def test_run_load(self):
+        users, trips = seed_load(20, 10, 4, 2, message_num=5)
+
+        stats = run_load(users, trips, workers=1, rounds=2)
+
+        # 每一轮都走完登录、查询、购票、支付、改签、退票和消息列表
+        for name in SCENARIOS:
+            self.assertEqual(stats[name]['requests'], 2, name)
+            self.assertEqual(stats[name]['errors'], 0, stats[name]['first_error'])
+            self.assertGreater(stats[name]['queries'], 0, name)
+        self.assertEqual(regressions(stats, to_baseline(stats)), [])
+
+    def test_regressions(self):
+        stats = {
+            'search': {'requests': 10, 'errors': 0, 'first_error': None, 'p95_ms': 30.0, 'queries': 4},
+            'pay': {'requests': 10, 'errors': 1, 'first_error': "账户余额不足", 'p95_ms': 5.0, 'queries': 3},
+        }
+        baseline = {
+            'search': {'p95_ms': 10.0, 'queries': 3},
+            'pay': {'p95_ms': 5.0, 'queries': 3},
+            'inbox': {'p95_ms': 5.0, 'queries': 1},
+        }
+
+        problems = regressions(stats, baseline, tolerance=0.5)
+
+        self.assertEqual(len(problems), 4)
+        self.assertTrue(problems[0].startswith('search: 4 queries/req'))
+        self.assertTrue(problems[1].startswith('search: p95'))
+        self.assertIn("账户余额不足", problems[2])
+        self.assertEqual(problems[3], 'inbox: no requests')
+        self.assertEqual(regressions(stats, {'search': {'p95_ms': 25.0, 'queries': 4}}), [])
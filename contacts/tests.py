@@ -1,114 +1,94 @@
-import unittest
-from unittest.mock import patch
-from django.test import RequestFactory
-from views import ContactView, ContactIdView
-from django.contrib.auth.models import User
+from datetime import date, datetime, timedelta
+
+import jwt
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.test import TestCase
+
 from contacts.models import Contact
-from datetime import datetime
 from contacts.serializers import ContactSerializer
+from schedules.models import Carriage, Schedule
+from tickets.models import Ticket
+
 # Create your tests here.
 
-class ContactViewTestCase(unittest.TestCase):
+
+def login(user):
+    return {'HTTP_JWT': jwt.encode(
+        {'id': user.id, 'expire': (datetime.now() + timedelta(hours=2)).isoformat()},
+        settings.SECRET_KEY,
+    )}
+
+
+class ContactViewTestCase(TestCase):
     def setUp(self):
-        self.factory = RequestFactory()
-        self.view = ContactView()
+        self.user = User.objects.create(username='testuser')
+        self.user.groups.add(Group.objects.create(name='Common User'))
+        self.headers = login(self.user)
 
     def test_get_contacts(self):
-        # 创建GET请求对象
-        request = self.factory.get('/contacts/')
-        # 设置用户对象
-        user = User.objects.create(username='testuser', role='Common User')
         # 创建联系人对象
-        contact1 = Contact.objects.create(name='John Doe', gender='M', birthdate='1990-01-01', id_card='1234567890', user=user)
-        contact2 = Contact.objects.create(name='Jane Doe', gender='F', birthdate='1992-05-10', id_card='0987654321', user=user)
+        contact1 = Contact.objects.create(name='John Doe', gender='M', birthdate='1990-01-01', id_card='1234567890', user=self.user)
+        contact2 = Contact.objects.create(name='Jane Doe', gender='F', birthdate='1992-05-10', id_card='0987654321', user=self.user)
         # 调用视图方法进行测试
-        response = self.view.get(request, user)
+        response = self.client.get('/contacts/', **self.headers)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.json(), {'contacts': ContactSerializer([contact1, contact2], many=True).data})
+        contacts = Contact.objects.filter(id__in=[contact1.id, contact2.id])
+        self.assertEqual(response.json(), {'contacts': ContactSerializer(contacts, many=True).data})
 
     def test_post_with_valid_data(self):
-        # 创建POST请求对象
-        request = self.factory.post('/contacts/', {'name': 'John Doe', 'gender': 'M', 'birthdate': '1990-01-01', 'id_card': '1234567890'})
-        # 设置用户对象
-        user = User.objects.create(username='testuser', role='Common User')
-        # 调用视图方法进行测试
-        response = self.view.post(request, user)
+        response = self.client.post('/contacts/', {
+            'name': 'John Doe', 'gender': 'M', 'birthdate': '1990-01-01', 'id_card': '1234567890',
+        }, **self.headers)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {'result': 0, 'message': "添加联系人成功"})
         # 确保联系人已添加
-        self.assertEqual(user.contacts.count(), 1)
-        contact = user.contacts.first()
+        self.assertEqual(self.user.contacts.count(), 1)
+        contact = self.user.contacts.first()
         self.assertEqual(contact.name, 'John Doe')
         self.assertEqual(contact.gender, 'M')
-        self.assertEqual(contact.birthdate, datetime.date(1990, 1, 1))
+        self.assertEqual(contact.birthdate, date(1990, 1, 1))
         self.assertEqual(contact.id_card, '1234567890')
 
     def test_post_with_missing_data(self):
-        # 创建POST请求对象
-        request = self.factory.post('/contacts/', {'name': 'John Doe', 'gender': 'M'})
-        # 设置用户对象
-        user = User.objects.create(username='testuser', role='Common User')
-        # 调用视图方法进行测试
-        response = self.view.post(request, user)
+        response = self.client.post('/contacts/', {'name': 'John Doe', 'gender': 'M'}, **self.headers)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {'result': 1, 'message': "必须包含姓名、生日和身份证号"})
         # 确保联系人未添加
-        self.assertEqual(user.contacts.count(), 0)
+        self.assertEqual(self.user.contacts.count(), 0)
+
 
-class ContactIdViewTestCase(unittest.TestCase):
+class ContactIdViewTestCase(TestCase):
     def setUp(self):
-        self.factory = RequestFactory()
-        self.view = ContactIdView()
+        self.user = User.objects.create(username='testuser')
+        self.user.groups.add(Group.objects.create(name='Common User'))
+        self.headers = login(self.user)
+        self.contact = Contact.objects.create(
+            name='John Doe', gender='M', birthdate='1990-01-01', id_card='1234567890', user=self.user)
 
     def test_delete_existing_contact(self):
-        # 设置用户对象
-        user = User.objects.create(username='testuser', role='Common User')
-        # 创建联系人对象
-        contact = Contact.objects.create(name='John Doe', gender='M', birthdate='1990-01-01', id_card='1234567890', user=user)
-        contact_id = contact.id
-        # 创建DELETE请求对象
-        request = self.factory.delete('/contacts/' + contact_id)
-        # 调用视图方法进行测试
-        response = self.view.delete(request, contact_id, user)
+        response = self.client.delete(f'/contacts/{self.contact.id}', **self.headers)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {'result': 0, 'message': "成功删除联系人"})
         # 确保联系人已被删除
-        self.assertFalse(user.contacts.filter(id=contact_id).exists())
+        self.assertFalse(self.user.contacts.filter(id=self.contact.id).exists())
 
     def test_delete_nonexistent_contact(self):
-        # 设置用户对象
-        user = User.objects.create(username='testuser', role='Common User')
         contact_id = 123456  # 假设不存在的联系人ID
-        # 创建DELETE请求对象
-        request = self.factory.delete('/contacts/' + contact_id)
-        # 调用视图方法进行测试
-        response = self.view.delete(request, contact_id, user)
+        response = self.client.delete(f'/contacts/{contact_id}', **self.headers)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {'result': 1, 'message': "未找到联系人"})
 
     def test_delete_contact_with_restricted_error(self):
-        # 设置用户对象
-        user = User.objects.create(username='testuser', role='Common User')
-        # 创建联系人对象
-        contact = Contact.objects.create(name='John Doe', gender='M', birthdate='1990-01-01', id_card='1234567890', user=user)
-        contact_id = contact.id
-        # 创建DELETE请求对象
-        request = self.factory.delete('/contacts/' + contact_id)
-
-        # 使用patch装饰器模拟RestrictedError
-        with patch('views.Contact.delete') as mock_delete:
-            mock_delete.side_effect = RestrictedError
+        # 联系人已被用于购买车票
+        Ticket.objects.create(
+            amount=10, seat_no=0, user=self.user, contact=self.contact,
+            schedule=Schedule.objects.create(schedule_no='G1', departure_time='2023-06-01T08:00:00Z'),
+            carriage=Carriage.objects.create(name='二等座', seat_num=10),
+        )
 
-            # 调用视图方法进行测试
-            response = self.view.delete(request, contact_id, user)
-
-            self.assertEqual(response.status_code, 200)
-            self.assertEqual(response.json(), {'result': 1, 'message': "该联系人已经被用于购买车票，无法删除"})
-            # 确保联系人未被删除
-            self.assertTrue(user.contacts.filter(id=contact_id).exists())
-
-class RestrictedError(Exception):
-    pass
-
-if __name__ == '__main__':
-    unittest.main()
+        response = self.client.delete(f'/contacts/{self.contact.id}', **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'result': 1, 'message': "该联系人已经被用于购买车票，无法删除"})
+        # 确保联系人未被删除
+        self.assertTrue(self.user.contacts.filter(id=self.contact.id).exists())
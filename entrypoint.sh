@@ -1,7 +1,18 @@
 python manage.py makemigrations
 
+# rows that would break the unique constraints of schedules, stops it can't merge stop the deploy
+python manage.py dedupe_schedules || exit 1
+
 python manage.py migrate
 
+# schedules stored before the route index or the stop distances existed
+python manage.py rebuild_routes
+
+# carriages stored before the seat counters and occupancy existed
+python manage.py rebuild_seat_inventory --missing
+
 python manage.py loaddata seed.json
 
+python manage.py run_workers &
+
 python manage.py runserver 0.0.0.0:8000
@@ -0,0 +1,42 @@
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from jobs.queue import Worker, requeue_stale, run_pending
+
+
+class Command(BaseCommand):
+    help = "run queued jobs with a pool of worker threads, start the command several times for more processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--batch-size', type=int, default=10)
+        parser.add_argument('--poll-interval', type=float, default=settings.JOB_POLL_INTERVAL)
+        parser.add_argument('--once', action='store_true', help="run the jobs that are due and exit")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            requeue_stale()
+            self.stdout.write(f"ran {run_pending(options['batch_size'])} jobs")
+            return
+
+        stop_event = threading.Event()
+        workers = [
+            Worker(stop_event, options['batch_size'], options['poll_interval'], name=f"job-worker-{i}")
+            for i in range(options['threads'])
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f"started {len(workers)} job workers")
+
+        try:
+            while not stop_event.is_set():
+                requeue_stale()
+                stop_event.wait(settings.JOB_LOCK_TIMEOUT / 2)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop_event.set()
+            for worker in workers:
+                worker.join()
@@ -0,0 +1,25 @@
+from django.db import models
+from django.utils import timezone
+
+
+# Create your models here.
+class Job(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, PENDING), (RUNNING, RUNNING), (DONE, DONE), (FAILED, FAILED)]
+
+    name = models.CharField(max_length=128)
+    kwargs = models.JSONField(default=dict)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=64, blank=True, default='')
+    locked_at = models.DateTimeField(null=True)
+    last_error = models.TextField(blank=True, default='')
+    create_time = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_at'])]
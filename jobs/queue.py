@@ -0,0 +1,131 @@
+import logging
+import threading
+import traceback
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from jobs.models import Job
+
+logger = logging.getLogger(__name__)
+
+_tasks = {}
+
+
+def task(func):
+    """
+    register func so that workers can run it by its dotted name, its keyword arguments must be json serializable.
+    a job may run again after a failure or a worker crash, so tasks should be safe to repeat
+    """
+    func.job_name = f"{func.__module__}.{func.__name__}"
+    _tasks[func.job_name] = func
+    return func
+
+
+def enqueue(func, **kwargs):
+    """
+    schedule func(**kwargs) to be run by a worker, inside the current transaction if there is one
+    """
+    return Job.objects.create(name=func.job_name, kwargs=kwargs, max_attempts=settings.JOB_MAX_ATTEMPTS)
+
+
+def enqueue_many(func, kwargs_list, batch_size=1000):
+    Job.objects.bulk_create(
+        (Job(name=func.job_name, kwargs=kwargs, max_attempts=settings.JOB_MAX_ATTEMPTS) for kwargs in kwargs_list),
+        batch_size=batch_size,
+    )
+
+
+def claim(limit):
+    """
+    mark up to limit due jobs as running for the caller and return them.
+    the update only takes rows still pending, so concurrent workers, threads or processes, never share a job
+    """
+    now = timezone.now()
+    ids = list(
+        Job.objects.filter(status=Job.PENDING, run_at__lte=now).order_by('run_at', 'id').values_list('id', flat=True)[:limit]
+    )
+    if not ids:
+        return []
+
+    token = uuid.uuid4().hex
+    Job.objects.filter(id__in=ids, status=Job.PENDING).update(status=Job.RUNNING, locked_by=token, locked_at=now)
+    return list(Job.objects.filter(locked_by=token, status=Job.RUNNING).order_by('run_at', 'id'))
+
+
+def run_job(job):
+    """
+    run a claimed job in its own transaction. done jobs are deleted, failed ones are retried
+    with exponential backoff until max_attempts, then kept as failed for inspection
+    """
+    job.attempts += 1
+    try:
+        func = _tasks.get(job.name)
+        if func is None:
+            raise LookupError(f"no task registered as {job.name}")
+        with transaction.atomic():
+            func(**job.kwargs)
+    except Exception:
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = Job.FAILED
+            logger.error("job %s %s failed after %d attempts\n%s", job.id, job.name, job.attempts, job.last_error)
+        else:
+            job.status = Job.PENDING
+            job.run_at = timezone.now() + timedelta(seconds=settings.JOB_RETRY_DELAY * 2 ** (job.attempts - 1))
+        job.locked_by = ''
+        job.save(update_fields=['attempts', 'last_error', 'status', 'run_at', 'locked_by'])
+        return False
+
+    job.delete()
+    return True
+
+
+def run_pending(batch_size=10):
+    """
+    run due jobs in the calling thread until none is left, returns how many were run
+    """
+    count = 0
+    while jobs := claim(batch_size):
+        for job in jobs:
+            run_job(job)
+        count += len(jobs)
+    return count
+
+
+def requeue_stale():
+    """
+    give jobs of workers that died while running them back to the queue
+    """
+    return Job.objects.filter(
+        status=Job.RUNNING,
+        locked_at__lt=timezone.now() - timedelta(seconds=settings.JOB_LOCK_TIMEOUT),
+    ).update(status=Job.PENDING, locked_by='')
+
+
+class Worker(threading.Thread):
+    def __init__(self, stop_event, batch_size=10, poll_interval=1.0, **kwargs):
+        super().__init__(daemon=True, **kwargs)
+        self.stop_event = stop_event
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                close_old_connections()
+                try:
+                    jobs = claim(self.batch_size)
+                    for job in jobs:
+                        run_job(job)
+                except Exception:
+                    logger.exception("worker %s could not run jobs", self.name)
+                    jobs = []
+
+                if not jobs:
+                    self.stop_event.wait(self.poll_interval)
+        finally:
+            connection.close()
@@ -0,0 +1,8 @@
+import utils.mail
+from jobs.queue import task
+
+
+@task
+def send_mail(subject, text_content, html_content, from_email, to):
+    # workers are long lived threads, their mail shares one connection per thread
+    utils.mail.send_mail_pooled(subject, text_content, html_content, from_email=from_email, to=to)
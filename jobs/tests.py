@@ -0,0 +1,92 @@
+import io
+from datetime import timedelta
+
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from jobs.models import Job
+from jobs.queue import task, enqueue, enqueue_many, claim, run_pending, requeue_stale
+from jobs.tasks import send_mail
+
+calls = []
+
+
+@task
+def record(value, fail_times=0):
+    calls.append(value)
+    if calls.count(value) <= fail_times:
+        raise RuntimeError(f"failure {calls.count(value)}")
+
+
+# Create your tests here.
+class JobQueueTest(TestCase):
+    def setUp(self):
+        calls.clear()
+
+    def test_run_and_delete(self):
+        enqueue(record, value=1)
+        enqueue_many(record, [{'value': 2}, {'value': 3}])
+
+        self.assertEqual(run_pending(batch_size=2), 3)
+        self.assertEqual(calls, [1, 2, 3])
+        self.assertFalse(Job.objects.exists())
+
+    @override_settings(JOB_RETRY_DELAY=60, JOB_MAX_ATTEMPTS=3)
+    def test_retry_with_backoff(self):
+        enqueue(record, value=1, fail_times=1)
+
+        # 第一次失败后推迟重试
+        self.assertEqual(run_pending(), 1)
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (Job.PENDING, 1))
+        self.assertIn("failure 1", job.last_error)
+        self.assertGreater(job.run_at, timezone.now() + timedelta(seconds=50))
+        self.assertEqual(run_pending(), 0)
+
+        Job.objects.update(run_at=timezone.now())
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(calls, [1, 1])
+        self.assertFalse(Job.objects.exists())
+
+    @override_settings(JOB_RETRY_DELAY=0, JOB_MAX_ATTEMPTS=3)
+    def test_give_up_after_max_attempts(self):
+        enqueue(record, value=1, fail_times=10)
+
+        with self.assertLogs('jobs.queue', 'ERROR'):
+            self.assertEqual(run_pending(), 3)
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 3))
+
+    def test_claim_is_exclusive(self):
+        enqueue_many(record, [{'value': i} for i in range(5)])
+
+        first = claim(3)
+        second = claim(3)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        self.assertFalse({job.id for job in first} & {job.id for job in second})
+        self.assertEqual(claim(3), [])
+
+    @override_settings(JOB_LOCK_TIMEOUT=60)
+    def test_requeue_stale(self):
+        enqueue(record, value=1)
+        claim(1)
+        self.assertEqual(requeue_stale(), 0)
+
+        Job.objects.update(locked_at=timezone.now() - timedelta(seconds=120))
+        self.assertEqual(requeue_stale(), 1)
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(calls, [1])
+
+    def test_run_workers_once_sends_mail(self):
+        enqueue(send_mail, subject="主题", text_content="正文", html_content="<p>正文</p>",
+                from_email='noreply@example.com', to=['someone@example.com'])
+        self.assertEqual(len(mail.outbox), 0)
+
+        out = io.StringIO()
+        call_command('run_workers', '--once', stdout=out)
+        self.assertIn("ran 1 jobs", out.getvalue())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['someone@example.com'])
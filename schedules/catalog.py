@@ -0,0 +1,161 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.module_loading import import_string
+from rest_framework import serializers
+
+
+class _Snapshot:
+    def __init__(self, version, rows, body, etag):
+        self.version = version
+        self.rows = rows
+        self.body = body
+        self.etag = etag
+
+
+class Catalog:
+    """
+    every row of a small, rarely changing table, serialized once and kept in process.
+    the whole table is reloaded when invalidate() changes its version, and also when an id is missing,
+    as rows may have been added by another process. with settings.CATALOG_CACHE naming a CACHES alias
+    the version and the rows are shared through that cache, so invalidation reaches every process
+    within settings.CATALOG_CHECK_INTERVAL seconds.
+
+    model may be given as an 'app_label.Model' label and serializer_class as a dotted path, both are resolved
+    on the first load, so that models and serializers can import the catalogs at the top
+    """
+
+    def __init__(self, name, model, serializer_class):
+        self.name = name
+        self.model = model
+        self.serializer_class = serializer_class
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.local_version = 0
+        self.checked_at = 0.0
+
+        # any saved or deleted row, whether from a view, the admin or a script, once its transaction commits.
+        # bulk writes send no signals, whoever makes them calls invalidate()
+        post_save.connect(self._invalidate, sender=model, weak=False, dispatch_uid=f'catalog_{name}_save')
+        post_delete.connect(self._invalidate, sender=model, weak=False, dispatch_uid=f'catalog_{name}_delete')
+
+    def __deepcopy__(self, memo):
+        # serializers deep copy their fields, every copy has to read the same catalog
+        return self
+
+    @staticmethod
+    def _shared():
+        return caches[settings.CATALOG_CACHE] if settings.CATALOG_CACHE else None
+
+    def _version(self, shared):
+        if shared is None:
+            return self.local_version
+
+        snapshot = self.snapshot
+        if snapshot is not None and time.monotonic() - self.checked_at < settings.CATALOG_CHECK_INTERVAL:
+            return snapshot.version
+
+        key = f"catalog:{self.name}:version"
+        version = shared.get(key)
+        if version is None:
+            shared.add(key, uuid.uuid4().hex, None)
+            version = shared.get(key)
+        self.checked_at = time.monotonic()
+        return version
+
+    def _current(self, reload=False):
+        shared = self._shared()
+        version = self._version(shared)
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.version == version and not reload:
+            return snapshot
+
+        with self.lock:
+            if self.snapshot is not None and self.snapshot is not snapshot:
+                # loaded by another thread meanwhile
+                return self.snapshot
+
+            data = None
+            if shared is not None and not reload:
+                data = shared.get(f"catalog:{self.name}:{version}")
+            if data is None:
+                model = apps.get_model(self.model) if isinstance(self.model, str) else self.model
+                serializer_class = (import_string(self.serializer_class) if isinstance(self.serializer_class, str)
+                                    else self.serializer_class)
+                data = [dict(row) for row in serializer_class(model.objects.order_by('id'), many=True).data]
+                if shared is not None:
+                    shared.set(f"catalog:{self.name}:{version}", data, None)
+
+            body = json.dumps({self.name: data}, cls=DjangoJSONEncoder, ensure_ascii=False).encode()
+            self.snapshot = _Snapshot(version, {row['id']: row for row in data}, body,
+                                      f'"{hashlib.md5(body).hexdigest()}"')
+            return self.snapshot
+
+    def get(self, pk):
+        """
+        the serialized row with this id, None if there is none
+        """
+        if pk is None:
+            return None
+        row = self._current().rows.get(pk, None)
+        if row is None:
+            row = self._current(reload=True).rows.get(pk, None)
+        return dict(row) if row is not None else None
+
+    def response(self, request):
+        """
+        the whole table as {name: [...]}, or 304 Not Modified when the client's If-None-Match still holds
+        """
+        snapshot = self._current()
+        response = get_conditional_response(request, etag=snapshot.etag)
+        if response is None:
+            response = HttpResponse(snapshot.body, content_type='application/json')
+        response['ETag'] = snapshot.etag
+        return response
+
+    def _invalidate(self, using, **kwargs):
+        # readers reloading before the commit would cache the old rows under the new version
+        transaction.on_commit(self.invalidate, using=using)
+
+    def invalidate(self):
+        with self.lock:
+            self.local_version += 1
+            self.snapshot = None
+        shared = self._shared()
+        if shared is not None:
+            shared.set(f"catalog:{self.name}:version", uuid.uuid4().hex, None)
+
+
+class CatalogField(serializers.Field):
+    """
+    a nested station or carriage read from its catalog by the foreign key, source being the *_id attribute,
+    so neither a join nor a query is needed. fields narrows the output like a smaller serializer would
+    """
+
+    def __init__(self, catalog, fields=None, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+        self.catalog = catalog
+        self.only = fields
+
+    def to_representation(self, pk):
+        row = self.catalog.get(pk)
+        if row is not None and self.only is not None:
+            row = {name: row[name] for name in self.only}
+        return row
+
+
+# every station and carriage serialized once, named rather than imported since the models use them as well
+station_catalog = Catalog('stations', 'schedules.Station', 'schedules.serializers.StationSerializer')
+carriage_catalog = Catalog('carriages', 'schedules.Carriage', 'schedules.serializers.CarriageSerializer')
@@ -0,0 +1,61 @@
+from schedules.catalog import carriage_catalog
+from schedules.models import ScheduleToCarriage, ScheduleToStation, fare_at_rate, fare_for_distance
+
+
+def span_distances(schedule_ids, ori_station_id, dst_station_id):
+    """
+    the km between two stations on each of the given schedules, read from the cumulative distances of the two stops
+    in one query. returns {schedule_id: distance}, schedules that don't pass ori before dst are left out
+    """
+    stops = {}
+    for schedule_id, station_id, order, km in ScheduleToStation.objects.filter(
+            schedule_id__in=schedule_ids, station_id__in=[ori_station_id, dst_station_id],
+    ).values_list('schedule_id', 'station_id', 'order', 'cumulative_distance'):
+        stops.setdefault(schedule_id, {})[station_id] = (order, km)
+
+    return {
+        schedule_id: pair[dst_station_id][1] - pair[ori_station_id][1]
+        for schedule_id, pair in stops.items()
+        if ori_station_id in pair and dst_station_id in pair and pair[ori_station_id][0] < pair[dst_station_id][0]
+    }
+
+
+def batch_fares(items):
+    """
+    prices of many (distance, increase_rate) pairs, as ScheduleToCarriage.fare would give them.
+    a bulk quote repeats few distinct pairs, each is priced once
+    """
+    prices = {}
+    result = []
+    for distance, increase_rate in items:
+        key = (distance, increase_rate)
+        if key not in prices:
+            prices[key] = fare_at_rate(fare_for_distance(distance), increase_rate)
+        result.append(prices[key])
+    return result
+
+
+def quote_fares(schedule_ids, ori_station_id, dst_station_id):
+    """
+    the price and rest seats of every carriage of the given schedules between two stations, in two queries
+    whatever the number of schedules. returns {schedule_id: [{'carriage', 'price', 'rest_seats'}, ...]},
+    schedules that don't serve the route are left out
+    """
+    distances = span_distances(schedule_ids, ori_station_id, dst_station_id)
+
+    quotes = {schedule_id: [] for schedule_id in distances}
+    schedule2carriages = list(ScheduleToCarriage.objects.filter(schedule_id__in=distances).order_by('id'))
+    carriages = [carriage_catalog.get(schedule2carriage.carriage_id) for schedule2carriage in schedule2carriages]
+    prices = batch_fares(
+        (distances[schedule2carriage.schedule_id], carriage['increase_rate'])
+        for schedule2carriage, carriage in zip(schedule2carriages, carriages)
+    )
+
+    for schedule2carriage, carriage, price in zip(schedule2carriages, carriages, prices):
+        max_seat, now_seat = schedule2carriage.get_seat_info()
+        quotes[schedule2carriage.schedule_id].append({
+            'carriage': carriage,
+            'price': price,
+            'rest_seats': max_seat - now_seat,
+        })
+    return quotes
@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count, Min, Sum
+
+from schedules.models import ScheduleRoute, ScheduleToCarriage, ScheduleToStation
+
+
+class Command(BaseCommand):
+    help = ("clear the rows that would break the unique constraints of schedules before migrate adds them. "
+            "repeated carriages are merged and repeated stops or routes dropped, stop lists that visit "
+            "a station twice or put two stations at one order are reported and fail the command")
+
+    def handle(self, *args, **options):
+        # only the columns stored before the constraints are read, the tables may not have the others yet
+        tables = set(connection.introspection.table_names())
+
+        merged = dropped_stops = dropped_routes = 0
+        conflicts = []
+        with transaction.atomic():
+            if ScheduleToCarriage._meta.db_table in tables:
+                merged = self.merge_carriages()
+            if ScheduleToStation._meta.db_table in tables:
+                dropped_stops = self.drop_repeated(ScheduleToStation, ['schedule_id', 'station_id', 'order'])
+                conflicts = self.stop_conflicts()
+            if ScheduleRoute._meta.db_table in tables:
+                dropped_routes = self.drop_repeated(ScheduleRoute, ['schedule_id', 'ori_station_id', 'dst_station_id'])
+
+        self.stdout.write(f"merged {merged} repeated carriages, dropped {dropped_stops} repeated stops "
+                          f"and {dropped_routes} repeated routes")
+
+        for schedule_id, stops in conflicts:
+            self.stderr.write(f"schedule {schedule_id}: " + ', '.join(
+                f"station {station_id} at order {order}" for station_id, order in stops))
+        if conflicts:
+            raise CommandError(f"{len(conflicts)} schedules visit a station twice or put two stations at one order, "
+                               f"fix their stops before migrating")
+
+    @staticmethod
+    def groups(model, fields, **aggregates):
+        return (
+            model.objects.order_by().values(*fields)
+            .annotate(copies=Count('id'), keep=Min('id'), **aggregates).filter(copies__gt=1)
+        )
+
+    def merge_carriages(self):
+        """
+        a carriage listed twice on a schedule becomes one row carrying the total number of carriages
+        """
+        merged = 0
+        for group in self.groups(ScheduleToCarriage, ['schedule_id', 'carriage_id'], total=Sum('num')):
+            ScheduleToCarriage.objects.filter(id=group['keep']).update(num=group['total'])
+            merged += self.delete(ScheduleToCarriage, group, ['schedule_id', 'carriage_id'])
+        return merged
+
+    def drop_repeated(self, model, fields):
+        """
+        rows equal on every field are copies, all but the first are dropped
+        """
+        return sum(self.delete(model, group, fields) for group in self.groups(model, fields))
+
+    def stop_conflicts(self):
+        """
+        schedules with stops that can't be merged, with their stop list as (station_id, order)
+        """
+        schedule_ids = {
+            group['schedule_id']
+            for fields in (['schedule_id', 'station_id'], ['schedule_id', 'order'])
+            for group in self.groups(ScheduleToStation, fields)
+        }
+
+        conflicts = {schedule_id: [] for schedule_id in sorted(schedule_ids)}
+        for schedule_id, station_id, order in ScheduleToStation.objects.filter(
+                schedule_id__in=schedule_ids).order_by('schedule_id', 'order', 'id').values_list(
+                'schedule_id', 'station_id', 'order'):
+            conflicts[schedule_id].append((station_id, order))
+        return list(conflicts.items())
+
+    @staticmethod
+    def delete(model, group, fields):
+        # raw delete, the collector of QuerySet.delete would look for related rows in tables migrate hasn't made yet
+        ids = list(
+            model.objects.filter(**{field: group[field] for field in fields}).exclude(id=group['keep'])
+            .values_list('id', flat=True)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {connection.ops.quote_name(model._meta.db_table)} "
+                f"WHERE id IN ({', '.join(['%s'] * len(ids))})",
+                ids,
+            )
+        return len(ids)
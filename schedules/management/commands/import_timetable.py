@@ -0,0 +1,34 @@
+import csv
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from schedules.timetable import import_timetable, read_timetable, TIMETABLE_FORMATS
+
+
+class Command(BaseCommand):
+    help = "create schedules in bulk from a csv, json or jsonl timetable, '-' reads stdin"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=TIMETABLE_FORMATS, default=None)
+        parser.add_argument('--chunk-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or path.rsplit('.', 1)[-1].lower()
+        if fmt not in TIMETABLE_FORMATS:
+            raise CommandError(f"can't tell the format of {path}, pass --format")
+
+        stream = sys.stdin if path == '-' else open(path, encoding='utf-8-sig', newline='')
+        try:
+            created, errors = import_timetable(read_timetable(stream, fmt), chunk_size=options['chunk_size'])
+        except (ValueError, csv.Error) as e:
+            raise CommandError(f"can't parse {path}: {e}")
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        for error in errors:
+            self.stderr.write(f"row {error['row']}: {error['message']}")
+        self.stdout.write(f"created {created} schedules, skipped {len(errors)} rows")
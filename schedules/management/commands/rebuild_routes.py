@@ -0,0 +1,87 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Q
+
+from schedules.models import Schedule, ScheduleRoute, ScheduleToStation
+
+
+class Command(BaseCommand):
+    help = ("regenerate the ScheduleRoute pairs of schedules whose routes don't match their stop list, "
+            "such as schedules stored before the route index existed. stops stored before their distances "
+            "get settings.AVG_KM_BETWEEN_STATION between every two stops, the distance their prices were "
+            "computed from, and the routes of their schedules are rebuilt. --all rebuilds every schedule")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--all', action='store_true', help="rebuild every schedule, not only the stale ones")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+
+        checked = filled = rebuilt = 0
+        last_id = 0
+        while True:
+            chunk = list(
+                Schedule.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+            if not chunk:
+                break
+            last_id = chunk[-1]
+            checked += len(chunk)
+
+            with transaction.atomic():
+                undistanced = self.fill_distances(chunk)
+                stale = chunk if options['all'] else sorted(set(self.stale(chunk)) | set(undistanced))
+                for schedule in Schedule.objects.filter(id__in=stale):
+                    schedule.rebuild_routes()
+            filled += len(undistanced)
+            rebuilt += len(stale)
+
+        self.stdout.write(f"checked {checked} schedules, filled the stop distances of {filled}, "
+                          f"rebuilt the routes of {rebuilt}")
+
+    @staticmethod
+    def fill_distances(schedule_ids):
+        """
+        give the stops of the chunk's schedules stored before stop distances existed, whose later stops
+        are all at cumulative distance 0, settings.AVG_KM_BETWEEN_STATION between every two stops
+        """
+        undistanced = list(
+            ScheduleToStation.objects.filter(schedule_id__in=schedule_ids, order__gt=0).order_by()
+            .values('schedule_id').annotate(num=Count('id'), zeros=Count('id', filter=Q(cumulative_distance=0)))
+            .filter(zeros=F('num'))
+            .values_list('schedule_id', flat=True)
+        )
+        ScheduleToStation.objects.filter(schedule_id__in=undistanced, order__gt=0).update(
+            distance=settings.AVG_KM_BETWEEN_STATION,
+            cumulative_distance=ExpressionWrapper(
+                F('order') * settings.AVG_KM_BETWEEN_STATION, output_field=DecimalField()),
+        )
+        return undistanced
+
+    @staticmethod
+    def stale(schedule_ids):
+        """
+        schedules of the chunk whose number of routes isn't that of every pair of their stops,
+        or with routes stored before their base fare
+        """
+        def counts(model):
+            return dict(
+                model.objects.filter(schedule_id__in=schedule_ids).order_by()
+                .values('schedule_id').annotate(num=Count('id')).values_list('schedule_id', 'num')
+            )
+
+        stop_nums = counts(ScheduleToStation)
+        route_nums = counts(ScheduleRoute)
+
+        unpriced = set(
+            ScheduleRoute.objects.filter(schedule_id__in=schedule_ids, base_fare=0)
+            .values_list('schedule_id', flat=True)
+        )
+
+        stale = []
+        for schedule_id in schedule_ids:
+            stop_num = stop_nums.get(schedule_id, 0)
+            if route_nums.get(schedule_id, 0) != stop_num * (stop_num - 1) // 2 or schedule_id in unpriced:
+                stale.append(schedule_id)
+        return stale
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from schedules.models import ScheduleToCarriage
+
+
+class Command(BaseCommand):
+    help = "recompute seat occupancy and the capacity/sold counters of ScheduleToCarriage from the Ticket table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--missing', action='store_true',
+                            help="only rows that have no capacity yet, such as compositions stored before the counters")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        schedule2carriages = ScheduleToCarriage.objects.select_related('carriage').order_by('id')
+        if options['missing']:
+            schedule2carriages = schedule2carriages.filter(capacity=0)
+
+        checked = fixed = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                chunk = list(schedule2carriages.filter(id__gt=last_id).select_for_update()[:chunk_size])
+                if not chunk:
+                    break
+
+                before = [(schedule2carriage.capacity, schedule2carriage.sold) for schedule2carriage in chunk]
+                ScheduleToCarriage.rebuild_seats(chunk)
+                after = [(schedule2carriage.capacity, schedule2carriage.sold) for schedule2carriage in chunk]
+
+            checked += len(chunk)
+            fixed += sum(old != new for old, new in zip(before, after))
+            last_id = chunk[-1].id
+
+        self.stdout.write(f"checked {checked} schedule/carriage rows, fixed counters of {fixed}")
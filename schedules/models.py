@@ -1,12 +1,48 @@
-from collections import Counter
+from collections import Counter, defaultdict
 from datetime import datetime
 import decimal
 
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction, IntegrityError
 from django.conf import settings
 
+from schedules.catalog import carriage_catalog
+
+# seat occupancy keeps one bit per leg in a signed 64-bit integer
+MAX_STATION_NUM = 64
+
+# the largest km ScheduleToStation.distance and cumulative_distance can hold
+MAX_SEGMENT_KM = decimal.Decimal('999999.99')
+MAX_CUMULATIVE_KM = decimal.Decimal('99999999.99')
+
 
 # Create your models here.
+class ScheduleQuerySet(models.QuerySet):
+    def passing(self, ori_station, dst_station):
+        """
+        keep schedules that stop at ori_station and later at dst_station, see Schedule.is_option_schedule.
+        stations may be given as instances or ids, and the filter stays a join so it composes into one statement
+        """
+        if ori_station and dst_station:
+            return self.filter(routes__ori_station=ori_station, routes__dst_station=dst_station)
+        elif ori_station or dst_station:
+            return self.filter(stations=ori_station or dst_station)
+        else:
+            return self
+
+    def with_details(self, stations=True, carriages=True):
+        """
+        load stops and carriages of every schedule in one extra query each, as ScheduleSerializer reads them
+        """
+        lookups = []
+        if stations:
+            lookups.append('scheduletostation_set')
+        if carriages:
+            lookups.append('scheduletocarriage_set')
+        # the stations and carriages themselves come from their catalogs
+        return self.prefetch_related(*lookups)
+
+
 class Schedule(models.Model):
     schedule_no = models.CharField(max_length=32, unique=True)
     departure_time = models.DateTimeField()
@@ -14,30 +50,93 @@ class Schedule(models.Model):
     stations = models.ManyToManyField(to="Station", through="ScheduleToStation")
     carriages = models.ManyToManyField(to="Carriage", through="ScheduleToCarriage")
 
-    def add_stations(self, station_ids, arrival_times):
-        for i in range(len(station_ids)):
-            station_id = station_ids[i]
-            arrival_time = datetime.fromisoformat(arrival_times[i])
+    objects = ScheduleQuerySet.as_manager()
+
+    class Meta:
+        # search filters and pages by departure time, see ScheduleView.get
+        indexes = [models.Index(fields=['departure_time', 'id'])]
+
+    def add_stations(self, station_ids, arrival_times, distances=None):
+        """
+        write the stop list of an empty schedule in a constant number of statements. distances are the km
+        between consecutive stops, settings.AVG_KM_BETWEEN_STATION each if not given.
+        raises ValidationError if a station does not exist or an arrival time or distance can't be parsed
+        """
+        try:
+            station_ids = [int(station_id) for station_id in station_ids]
+            arrival_times = [datetime.fromisoformat(arrival_time) for arrival_time in arrival_times]
+        except (TypeError, ValueError) as e:
+            raise ValidationError(f"站点或到达时间格式错误，{e}")
+
+        try:
+            distances = segment_distances(distances, len(station_ids))
+        except (TypeError, ValueError, ArithmeticError) as e:
+            raise ValidationError(f"站点距离格式错误，{e}")
+        cumulative = cumulative_distances(distances)
+
+        if len(set(station_ids)) != len(station_ids):
+            raise ValidationError("行程不能重复经过同一站点")
 
-            schedule2station = ScheduleToStation(
-                schedule=self,
-                station_id=station_id,
-                order=i,
-                arrival_time=arrival_time,
+        missing = set(station_ids) - set(Station.objects.filter(id__in=station_ids).values_list('id', flat=True))
+        if missing:
+            raise ValidationError(f"站点 {sorted(missing)} 不存在")
+
+        with transaction.atomic():
+            ScheduleToStation.objects.bulk_create(
+                ScheduleToStation(
+                    schedule=self,
+                    station_id=station_id,
+                    order=i,
+                    arrival_time=arrival_time,
+                    distance=cumulative[i] - cumulative[i - 1] if i else 0,
+                    cumulative_distance=cumulative[i],
+                )
+                for i, (station_id, arrival_time) in enumerate(zip(station_ids, arrival_times))
             )
-            schedule2station.save()
+
+            self.rebuild_routes()
+            self.rebuild_seats()
+
+    def rebuild_routes(self):
+        """
+        regenerate the (ori_station, dst_station) pairs of this schedule from its current stop list
+        """
+        stops = list(self.scheduletostation_set.values_list('station_id', 'cumulative_distance'))
+
+        self.routes.all().delete()
+        ScheduleRoute.objects.bulk_create(ScheduleRoute.for_stops(
+            self, [station_id for station_id, _ in stops], [km for _, km in stops]))
 
     def add_carriages(self, carriage_ids):
-        carriage_count = Counter(carriage_ids)
-        for carriage_id in carriage_count:
-            num = carriage_count[carriage_id]
-
-            schedule2carriage = ScheduleToCarriage(
-                schedule=self,
-                carriage_id=carriage_id,
-                num=num,
+        """
+        write the carriage composition of a schedule in a constant number of statements,
+        raises ValidationError if a carriage does not exist
+        """
+        try:
+            carriage_count = Counter(int(carriage_id) for carriage_id in carriage_ids)
+        except (TypeError, ValueError) as e:
+            raise ValidationError(f"车厢格式错误，{e}")
+
+        missing = set(carriage_count) - set(Carriage.objects.filter(id__in=carriage_count).values_list('id', flat=True))
+        if missing:
+            raise ValidationError(f"车厢 {sorted(missing)} 不存在")
+
+        with transaction.atomic():
+            ScheduleToCarriage.objects.bulk_create(
+                ScheduleToCarriage(schedule=self, carriage_id=carriage_id, num=num)
+                for carriage_id, num in carriage_count.items()
             )
-            schedule2carriage.save()
+
+            self.rebuild_seats()
+
+    def rebuild_seats(self):
+        """
+        recompute the seat inventory of this schedule from its tickets, after its stops or carriages are rewritten
+        """
+        ScheduleToCarriage.rebuild_seats(self.scheduletocarriage_set.select_related('carriage'))
+
+    def get_route(self, ori_station, dst_station):
+        return self.routes.filter(ori_station=ori_station, dst_station=dst_station).first()
 
     def is_option_schedule(self, ori_station, dst_station):
         if not ori_station and not dst_station:
@@ -47,13 +146,7 @@ class Schedule(models.Model):
         elif not ori_station and dst_station:
             return self.stations.filter(id=dst_station.id).exists()
         else:
-            self_ori = self.scheduletostation_set.filter(station=ori_station).first()
-            self_dst = self.scheduletostation_set.filter(station=dst_station).first()
-
-            if not self_ori or not self_dst:
-                return False
-            
-            return self_ori.order < self_dst.order
+            return self.routes.filter(ori_station=ori_station, dst_station=dst_station).exists()
 
 
 class Station(models.Model):
@@ -66,9 +159,115 @@ class ScheduleToStation(models.Model):
     station = models.ForeignKey(to="Station", on_delete=models.CASCADE)
     order = models.IntegerField()
     arrival_time = models.DateTimeField()
+    # km from the previous stop, 0 for the first, and km from the first stop, so the distance
+    # between any two stops of the schedule is the difference of their cumulative distances
+    distance = models.DecimalField(max_digits=8, decimal_places=2, default=0)
+    cumulative_distance = models.DecimalField(max_digits=10, decimal_places=2, default=0)
 
     class Meta:
         ordering = ['order']
+        constraints = [
+            models.UniqueConstraint(fields=['schedule', 'order'], name='unique_stop_order'),
+            models.UniqueConstraint(fields=['schedule', 'station'], name='unique_stop_station'),
+        ]
+        # schedules stopping at one station, see ScheduleQuerySet.passing
+        indexes = [models.Index(fields=['station', 'schedule'])]
+
+
+class ScheduleRoute(models.Model):
+    """
+    every ordered station pair a schedule serves, kept in sync with ScheduleToStation by Schedule.rebuild_routes
+    """
+    schedule = models.ForeignKey(to="Schedule", on_delete=models.CASCADE, related_name='routes')
+    ori_station = models.ForeignKey(to="Station", on_delete=models.CASCADE, related_name='+')
+    dst_station = models.ForeignKey(to="Station", on_delete=models.CASCADE, related_name='+')
+    ori_order = models.IntegerField()
+    dst_order = models.IntegerField()
+    # the fare of this route in a carriage with increase_rate 1, written with the route, see ScheduleToCarriage.fare
+    base_fare = models.DecimalField(max_digits=16, decimal_places=6, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ori_station', 'dst_station', 'schedule'], name='unique_route'),
+        ]
+
+    @classmethod
+    def for_stops(cls, schedule, station_ids, cumulative=None):
+        """
+        unsaved routes for a stop list given in travel order and the cumulative distances of its stops,
+        settings.AVG_KM_BETWEEN_STATION between every two stops if not given
+        """
+        if cumulative is None:
+            cumulative = cumulative_distances(segment_distances(None, len(station_ids)))
+
+        for i, ori_id in enumerate(station_ids):
+            for j in range(i + 1, len(station_ids)):
+                yield cls(
+                    schedule=schedule,
+                    ori_station_id=ori_id,
+                    dst_station_id=station_ids[j],
+                    ori_order=i,
+                    dst_order=j,
+                    base_fare=fare_for_distance(cumulative[j] - cumulative[i]),
+                )
+
+    @property
+    def legs(self):
+        return leg_mask(self.ori_order, self.dst_order)
+
+
+def segment_distances(distances, stop_num):
+    """
+    the km between each two consecutive of stop_num stops as decimals, checked to be one per segment and positive.
+    settings.AVG_KM_BETWEEN_STATION for every segment if distances is None
+    """
+    if distances is None:
+        return [settings.AVG_KM_BETWEEN_STATION] * max(stop_num - 1, 0)
+
+    if not isinstance(distances, list) or len(distances) != stop_num - 1:
+        raise ValueError("相邻两站之间各需一个距离")
+
+    distances = [decimal.Decimal(str(distance)).quantize(decimal.Decimal('0.01')) for distance in distances]
+    if not all(distance.is_finite() and distance > 0 for distance in distances):
+        raise ValueError("距离必须大于 0")
+    if any(distance > MAX_SEGMENT_KM for distance in distances):
+        raise ValueError(f"相邻两站距离不能超过 {MAX_SEGMENT_KM} 公里")
+    if sum(distances) > MAX_CUMULATIVE_KM:
+        raise ValueError(f"行程总距离不能超过 {MAX_CUMULATIVE_KM} 公里")
+    return distances
+
+
+def cumulative_distances(distances):
+    """
+    prefix sums of the segment distances: the km from the first stop to every stop, starting with 0
+    """
+    cumulative = [decimal.Decimal(0)]
+    for distance in distances:
+        cumulative.append(cumulative[-1] + distance)
+    return cumulative
+
+
+def fare_for_distance(distance):
+    """
+    the fare of travelling distance km in a carriage with increase_rate 1
+    """
+    return (decimal.Decimal(distance) * settings.ADDITION_COST_PER_KM).quantize(decimal.Decimal('0.000001'))
+
+
+def fare_at_rate(base_fare, increase_rate):
+    """
+    the ticket price of a route's base fare in a carriage with this increase rate
+    """
+    # base fares are stored to 6 places, round half up like the unrounded product used to
+    return (decimal.Decimal(increase_rate) * base_fare).quantize(
+        decimal.Decimal('0.00'), rounding=decimal.ROUND_HALF_UP)
+
+
+def leg_mask(ori_order, dst_order):
+    """
+    bit i stands for the leg between the stops of order i and i + 1
+    """
+    return (1 << dst_order) - (1 << ori_order)
 
 
 class Carriage(models.Model):
@@ -81,27 +280,161 @@ class ScheduleToCarriage(models.Model):
     schedule = models.ForeignKey(to="Schedule", on_delete=models.CASCADE)
     carriage = models.ForeignKey(to="Carriage", on_delete=models.CASCADE)
     num = models.IntegerField()
+    sold = models.IntegerField(default=0)
+    capacity = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['schedule', 'carriage'], name='unique_schedule_carriage'),
+        ]
+
+    def calc_cost(self, ori_station, dst_station, route=None):
+        """
+        the price of a ticket from ori_station to dst_station, None if the schedule doesn't serve that route.
+        pass the route when it is already loaded, its fare was precomputed and the price needs no query,
+        otherwise the distance is the difference of the cumulative distances of the two stops
+        """
+        if route is not None:
+            return self.fare(route.base_fare)
 
-    def calc_cost(self, ori_station, dst_station):
-        self_ori = self.schedule.scheduletostation_set.filter(station=ori_station).first()
-        self_dst = self.schedule.scheduletostation_set.filter(station=dst_station).first()
+        ori_id = getattr(ori_station, 'id', ori_station)
+        dst_id = getattr(dst_station, 'id', dst_station)
+        stops = {
+            station_id: (order, km) for station_id, order, km in ScheduleToStation.objects.filter(
+                schedule_id=self.schedule_id, station_id__in=[ori_id, dst_id],
+            ).values_list('station_id', 'order', 'cumulative_distance')
+        }
 
-        if not self_ori or not self_dst:
+        if ori_id not in stops or dst_id not in stops or stops[ori_id][0] >= stops[dst_id][0]:
             return None
 
-        station_num = self_dst.order - self_ori.order
-        carriage_increase_rate = self.carriage.increase_rate
+        return self.fare(fare_for_distance(stops[dst_id][1] - stops[ori_id][1]))
+
+    def fare(self, base_fare):
+        """
+        base_fare of a route times the increase rate of this carriage, read from the carriage catalog
+        """
+        return fare_at_rate(base_fare, carriage_catalog.get(self.carriage_id)['increase_rate'])
+
+    @staticmethod
+    def rebuild_seats(schedule2carriages):
+        """
+        recompute capacity, sold and the seat occupancy of many schedule/carriage pairs
+        from the Carriage, ScheduleToStation and Ticket tables. carriages must be loaded with select_related
+        """
+        from tickets.models import Ticket
+
+        schedule2carriages = list(schedule2carriages)
+        if not schedule2carriages:
+            return
+
+        schedule_ids = {schedule2carriage.schedule_id for schedule2carriage in schedule2carriages}
+        orders = {
+            (schedule_id, station_id): order for schedule_id, station_id, order in
+            ScheduleToStation.objects.filter(schedule_id__in=schedule_ids).values_list('schedule_id', 'station_id', 'order')
+        }
+
+        occupied = defaultdict(dict)
+        tickets = Ticket.objects.filter(
+            schedule_id__in=schedule_ids,
+            carriage_id__in={schedule2carriage.carriage_id for schedule2carriage in schedule2carriages},
+        ).values_list('schedule_id', 'carriage_id', 'seat_no', 'ori_station_id', 'dst_station_id')
+        for schedule_id, carriage_id, seat_no, ori_station_id, dst_station_id in tickets:
+            ori_order = orders.get((schedule_id, ori_station_id))
+            dst_order = orders.get((schedule_id, dst_station_id))
+            if ori_order is None or dst_order is None or ori_order >= dst_order:
+                continue
+            seats = occupied[(schedule_id, carriage_id)]
+            seats[seat_no] = seats.get(seat_no, 0) | leg_mask(ori_order, dst_order)
+
+        seats = []
+        for schedule2carriage in schedule2carriages:
+            legs = occupied[(schedule2carriage.schedule_id, schedule2carriage.carriage_id)]
+            schedule2carriage.capacity = schedule2carriage.num * schedule2carriage.carriage.seat_num
+            schedule2carriage.sold = len(legs)
+            # seat numbers stay dense so that the next new seat is always seats.count()
+            seats.extend(
+                SeatOccupancy(schedule2carriage=schedule2carriage, seat_no=seat_no, legs=legs.get(seat_no, 0))
+                for seat_no in range(max(legs, default=-1) + 1)
+            )
+
+        with transaction.atomic():
+            SeatOccupancy.objects.filter(schedule2carriage__in=schedule2carriages).delete()
+            SeatOccupancy.objects.bulk_create(seats)
+            ScheduleToCarriage.objects.bulk_update(schedule2carriages, ['capacity', 'sold'])
 
-        return (decimal.Decimal(carriage_increase_rate) * (
-            (decimal.Decimal(station_num)) *
-            settings.AVG_KM_BETWEEN_STATION *
-            settings.ADDITION_COST_PER_KM
-        )).quantize(decimal.Decimal('0.00'))
-    
     def get_seat_info(self):
-        schedule2carriage = ScheduleToCarriage.objects.get(schedule=self.schedule, carriage=self.carriage)
-        max_seat = schedule2carriage.num * schedule2carriage.carriage.seat_num
-        now_seat = self.schedule.tickets.filter(carriage=self.carriage).count()
+        """
+        returns (max_seat, now_seat), now_seat counts the seats sold on at least one leg
+        """
+        return self.capacity, self.sold
+
+    def take_seat(self, legs):
+        """
+        book the legs on the lowest numbered seat that is free on all of them, so seats freed by
+        free_seat are handed out again first. returns the seat number, or None if no seat is free on the whole span.
+
+        buyers of the same carriage are serialized by a row lock on this ScheduleToCarriage,
+        the compare-and-set updates below keep seats exclusive on databases without row locks
+        """
+        with transaction.atomic():
+            capacity = ScheduleToCarriage.objects.select_for_update().filter(
+                pk=self.pk,
+            ).values_list('capacity', flat=True).get()
+
+            while True:
+                seat = self.seats.alias(
+                    busy=models.F('legs').bitand(legs),
+                ).filter(busy=0).order_by('seat_no').first()
+
+                if seat:
+                    # only succeeds if nobody booked the seat since it was read
+                    if not SeatOccupancy.objects.filter(pk=seat.pk, legs=seat.legs).update(legs=seat.legs | legs):
+                        continue
+                    if not seat.legs:
+                        ScheduleToCarriage.objects.filter(pk=self.pk).update(sold=models.F('sold') + 1)
+                    return seat.seat_no
 
-        return max_seat, now_seat
+                seat_no = self.seats.count()
+                if seat_no >= capacity:
+                    return None
 
+                try:
+                    with transaction.atomic():
+                        SeatOccupancy.objects.create(schedule2carriage=self, seat_no=seat_no, legs=legs)
+                except IntegrityError:
+                    continue
+                ScheduleToCarriage.objects.filter(pk=self.pk).update(sold=models.F('sold') + 1)
+                return seat_no
+
+    @staticmethod
+    def free_seat(schedule_id, carriage_id, seat_no, legs):
+        with transaction.atomic():
+            seat = SeatOccupancy.objects.select_for_update().filter(
+                schedule2carriage__schedule_id=schedule_id,
+                schedule2carriage__carriage_id=carriage_id,
+                seat_no=seat_no,
+            ).first()
+
+            if not seat or not seat.legs & legs:
+                return
+
+            seat.legs &= ~legs
+            seat.save(update_fields=['legs'])
+
+            if not seat.legs:
+                ScheduleToCarriage.objects.filter(pk=seat.schedule2carriage_id).update(sold=models.F('sold') - 1)
+
+
+class SeatOccupancy(models.Model):
+    """
+    the legs one seat is sold on, as a bitmask built by leg_mask
+    """
+    schedule2carriage = models.ForeignKey(to="ScheduleToCarriage", on_delete=models.CASCADE, related_name='seats')
+    seat_no = models.IntegerField()
+    legs = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['schedule2carriage', 'seat_no'], name='unique_seat_no'),
+        ]
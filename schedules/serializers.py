@@ -1,6 +1,7 @@
 from rest_framework import serializers
 
-from schedules.models import Station, Carriage, ScheduleToCarriage, Schedule, ScheduleToStation
+from schedules.catalog import CatalogField, carriage_catalog, station_catalog
+from schedules.models import Station, Carriage, ScheduleToCarriage, Schedule, ScheduleToStation, fare_for_distance
 
 
 class StationSerializer(serializers.ModelSerializer):
@@ -16,25 +17,31 @@ class CarriageSerializer(serializers.ModelSerializer):
 
 
 class ScheduleToCarriageSerializer(serializers.ModelSerializer):
-    carriage = CarriageSerializer()
+    carriage = CatalogField(carriage_catalog, source='carriage_id')
     rest_seats = serializers.SerializerMethodField()
+    price = serializers.SerializerMethodField()
 
     class Meta:
         model = ScheduleToCarriage
-        fields = ['carriage', 'num', 'rest_seats']
+        fields = ['carriage', 'num', 'rest_seats', 'price']
 
     def get_rest_seats(self, obj):
         max_seat, now_seat = obj.get_seat_info()
         return max_seat - now_seat
 
+    def get_price(self, obj):
+        # the km of the searched span, given by ScheduleSerializer
+        distance = self.context.get('distance', None)
+        return obj.fare(fare_for_distance(distance)) if distance is not None else None
+
 
 class ScheduleToStationSerializer(serializers.ModelSerializer):
-    station = StationSerializer()
+    station = CatalogField(station_catalog, source='station_id')
     arrival_time = serializers.DateTimeField()
 
     class Meta:
         model = ScheduleToStation
-        fields = ['station', 'order', 'arrival_time']
+        fields = ['station', 'order', 'arrival_time', 'distance', 'cumulative_distance']
 
 
 class ScheduleSerializer(serializers.ModelSerializer):
@@ -46,10 +53,35 @@ class ScheduleSerializer(serializers.ModelSerializer):
         model = Schedule
         fields = ['id', 'schedule_no', 'departure_time', 'stations', 'carriages']
 
+    def __init__(self, *args, fields=None, **kwargs):
+        """
+        fields keeps only the named fields in the output, a 'span' of (ori_station_id, dst_station_id)
+        in the context prices the carriages for that span
+        """
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
     def get_carriages(self, obj):
-        carriages = ScheduleToCarriage.objects.filter(schedule=obj)
-        return ScheduleToCarriageSerializer(carriages, many=True).data
+        # served from Schedule.objects.with_details() when the caller prefetched
+        return ScheduleToCarriageSerializer(
+            obj.scheduletocarriage_set.all(), many=True, context={'distance': self.span_distance(obj)}).data
+
+    def span_distance(self, obj):
+        """
+        km between the stations of the span from the prefetched stops, None without a span the schedule serves
+        """
+        span = self.context.get('span', None)
+        if not span:
+            return None
+
+        stops = {stop.station_id: stop for stop in obj.scheduletostation_set.all()}
+        ori, dst = stops.get(span[0], None), stops.get(span[1], None)
+        if not ori or not dst or ori.order >= dst.order:
+            return None
+        return dst.cumulative_distance - ori.cumulative_distance
 
     def get_stations(self, obj):
-        stations = ScheduleToStation.objects.filter(schedule=obj)
-        return ScheduleToStationSerializer(stations, many=True).data
+        return ScheduleToStationSerializer(obj.scheduletostation_set.all(), many=True).data
+
@@ -1,189 +1,196 @@
-from audioop import reverse
+import decimal
 import json
-import unittest
 from unittest.mock import patch
-from django.test import RequestFactory
-from schedules.models import Carriage, Station
-from schedules.serializers import StationSerializer
-from views import ScheduleView, ScheduleIdView
+from datetime import datetime, timedelta
+import io
+import tempfile
+import jwt
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command, CommandError
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, TransactionTestCase, override_settings
+from contacts.models import Contact
+from jobs.queue import run_pending
+from schedules.catalog import Catalog, station_catalog, carriage_catalog
+from schedules.models import (
+    Carriage, Schedule, ScheduleRoute, ScheduleToCarriage, ScheduleToStation, Station, MAX_SEGMENT_KM,
+    fare_for_distance, segment_distances,
+)
+from schedules.serializers import CarriageSerializer, StationSerializer
+from schedules.timetable import export_timetable, import_timetable, read_timetable
+from tickets.models import Ticket
+from utils.pagination import encode_cursor
+from utils.perm import get_user_and_roles
 # Create your tests here.
 
-class ScheduleViewTestCase(unittest.TestCase):
+def admin_headers():
+    admin = User.objects.create(username='admin')
+    admin.groups.add(Group.objects.get_or_create(name='Train Admin')[0])
+    return {'HTTP_JWT': jwt.encode(
+        {'id': admin.id, 'expire': (datetime.now() + timedelta(hours=2)).isoformat()},
+        settings.SECRET_KEY,
+    )}
+
+
+class ScheduleViewTestCase(TestCase):
     def setUp(self):
-        self.factory = RequestFactory()
+        self.headers = admin_headers()
+        self.stations = [Station.objects.create(station_no=f'S{i}', name=f'站点{i}') for i in range(3)]
+        self.carriages = [Carriage.objects.create(name=f'车厢{i}', seat_num=10) for i in range(2)]
+        station_catalog.invalidate()
+        carriage_catalog.invalidate()
+
+        self.schedule = Schedule.objects.create(schedule_no='G1', departure_time='2023-06-01T08:00:00Z')
+        self.schedule.add_stations(
+            [station.id for station in self.stations],
+            ['2023-06-01T08:00:00+00:00', '2023-06-01T09:00:00+00:00', '2023-06-01T10:00:00+00:00'],
+        )
+        self.schedule.add_carriages([carriage.id for carriage in self.carriages])
+
+    def schedule_data(self, **data):
+        return dict({
+            'schedule_no': 'G9',
+            'station_ids': [station.id for station in self.stations],
+            'carriage_ids': [carriage.id for carriage in self.carriages],
+            'departure_time': '2023-06-06T08:00:00+00:00',
+            'arrival_times': ['2023-06-06T08:00:00+00:00', '2023-06-06T08:30:00+00:00', '2023-06-06T09:00:00+00:00'],
+        }, **data)
 
     def test_get_all_schedules(self):
-        view = ScheduleView.as_view()
-        request = self.factory.get('/schedules/')
-        response = view(request)
+        response = self.client.get('/schedules/')
 
         self.assertEqual(response.status_code, 200)
+        self.assertEqual([schedule['id'] for schedule in response.json()['schedules']], [self.schedule.id])
 
     def test_get_filtered_schedules(self):
-        view = ScheduleView.as_view()
-        request = self.factory.get('/schedules/', {'after': '2023-09-09', 'before': '2023-92-39'})
-        response = view(request)
+        response = self.client.get('/schedules/', {'after': '2023-05-01T00:00:00Z', 'before': '2023-06-30T00:00:00Z'})
+        self.assertEqual(len(response.json()['schedules']), 1)
 
-        self.assertEqual(response.status_code, 200)
+        # 出发时间不在范围内
+        response = self.client.get('/schedules/', {'after': '2023-09-09T00:00:00Z'})
+        self.assertEqual(response.json()['schedules'], [])
 
     def test_get_non_existing_ticket_to_change(self):
-        view = ScheduleView.as_view()
-        request = self.factory.get('/schedules/', {'change': 999})
-        response = view(request)
+        response = self.client.get('/schedules/', {'change': 999})
 
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'result': 1, 'message': "没有找到改签之前的车票"})
 
     def test_add_new_schedule(self):
-        view = ScheduleView.as_view()
-        data = {
-            'schedule_no': 'SCH009',
-            'station_ids': [9, 2, 3],
-            'carriage_ids': [9, 2, 3],
-            'departure_time': '2023-06-06T92:00:00',
-            'arrival_times': ['2023-06-06T92:30:00', '2023-06-06T93:00:00', '2023-06-06T93:30:00'],
-        }
-        request = self.factory.post('/schedules/', data)
-        response = view(request)
-
-        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/schedules/', self.schedule_data(), content_type='application/json',
+                                    **self.headers)
 
+        self.assertEqual(response.json(), {'result': 0, 'message': "设置行程成功"})
+        schedule = Schedule.objects.get(schedule_no='G9')
+        self.assertEqual(list(schedule.scheduletostation_set.values_list('station_id', flat=True)),
+                         [station.id for station in self.stations])
+        self.assertEqual(schedule.scheduletocarriage_set.count(), 2)
 
     def test_missing_required_fields(self):
-        view = ScheduleView.as_view()
-        data = {
-            # 缺少必填字段
-        }
-        request = self.factory.post('/schedules/', data)
-        response = view(request)
-
-        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/schedules/', {}, content_type='application/json', **self.headers)
 
+        self.assertEqual(response.json(),
+                         {'result': 1, 'message': "必须设置行程编号、出发时间、各站点及其到达时间、车厢"})
 
     def test_duplicate_schedule_no(self):
-        view = ScheduleView.as_view()
-        data = {
-            'schedule_no': 'SCH009',  # 已经存在的行程编号
-            # 其他必填字段
-        }
-        request = self.factory.post('/schedules/', data)
-        response = view(request)
+        response = self.client.post('/schedules/', self.schedule_data(schedule_no='G1'),
+                                    content_type='application/json', **self.headers)
 
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'result': 1, 'message': "行程编号已存在"})
+        self.assertEqual(Schedule.objects.count(), 1)
+
+    def test_add_schedule_without_permission(self):
+        response = self.client.post('/schedules/', self.schedule_data(), content_type='application/json')
+
+        self.assertEqual(response.json(), {'result': 1, 'message': "无法解析 JWT"})
+        self.assertFalse(Schedule.objects.filter(schedule_no='G9').exists())
 
-class ScheduleIdViewTestCase(unittest.TestCase):
+
+class ScheduleIdViewTestCase(TestCase):
     def setUp(self):
-        self.factory = RequestFactory()
-        # 创建一个示例视图对象
-        self.view = ScheduleIdView()
+        self.headers = admin_headers()
+        self.stations = [Station.objects.create(station_no=f'S{i}', name=f'站点{i}') for i in range(3)]
+        self.carriages = [Carriage.objects.create(name=f'车厢{i}', seat_num=10) for i in range(2)]
+
+        self.schedule = Schedule.objects.create(schedule_no='G1', departure_time='2023-06-30T08:00:00Z')
+        self.schedule.add_stations(
+            [station.id for station in self.stations[:2]],
+            ['2023-06-30T08:00:00+00:00', '2023-06-30T09:00:00+00:00'],
+        )
+        self.schedule.add_carriages([self.carriages[0].id])
 
     def test_put_modify_schedule(self):
-        # 创建一个 PUT 请求对象
         data = {
-            'station_ids': [1, 2, 3],
-            'carriage_ids': [4, 5, 6],
-            'departure_time': '2023-06-30T09:00:00',
-            'arrival_times': ['2023-06-30T09:10:00', '2023-06-30T09:20:00', '2023-06-30T09:30:00'],
+            'station_ids': [station.id for station in self.stations],
+            'carriage_ids': [carriage.id for carriage in self.carriages],
+            'departure_time': '2023-06-30T09:00:00+00:00',
+            'arrival_times': ['2023-06-30T09:00:00+00:00', '2023-06-30T09:20:00+00:00', '2023-06-30T09:30:00+00:00'],
         }
-        request = self.factory.put('/schedule/1', data)
+        response = self.client.put(f'/schedules/{self.schedule.id}', data, content_type='application/json',
+                                   **self.headers)
 
-        # 调用视图的 put 方法并传入请求对象和 schedule_id
-        response = self.view.put(request, schedule_id=1)
-        # 检查响应状态码是否为 200
-        self.assertEqual(response.status_code, 200)
-        # 检查响应内容是否符合预期
-        expected_data = {
-            'result': 0,
-            'message': "行程修改成功"
-        }
-        self.assertEqual(response.json(), expected_data)
+        self.assertEqual(response.json(), {'result': 0, 'message': "行程修改成功"})
+        self.schedule.refresh_from_db()
+        self.assertEqual(self.schedule.departure_time.hour, 9)
+        self.assertEqual(list(self.schedule.scheduletostation_set.values_list('station_id', flat=True)),
+                         [station.id for station in self.stations])
+        self.assertEqual(self.schedule.scheduletocarriage_set.count(), 2)
+        self.assertEqual(self.schedule.routes.count(), 3)
 
     def test_put_non_existing_schedule(self):
-        # 创建一个 PUT 请求对象
-        data = {
-            'station_ids': [1, 2, 3],
-            'carriage_ids': [4, 5, 6],
-            'departure_time': '2023-06-30T09:00:00',
-            'arrival_times': ['2023-06-30T09:10:00', '2023-06-30T09:20:00', '2023-06-30T09:30:00'],
-        }
-        request = self.factory.put('/schedule/999', data)
+        response = self.client.put('/schedules/999', {'departure_time': '2023-06-30T09:00:00+00:00'},
+                                   content_type='application/json', **self.headers)
 
-        # 调用视图的 put 方法并传入请求对象和 schedule_id
-        response = self.view.put(request, schedule_id=999)
-        # 检查响应状态码是否为 200
-        self.assertEqual(response.status_code, 200)
-        # 检查响应内容是否符合预期
-        expected_data = {
-            'result': 1,
-            'message': "行程不存在"
-        }
-        self.assertEqual(response.json(), expected_data)
+        self.assertEqual(response.json(), {'result': 1, 'message': "行程不存在"})
 
     def test_delete_schedule(self):
-        # 创建一个 DELETE 请求对象
-        request = self.factory.delete('/schedule/1')
-        # request.user = ...
+        response = self.client.delete(f'/schedules/{self.schedule.id}', **self.headers)
 
-        # 调用视图的 delete 方法并传入请求对象、schedule_id和用户信息
-        response = self.view.delete(request, schedule_id=1, user=...)
-        # 检查响应状态码是否为 200
-        self.assertEqual(response.status_code, 200)
-        # 检查响应内容是否符合预期
-        expected_data = {
-            'result': 0,
-            'message': "行程已删除"
-        }
-        self.assertEqual(response.json(), expected_data)
+        self.assertEqual(response.json(), {'result': 0, 'message': "行程已删除"})
+        self.assertFalse(Schedule.objects.filter(id=self.schedule.id).exists())
 
     def test_delete_non_existing_schedule(self):
-        # 创建一个 DELETE 请求对象
-        request = self.factory.delete('/schedule/999')
-        # 调用视图的 delete 方法并传入请求对象、schedule_id和用户信息
-        response = self.view.delete(request, schedule_id=999, user=...)
-        # 检查响应状态码是否为 200
-        self.assertEqual(response.status_code, 200)
-        # 检查响应内容是否符合预期
-        expected_data = {
-            'result': 1,
-            'message': "未找到要删除的行程"
-        }
-        self.assertEqual(response.json(), expected_data)
+        response = self.client.delete('/schedules/999', **self.headers)
+
+        self.assertEqual(response.json(), {'result': 1, 'message': "未找到要删除的行程"})
+
 
-class StationViewTestCase(unittest.TestCase):
+class StationViewTestCase(TestCase):
     def setUp(self):
-        # Create some sample stations for testing
-        Station.objects.create(name='Station A', code='A')
-        Station.objects.create(name='Station B', code='B')
+        self.headers = admin_headers()
+        Station.objects.create(station_no='A', name='Station A')
+        Station.objects.create(station_no='B', name='Station B')
+        station_catalog.invalidate()
+        carriage_catalog.invalidate()
 
     def test_get_all_stations(self):
-        # 使用API获取所有站点
-        url = reverse('/schedules/stations/')
-        response = self.client.get(url)
+        response = self.client.get('/schedules/stations')
 
         # 验证响应的状态码
         self.assertEqual(response.status_code, 200)
 
         # 验证响应数据
         expected_data = {
-            'stations': StationSerializer(Station.objects.all(), many=True).data
+            'stations': StationSerializer(Station.objects.order_by('id'), many=True).data
         }
         self.assertJSONEqual(response.content, json.dumps(expected_data))
-        
+
     def test_add_new_station(self):
         # 构造要添加的新站点的数据
         data = {
-            'station_no': 'A',
-            'name': '站点A',
+            'station_no': 'C',
+            'name': '站点C',
         }
 
-        # 使用API添加新站点
-        url = reverse('/schedules/stations/')
-        response = self.client.post(url, data=data)
-
-        # 验证响应的状态码
-        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/schedules/stations', data=data, **self.headers)
 
         # 验证站点是否成功添加
-        self.assertTrue(Station.objects.filter(station_no='A').exists())
+        self.assertTrue(Station.objects.filter(station_no='C').exists())
 
         # 验证响应数据
         expected_data = {
@@ -195,19 +202,14 @@ class StationViewTestCase(unittest.TestCase):
     def test_add_new_station_missing_data(self):
         # 构造缺少必要数据的情况
         data = {
-            'station_no': 'A',
+            'station_no': 'C',
             # 缺少'name'字段
         }
 
-        # 使用API添加新站点
-        url = reverse('/schedules/stations/')
-        response = self.client.post(url, data=data)
-
-        # 验证响应的状态码
-        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/schedules/stations', data=data, **self.headers)
 
         # 验证站点是否未添加
-        self.assertFalse(Station.objects.filter(station_no='A').exists())
+        self.assertFalse(Station.objects.filter(station_no='C').exists())
 
         # 验证响应数据
         expected_data = {
@@ -217,21 +219,13 @@ class StationViewTestCase(unittest.TestCase):
         self.assertJSONEqual(response.content, json.dumps(expected_data))
 
     def test_add_new_station_duplicate_station_no(self):
-        # 创建一个已存在的站点
-        Station.objects.create(station_no='A', name='站点A')
-
         # 构造与已存在的站点编号冲突的新站点数据
         data = {
             'station_no': 'A',
             'name': '新站点A',
         }
 
-        # 使用API添加新站点
-        url = reverse('/schedules/stations/')
-        response = self.client.post(url, data=data)
-
-        # 验证响应的状态码
-        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/schedules/stations', data=data, **self.headers)
 
         # 验证站点是否未添加
         self.assertFalse(Station.objects.filter(name='新站点A').exists())
@@ -245,22 +239,18 @@ class StationViewTestCase(unittest.TestCase):
 
     def test_list_all_carriages(self):
         # 创建一些测试数据
-        carriage1 = Carriage.objects.create(name='Carriage 1')
-        carriage2 = Carriage.objects.create(name='Carriage 2')
+        carriage1 = Carriage.objects.create(name='Carriage 1', seat_num=50)
+        carriage2 = Carriage.objects.create(name='Carriage 2', seat_num=60, increase_rate=2)
+        carriage_catalog.invalidate()
 
-        # 使用API获取所有车厢
-        url = reverse('/schedules/carriages/') 
-        response = self.client.get(url)
+        response = self.client.get('/schedules/carriages')
 
         # 验证响应的状态码
         self.assertEqual(response.status_code, 200)
 
         # 验证响应数据
         expected_data = {
-            'carriages': [
-                {'id': carriage1.id, 'name': 'Carriage 1'},
-                {'id': carriage2.id, 'name': 'Carriage 2'},
-            ]
+            'carriages': CarriageSerializer([carriage1, carriage2], many=True).data
         }
         self.assertJSONEqual(response.content, json.dumps(expected_data))
 
@@ -269,22 +259,737 @@ class StationViewTestCase(unittest.TestCase):
         data = {
             'name': 'Carriage 1',
             'seat_num': 50,
-            'increase_rate': 0.05
+            'increase_rate': 1.5
         }
 
-        # 使用API添加新的车厢
-        url = reverse('/schedules/carriages/')  # 假设URL名称为'carriage-list'
-        response = self.client.post(url, data, content_type='application/json')
-
-        # 验证响应的状态码
-        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/schedules/carriages', data, content_type='application/json', **self.headers)
 
         # 验证数据库中是否成功添加了新的车厢
         carriage = Carriage.objects.get(name='Carriage 1')
         self.assertEqual(carriage.seat_num, 50)
-        self.assertEqual(carriage.increase_rate, 0.05)
+        self.assertEqual(carriage.increase_rate, decimal.Decimal('1.5'))
 
         # 验证响应数据
         expected_data = {'result': 0, 'message': "添加车厢成功"}
         self.assertJSONEqual(response.content, json.dumps(expected_data))
 
+
+class ScheduleRouteTestCase(TestCase):
+    def setUp(self):
+        self.stations = [Station.objects.create(station_no=f'S{i}', name=f'站点{i}') for i in range(4)]
+        self.schedule = Schedule.objects.create(schedule_no='G1', departure_time='2023-06-01T08:00:00Z')
+        self.schedule.add_stations(
+            [station.id for station in self.stations[:3]],
+            ['2023-06-01T08:00:00+00:00', '2023-06-01T09:00:00+00:00', '2023-06-01T10:00:00+00:00'],
+        )
+
+    def search(self, ori, dst):
+        response = self.client.get('/schedules/', {'ori': ori.id, 'dst': dst.id})
+        return [schedule['id'] for schedule in response.json()['schedules']]
+
+    def test_routes_cover_ordered_station_pairs(self):
+        # 三个站点共有三个有序站点对
+        self.assertEqual(ScheduleRoute.objects.filter(schedule=self.schedule).count(), 3)
+        self.assertTrue(self.schedule.is_option_schedule(self.stations[0], self.stations[2]))
+        self.assertFalse(self.schedule.is_option_schedule(self.stations[2], self.stations[0]))
+
+    def test_search_by_station_pair(self):
+        self.assertEqual(self.search(self.stations[0], self.stations[2]), [self.schedule.id])
+        self.assertEqual(self.search(self.stations[2], self.stations[0]), [])
+        self.assertEqual(self.search(self.stations[0], self.stations[3]), [])
+
+    def test_routes_follow_rewritten_stops(self):
+        # 修改行程站点后，索引应与新站点列表一致
+        self.schedule.stations.clear()
+        self.schedule.add_stations(
+            [self.stations[3].id, self.stations[0].id],
+            ['2023-06-01T08:00:00+00:00', '2023-06-01T09:00:00+00:00'],
+        )
+
+        self.assertEqual(ScheduleRoute.objects.filter(schedule=self.schedule).count(), 1)
+        self.assertEqual(self.search(self.stations[3], self.stations[0]), [self.schedule.id])
+        self.assertEqual(self.search(self.stations[0], self.stations[2]), [])
+
+    def test_rebuild_routes_command(self):
+        other = Schedule.objects.create(schedule_no='G2', departure_time='2023-06-01T08:00:00Z')
+        other.add_stations(
+            [station.id for station in self.stations],
+            [f'2023-06-01T{8 + i:02d}:00:00+00:00' for i in range(4)],
+        )
+        # 建立索引之前保存的行程没有线路
+        ScheduleRoute.objects.filter(schedule=self.schedule).delete()
+        self.assertEqual(self.search(self.stations[0], self.stations[2]), [other.id])
+
+        out = io.StringIO()
+        call_command('rebuild_routes', stdout=out)
+
+        self.assertIn("checked 2 schedules, filled the stop distances of 0, rebuilt the routes of 1", out.getvalue())
+        self.assertEqual(self.search(self.stations[0], self.stations[2]), [self.schedule.id, other.id])
+        self.assertTrue(self.schedule.is_option_schedule(self.stations[0], self.stations[2]))
+
+    def test_rebuild_routes_fills_stop_distances(self):
+        other = Schedule.objects.create(schedule_no='G2', departure_time='2023-06-01T08:00:00Z')
+        other.add_stations(
+            [station.id for station in self.stations[:2]],
+            ['2023-06-01T08:00:00+00:00', '2023-06-01T09:00:00+00:00'], ['120'],
+        )
+        carriage = Carriage.objects.create(name='一等座', seat_num=10, increase_rate='1.5')
+        carriage_catalog.invalidate()
+        ScheduleToCarriage.objects.create(schedule=self.schedule, carriage=carriage, num=1)
+        # 保存站点距离之前的行程，站点距离和线路票价都是 0
+        ScheduleToStation.objects.filter(schedule=self.schedule).update(distance=0, cumulative_distance=0)
+        ScheduleRoute.objects.filter(schedule=self.schedule).update(base_fare=0)
+
+        out = io.StringIO()
+        call_command('rebuild_routes', stdout=out)
+
+        self.assertIn("checked 2 schedules, filled the stop distances of 1, rebuilt the routes of 1", out.getvalue())
+        avg = settings.AVG_KM_BETWEEN_STATION
+        self.assertEqual(
+            list(self.schedule.scheduletostation_set.values_list('distance', 'cumulative_distance')),
+            [(0, 0), (avg, avg), (avg, 2 * avg)],
+        )
+        # 与按站数计算的旧票价一致
+        route = ScheduleRoute.objects.get(
+            schedule=self.schedule, ori_station=self.stations[0], dst_station=self.stations[2])
+        self.assertEqual(route.base_fare, fare_for_distance(2 * avg))
+        price = (decimal.Decimal('1.5') * 2 * avg * settings.ADDITION_COST_PER_KM).quantize(decimal.Decimal('0.00'))
+        schedule2carriage = ScheduleToCarriage.objects.get(schedule=self.schedule, carriage=carriage)
+        self.assertEqual(schedule2carriage.calc_cost(self.stations[0], self.stations[2]), price)
+        self.assertEqual(schedule2carriage.calc_cost(self.stations[0], self.stations[2], route), price)
+        # 已有距离的行程保持不变
+        self.assertEqual(
+            list(other.scheduletostation_set.values_list('cumulative_distance', flat=True)),
+            [0, decimal.Decimal('120')],
+        )
+
+    def test_search_for_ticket_to_change(self):
+        user = User.objects.create(username='tester')
+        contact = Contact.objects.create(name='张三', birthdate='2000-01-01', id_card='110101200001010000', user=user)
+        carriage = Carriage.objects.create(name='二等座', seat_num=10)
+        ticket = Ticket.objects.create(
+            amount=10, seat_no=0, schedule=self.schedule, carriage=carriage, user=user, contact=contact,
+            ori_station=self.stations[1], dst_station=self.stations[2],
+        )
+        other = Schedule.objects.create(schedule_no='G2', departure_time='2023-06-01T12:00:00Z')
+        other.add_stations(
+            [self.stations[2].id, self.stations[1].id],
+            ['2023-06-01T12:00:00+00:00', '2023-06-01T13:00:00+00:00'],
+        )
+
+        response = self.client.get('/schedules/', {'change': ticket.id})
+        self.assertEqual([schedule['id'] for schedule in response.json()['schedules']], [self.schedule.id])
+
+        response = self.client.get('/schedules/', {'change': ticket.id + 1})
+        self.assertEqual(response.json(), {'result': 1, 'message': "没有找到改签之前的车票"})
+
+
+class ScheduleQueryCountTestCase(TestCase):
+    def setUp(self):
+        self.stations = [Station.objects.create(station_no=f'S{i}', name=f'站点{i}') for i in range(3)]
+        self.carriages = [Carriage.objects.create(name=f'车厢{i}', seat_num=10) for i in range(2)]
+        self.user = User.objects.create(username='tester')
+        self.contact = Contact.objects.create(
+            name='张三', birthdate='2000-01-01', id_card='110101200001010000', user=self.user)
+        # 站点和车厢目录只在变更后加载一次，之后不再查询
+        station_catalog.invalidate()
+        carriage_catalog.invalidate()
+        station_catalog.get(self.stations[0].id)
+        carriage_catalog.get(self.carriages[0].id)
+
+    def add_schedules(self, num):
+        for _ in range(num):
+            schedule = Schedule.objects.create(
+                schedule_no=f'G{Schedule.objects.count()}', departure_time='2023-06-01T08:00:00Z')
+            schedule.add_stations(
+                [station.id for station in self.stations],
+                ['2023-06-01T08:00:00+00:00', '2023-06-01T09:00:00+00:00', '2023-06-01T10:00:00+00:00'],
+            )
+            schedule.add_carriages([carriage.id for carriage in self.carriages] + [self.carriages[0].id])
+            Ticket.objects.create(
+                amount=10, seat_no=0, schedule=schedule, carriage=self.carriages[1], user=self.user,
+                contact=self.contact, ori_station=self.stations[0], dst_station=self.stations[2],
+            )
+            ScheduleToCarriage.objects.get(schedule=schedule, carriage=self.carriages[1]).take_seat(
+                schedule.get_route(self.stations[0], self.stations[2]).legs)
+
+    def test_listing_query_count_is_constant(self):
+        # 行程、站点、车厢各一条查询，余票直接读取计数，与行程数量无关
+        for num in [1, 5]:
+            self.add_schedules(num)
+            with self.assertNumQueries(3):
+                response = self.client.get('/schedules/', {'ori': self.stations[0].id, 'dst': self.stations[2].id})
+            self.assertEqual(len(response.json()['schedules']), Schedule.objects.count())
+
+    def test_pages(self):
+        self.add_schedules(7)
+        Schedule.objects.filter(schedule_no__in=['G1', 'G2', 'G3']).update(departure_time='2023-05-01T08:00:00Z')
+
+        seen, cursor = [], None
+        while True:
+            with self.assertNumQueries(3):
+                response = self.client.get('/schedules/', {'limit': 3, **({'cursor': cursor} if cursor else {})}).json()
+            self.assertLessEqual(len(response['schedules']), 3)
+            seen.extend(schedule['id'] for schedule in response['schedules'])
+            cursor = response['next']
+            if not cursor:
+                break
+
+        self.assertEqual(seen, list(Schedule.objects.order_by('departure_time', 'id').values_list('id', flat=True)))
+
+        response = self.client.get('/schedules/', {'cursor': encode_cursor([[], []])}).json()
+        self.assertEqual(response, {'result': 1, 'message': "分页游标错误"})
+
+    def test_sparse_fields(self):
+        self.add_schedules(2)
+
+        # 不需要的站点和车厢不再查询
+        with self.assertNumQueries(1):
+            response = self.client.get('/schedules/', {'fields': 'id,schedule_no'}).json()
+        self.assertEqual([set(schedule) for schedule in response['schedules']], [{'id', 'schedule_no'}] * 2)
+
+        with self.assertNumQueries(2):
+            response = self.client.get('/schedules/', {'fields': 'id,stations'}).json()
+        self.assertEqual(len(response['schedules'][0]['stations']), 3)
+
+        response = self.client.get('/schedules/', {'fields': 'id,price'}).json()
+        self.assertEqual(response['result'], 1)
+
+    def test_rest_seats(self):
+        self.add_schedules(2)
+        response = self.client.get('/schedules/')
+
+        for schedule in response.json()['schedules']:
+            rest_seats = {carriage['carriage']['id']: carriage['rest_seats'] for carriage in schedule['carriages']}
+            self.assertEqual(rest_seats, {self.carriages[0].id: 20, self.carriages[1].id: 9})
+
+
+class CatalogTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        # 之前测试的写入被回滚而没有提交，目录不会自动失效
+        station_catalog.invalidate()
+        carriage_catalog.invalidate()
+        self.stations = [Station.objects.create(station_no=f'S{i}', name=f'站点{i}') for i in range(3)]
+        self.carriage = Carriage.objects.create(name='一等座', seat_num=10, increase_rate='1.50')
+        admin = User.objects.create_user(username='admin', password='admin')
+        admin.groups.add(Group.objects.create(name='Train Admin'))
+        self.headers = {'HTTP_JWT': jwt.encode(
+            {'id': admin.id, 'expire': (datetime.now() + timedelta(hours=2)).isoformat()},
+            settings.SECRET_KEY,
+        )}
+
+    def test_list_etag(self):
+        response = self.client.get('/schedules/stations')
+        self.assertEqual(response.json(), {'stations': StationSerializer(Station.objects.order_by('id'), many=True).data})
+        etag = response['ETag']
+
+        # 目录未变时不查询数据库，客户端带上 ETag 得到 304
+        with self.assertNumQueries(0):
+            response = self.client.get('/schedules/stations', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/schedules/stations', {'station_no': 'S9', 'name': '新站'}, **self.headers)
+        self.assertEqual(response.json()['result'], 0)
+
+        response = self.client.get('/schedules/stations', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['stations'][-1]['name'], '新站')
+
+    def test_carriages(self):
+        response = self.client.get('/schedules/carriages').json()
+        self.assertEqual(response['carriages'], [
+            {'id': self.carriage.id, 'name': '一等座', 'seat_num': 10, 'increase_rate': '1.50'},
+        ])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/schedules/carriages', {'name': '二等座', 'seat_num': 20}, **self.headers)
+        self.assertEqual(len(self.client.get('/schedules/carriages').json()['carriages']), 2)
+
+    def test_nested_without_queries(self):
+        schedule = Schedule.objects.create(schedule_no='G1', departure_time='2023-06-01T08:00:00Z')
+        schedule.add_stations(
+            [station.id for station in self.stations],
+            ['2023-06-01T08:00:00+00:00', '2023-06-01T09:00:00+00:00', '2023-06-01T10:00:00+00:00'],
+        )
+        schedule.add_carriages([self.carriage.id])
+        station_catalog.get(self.stations[0].id)
+        carriage_catalog.get(self.carriage.id)
+
+        # 行程、站点、车厢各一条查询，站点和车厢本身来自目录
+        with self.assertNumQueries(3):
+            response = self.client.get('/schedules/').json()['schedules'][0]
+        self.assertEqual([stop['station']['name'] for stop in response['stations']], ['站点0', '站点1', '站点2'])
+        self.assertEqual(response['carriages'][0]['carriage']['name'], '一等座')
+
+        # 其他方式写入的行也会让目录失效，但要等事务提交之后
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.stations[0].name = '改名站'
+                self.stations[0].save()
+                self.assertEqual(station_catalog.get(self.stations[0].id)['name'], '站点0')
+        self.assertEqual(station_catalog.get(self.stations[0].id)['name'], '改名站')
+
+    @override_settings(CATALOG_CACHE='default', CATALOG_CHECK_INTERVAL=0)
+    def test_shared_cache(self):
+        other_process = Catalog('stations', Station, StationSerializer)
+        station_catalog.get(self.stations[0].id)
+
+        # 另一个进程直接从共享缓存读取
+        with self.assertNumQueries(0):
+            self.assertEqual(other_process.get(self.stations[1].id)['name'], '站点1')
+
+        Station.objects.create(station_no='S9', name='新站')
+        station = Station.objects.get(station_no='S9')
+        Station.objects.filter(id=self.stations[1].id).update(name='改名站')
+        station_catalog.invalidate()
+
+        self.assertEqual(other_process.get(self.stations[1].id)['name'], '改名站')
+        self.assertEqual(other_process.get(station.id)['name'], '新站')
+
+
+class FareTestCase(TestCase):
+    def setUp(self):
+        self.stations = [Station.objects.create(station_no=f'S{i}', name=f'站点{i}') for i in range(4)]
+        self.carriages = [
+            Carriage.objects.create(name=f'车厢{i}', seat_num=10, increase_rate=rate)
+            for i, rate in enumerate(['1.00', '1.50', '2.25'])
+        ]
+        self.schedules = []
+        for i in range(3):
+            schedule = Schedule.objects.create(schedule_no=f'G{i}', departure_time='2023-06-01T08:00:00Z')
+            # 最后一个行程反向行驶
+            stations = self.stations if i < 2 else self.stations[::-1]
+            schedule.add_stations(
+                [station.id for station in stations],
+                [f'2023-06-01T{8 + order:02d}:00:00+00:00' for order in range(4)],
+            )
+            schedule.add_carriages([carriage.id for carriage in self.carriages])
+            self.schedules.append(schedule)
+        carriage_catalog.invalidate()
+        carriage_catalog.get(self.carriages[0].id)
+
+    @staticmethod
+    def legacy_cost(increase_rate, station_num):
+        return (decimal.Decimal(increase_rate) * (
+            decimal.Decimal(station_num) * settings.AVG_KM_BETWEEN_STATION * settings.ADDITION_COST_PER_KM
+        )).quantize(decimal.Decimal('0.00'))
+
+    def test_same_prices(self):
+        schedule = self.schedules[0]
+        for schedule2carriage in schedule.scheduletocarriage_set.all():
+            for route in schedule.routes.all():
+                # 已经读出线路时不再查询
+                with self.assertNumQueries(0):
+                    price = schedule2carriage.calc_cost(route.ori_station_id, route.dst_station_id, route)
+                self.assertEqual(price, self.legacy_cost(
+                    Carriage.objects.get(id=schedule2carriage.carriage_id).increase_rate, route.dst_order - route.ori_order))
+
+        schedule2carriage = schedule.scheduletocarriage_set.first()
+        self.assertIsNone(schedule2carriage.calc_cost(self.stations[3], self.stations[0]))
+
+    def test_bulk_quote(self):
+        with self.assertNumQueries(2):
+            response = self.client.get('/schedules/fares', {
+                'ori': self.stations[1].id,
+                'dst': self.stations[3].id,
+                'schedule_ids': ','.join(str(schedule.id) for schedule in self.schedules),
+            }).json()
+
+        # 反向行驶的行程不经过该区间
+        self.assertEqual([fare['schedule_id'] for fare in response['fares']], [s.id for s in self.schedules[:2]])
+        self.assertEqual(
+            [(carriage['carriage']['name'], carriage['price'], carriage['rest_seats'])
+             for carriage in response['fares'][0]['carriages']],
+            [('车厢0', '35.17', 10), ('车厢1', '52.75', 10), ('车厢2', '79.12', 10)],
+        )
+
+        response = self.client.get('/schedules/fares', {'ori': 1, 'dst': 2, 'schedule_ids': '1,x'}).json()
+        self.assertEqual(response['result'], 1)
+
+    def add_measured_schedule(self):
+        schedule = Schedule.objects.create(schedule_no='D0', departure_time='2023-06-01T08:00:00Z')
+        schedule.add_stations(
+            [station.id for station in self.stations],
+            [f'2023-06-01T{8 + order:02d}:00:00+00:00' for order in range(4)],
+            [100, '250.5', 49.5],
+        )
+        schedule.add_carriages([carriage.id for carriage in self.carriages])
+        return schedule
+
+    def test_distances(self):
+        schedule = self.add_measured_schedule()
+        schedule2carriages = list(schedule.scheduletocarriage_set.order_by('id'))
+
+        # 区间距离是两站累计距离之差，只查一次
+        with self.assertNumQueries(1):
+            price = schedule2carriages[2].calc_cost(self.stations[1], self.stations[3])
+        self.assertEqual(price, decimal.Decimal('39.56'))
+        self.assertEqual(schedule2carriages[0].calc_cost(self.stations[0], self.stations[1]), decimal.Decimal('5.86'))
+
+        # 预先算好的线路票价与之相同
+        for route in schedule.routes.all():
+            self.assertEqual(schedule2carriages[1].calc_cost(route.ori_station_id, route.dst_station_id, route),
+                             schedule2carriages[1].calc_cost(route.ori_station_id, route.dst_station_id))
+
+        response = self.client.get('/schedules/fares', {
+            'ori': self.stations[1].id, 'dst': self.stations[3].id, 'schedule_ids': schedule.id,
+        }).json()
+        self.assertEqual([carriage['price'] for carriage in response['fares'][0]['carriages']],
+                         ['17.58', '26.37', '39.56'])
+
+        response = self.client.get('/schedules/', {
+            'ori': self.stations[0].id, 'dst': self.stations[1].id, 'fields': 'schedule_no,carriages',
+        }).json()
+        prices = {row['schedule_no']: [carriage['price'] for carriage in row['carriages']]
+                  for row in response['schedules']}
+        self.assertEqual(prices['D0'], ['5.86', '8.79', '13.19'])
+        self.assertEqual(prices['G0'], ['17.58', '26.37', '39.56'])
+
+        # 没有指定区间时不报价
+        response = self.client.get('/schedules/', {'fields': 'carriages'}).json()
+        self.assertIsNone(response['schedules'][0]['carriages'][0]['price'])
+
+    def test_bad_distances(self):
+        schedule = Schedule.objects.create(schedule_no='D1', departure_time='2023-06-01T08:00:00Z')
+        arrival_times = [f'2023-06-01T{8 + order:02d}:00:00+00:00' for order in range(3)]
+        station_ids = [station.id for station in self.stations[:3]]
+
+        # 超出距离字段能存下的范围也要拒绝
+        for distances in ([100], [100, 0], [100, 'x'], [100, 'NaN'], '100,200', [10, 1e9], [10, '1000000'], [1e30, 1]):
+            with self.assertRaises(ValidationError):
+                schedule.add_stations(station_ids, arrival_times, distances)
+        self.assertFalse(schedule.scheduletostation_set.exists())
+
+        with self.assertRaises(ValueError):
+            segment_distances([MAX_SEGMENT_KM] * 101, 102)
+
+        admin = User.objects.create_user(username='admin', password='admin')
+        admin.groups.add(Group.objects.create(name='Train Admin'))
+        response = self.client.post('/schedules/', {
+            'schedule_no': 'D2',
+            'departure_time': '2023-06-01T08:00:00+00:00',
+            'station_ids': station_ids,
+            'arrival_times': arrival_times,
+            'carriage_ids': [self.carriages[0].id],
+            'distances': [10, 1e9],
+        }, content_type='application/json', HTTP_JWT=jwt.encode(
+            {'id': admin.id, 'expire': (datetime.now() + timedelta(hours=2)).isoformat()}, settings.SECRET_KEY,
+        )).json()
+        self.assertEqual(response['result'], 1)
+        self.assertTrue(response['message'].startswith("站点距离格式错误"))
+        self.assertFalse(Schedule.objects.filter(schedule_no='D2').exists())
+
+    def test_timetable_distances(self):
+        self.add_measured_schedule()
+
+        rows = {row['schedule_no']: row for row in export_timetable()}
+        self.assertEqual(rows['D0']['distances'], ['100.00', '250.50', '49.50'])
+        self.assertEqual(rows['G0']['distances'], ['300.00'] * 3)
+
+        rows['D0']['schedule_no'] = 'D1'
+        created, errors = import_timetable([rows['D0'], dict(rows['D0'], schedule_no='D2', distances=[1, 2])])
+        self.assertEqual(created, 1)
+        self.assertEqual(errors[0]['row'], 1)
+
+        schedule = Schedule.objects.get(schedule_no='D1')
+        schedule2carriage = schedule.scheduletocarriage_set.order_by('id').last()
+        self.assertEqual(schedule2carriage.calc_cost(self.stations[1], self.stations[3]), decimal.Decimal('39.56'))
+        route = schedule.routes.get(ori_station=self.stations[0], dst_station=self.stations[1])
+        self.assertEqual(schedule2carriage.calc_cost(self.stations[0], self.stations[1], route),
+                         decimal.Decimal('13.19'))
+
+
+class ScheduleWriteTestCase(TestCase):
+    def setUp(self):
+        self.stations = [Station.objects.create(station_no=f'S{i}', name=f'站点{i}') for i in range(12)]
+        self.carriages = [Carriage.objects.create(name=f'车厢{i}', seat_num=10) for i in range(5)]
+
+    def add_schedule(self, station_num, carriage_num):
+        schedule = Schedule.objects.create(schedule_no=f'G{station_num}', departure_time='2023-06-01T08:00:00Z')
+        with CaptureQueriesContext(connection) as ctx:
+            schedule.add_stations(
+                [station.id for station in self.stations[:station_num]],
+                [f'2023-06-01T{8 + i // 4:02d}:{i % 4 * 15:02d}:00+00:00' for i in range(station_num)],
+            )
+            schedule.add_carriages([carriage.id for carriage in self.carriages[:carriage_num]])
+        return schedule, len(ctx.captured_queries)
+
+    def test_statement_count_does_not_grow_with_stops(self):
+        short, short_queries = self.add_schedule(3, 1)
+        # 12 个站点的区间数仍在 SQLite 单条 insert 的变量上限之内
+        long, long_queries = self.add_schedule(12, 5)
+
+        self.assertEqual(short_queries, long_queries)
+        self.assertEqual(long.scheduletostation_set.count(), 12)
+        self.assertEqual(long.scheduletocarriage_set.count(), 5)
+        self.assertEqual(long.routes.count(), 12 * 11 // 2)
+
+    def test_unknown_ids_write_nothing(self):
+        schedule = Schedule.objects.create(schedule_no='G1', departure_time='2023-06-01T08:00:00Z')
+
+        with self.assertRaises(ValidationError):
+            schedule.add_stations([self.stations[0].id, -1], ['2023-06-01T08:00:00', '2023-06-01T09:00:00'])
+        with self.assertRaises(ValidationError):
+            schedule.add_carriages([self.carriages[0].id, -1])
+        with self.assertRaises(ValidationError):
+            schedule.add_stations([self.stations[0].id] * 2, ['2023-06-01T08:00:00', '2023-06-01T09:00:00'])
+
+        self.assertFalse(schedule.scheduletostation_set.exists())
+        self.assertFalse(schedule.scheduletocarriage_set.exists())
+
+
+class TimetableTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.stations = [Station.objects.create(station_no=f'S{i}', name=f'站点{i}') for i in range(4)]
+        self.carriages = [Carriage.objects.create(name=f'车厢{i}', seat_num=10) for i in range(2)]
+        Schedule.objects.create(schedule_no='G0', departure_time='2023-06-01T08:00:00Z')
+
+        admin = User.objects.create_user(username='admin', password='admin')
+        admin.groups.add(Group.objects.create(name='Train Admin'))
+        self.headers = {'HTTP_JWT': jwt.encode(
+            {'id': admin.id, 'expire': (datetime.now() + timedelta(hours=2)).isoformat()},
+            settings.SECRET_KEY,
+        )}
+
+    def row(self, schedule_no, station_num=3, **kwargs):
+        row = {
+            'schedule_no': schedule_no,
+            'departure_time': '2023-06-01T08:00:00+00:00',
+            'station_ids': [station.id for station in self.stations[:station_num]],
+            'arrival_times': [f'2023-06-01T{8 + i:02d}:00:00+00:00' for i in range(station_num)],
+            'carriage_ids': [self.carriages[0].id, self.carriages[0].id, self.carriages[1].id],
+        }
+        row.update(kwargs)
+        return row
+
+    def test_import_csv_command(self):
+        lines = ['schedule_no,departure_time,station_ids,arrival_times,carriage_ids']
+        for row in [self.row('G1'), self.row('G0'), self.row('G2', station_ids=[self.stations[0].id, -1]),
+                    self.row('G1', station_num=4), self.row('G3', arrival_times=['昨天'] * 3), self.row('G4', station_num=4)]:
+            lines.append(','.join([
+                row['schedule_no'], row['departure_time'],
+                *[';'.join(str(item) for item in row[key]) for key in ('station_ids', 'arrival_times', 'carriage_ids')],
+            ]))
+
+        out, err = io.StringIO(), io.StringIO()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = f'{tmp}/timetable.csv'
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines))
+            call_command('import_timetable', path, '--chunk-size', '2', stdout=out, stderr=err)
+
+        # 有效行全部导入，错误行逐行报告
+        self.assertIn('created 2 schedules, skipped 4 rows', out.getvalue())
+        self.assertEqual([line.split(':')[0] for line in err.getvalue().splitlines()],
+                         ['row 1', 'row 2', 'row 3', 'row 4'])
+
+        g4 = Schedule.objects.get(schedule_no='G4')
+        self.assertEqual(list(g4.scheduletostation_set.values_list('station_id', flat=True)),
+                         [station.id for station in self.stations])
+        self.assertEqual(g4.routes.count(), 6)
+        self.assertTrue(g4.is_option_schedule(self.stations[1], self.stations[3]))
+        self.assertEqual(
+            {s2c.carriage_id: (s2c.num, s2c.get_seat_info()) for s2c in g4.scheduletocarriage_set.all()},
+            {self.carriages[0].id: (2, (20, 0)), self.carriages[1].id: (1, (10, 0))},
+        )
+
+    def test_statement_count_per_chunk(self):
+        def queries(rows):
+            with CaptureQueriesContext(connection) as ctx:
+                created, errors = import_timetable(rows, chunk_size=100)
+            self.assertEqual(errors, [])
+            self.assertEqual(created, len(rows))
+            return len(ctx.captured_queries)
+
+        self.assertEqual(queries([self.row(f'A{i}') for i in range(2)]),
+                         queries([self.row(f'B{i}') for i in range(20)]))
+
+    def test_import_endpoint(self):
+        response = self.client.post('/schedules/import', {'schedules': [self.row('G1'), self.row('G0')]},
+                                    content_type='application/json', **self.headers).json()
+        self.assertEqual(response['created'], 1)
+        self.assertEqual(response['errors'], [{'row': 1, 'message': "行程编号已存在"}])
+
+        upload = SimpleUploadedFile('timetable.jsonl', '\n'.join(
+            [json.dumps(self.row('G2')), '{', json.dumps(self.row('G3', station_ids=1))]).encode())
+        response = self.client.post('/schedules/import', {'file': upload}, **self.headers).json()
+        self.assertEqual(response['created'], 1)
+        self.assertEqual([error['row'] for error in response['errors']], [1, 2])
+        self.assertTrue(Schedule.objects.filter(schedule_no='G2').exists())
+
+    def test_import_unreadable_file(self):
+        # 不是 utf-8 编码的文件，以及超出 csv 字段长度上限的文件
+        for content in ('schedule_no\n站点'.encode('gbk'), b'schedule_no\n"' + b'x' * 200000 + b'"\n'):
+            upload = SimpleUploadedFile('timetable.csv', content)
+            response = self.client.post('/schedules/import', {'file': upload}, **self.headers).json()
+            self.assertEqual(response['result'], 1)
+            self.assertTrue(response['message'].startswith("时刻表文件解析失败"))
+
+    def test_export_round_trip(self):
+        rows = [self.row(f'G{i}', station_num=2 + i % 3) for i in range(1, 6)]
+        import_timetable(rows)
+
+        for fmt in ('jsonl', 'csv'):
+            response = self.client.get(f'/schedules/export?type={fmt}', **self.headers)
+            self.assertTrue(response.streaming)
+            content = b''.join(response.streaming_content).decode()
+
+            exported = list(read_timetable(io.StringIO(content), fmt))
+            # 原有的 G0 没有站点和车厢
+            self.assertEqual([row['schedule_no'] for row in exported], [f'G{i}' for i in range(6)])
+            for row, expected in zip(exported[1:], rows):
+                self.assertEqual([int(station_id) for station_id in row['station_ids']], expected['station_ids'])
+                self.assertEqual([datetime.fromisoformat(t) for t in row['arrival_times']],
+                                 [datetime.fromisoformat(t) for t in expected['arrival_times']])
+                self.assertEqual(sorted(int(carriage_id) for carriage_id in row['carriage_ids']),
+                                 sorted(expected['carriage_ids']))
+
+    def test_export_statement_count_per_chunk(self):
+        import_timetable([self.row(f'G{i}') for i in range(1, 10)])
+
+        with CaptureQueriesContext(connection) as ctx:
+            rows = list(export_timetable(chunk_size=4))
+        self.assertEqual(len(rows), 10)
+        # 每块三条查询，最后一次空查询结束
+        self.assertEqual(len(ctx.captured_queries), 3 * 3 + 1)
+
+
+class ScheduleFanOutTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.stations = [Station.objects.create(station_no=f'S{i}', name=f'站点{i}') for i in range(3)]
+        self.carriage = Carriage.objects.create(name='二等座', seat_num=100)
+
+        self.admin = User.objects.create_user(username='admin', password='admin')
+        self.admin.groups.add(Group.objects.create(name='Train Admin'))
+        self.headers = {'HTTP_JWT': jwt.encode(
+            {'id': self.admin.id, 'expire': (datetime.now() + timedelta(hours=2)).isoformat()},
+            settings.SECRET_KEY,
+        )}
+        # 先缓存管理员身份，使两次请求的查询数可比
+        get_user_and_roles(self.admin.id)
+
+    def schedule_with_tickets(self, schedule_no, user_num):
+        schedule = Schedule.objects.create(schedule_no=schedule_no, departure_time='2023-06-01T08:00:00Z')
+        schedule.add_stations([station.id for station in self.stations],
+                              ['2023-06-01T08:00:00+00:00', '2023-06-01T09:00:00+00:00', '2023-06-01T10:00:00+00:00'])
+        schedule.add_carriages([self.carriage.id])
+
+        tickets = []
+        for i in range(user_num):
+            user = User.objects.create(username=f'{schedule_no}_{i}', email=f'{schedule_no}_{i}@example.com')
+            contact = Contact.objects.create(name='张三', birthdate='2000-01-01', id_card=f'{schedule_no}01012000{i:06d}', user=user)
+            # 每个用户买两张票，消息只应发一次
+            tickets.extend(
+                Ticket(amount=10, seat_no=2 * i + j, schedule=schedule, carriage=self.carriage,
+                       ori_station=self.stations[0], dst_station=self.stations[2], user=user, contact=contact)
+                for j in range(2)
+            )
+        Ticket.objects.bulk_create(tickets)
+        return schedule
+
+    def request_queries(self, method, schedule, data=None):
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(f'/schedules/{schedule.id}', data,
+                                                    content_type='application/json', **self.headers).json()
+        self.assertEqual(response['result'], 0)
+        return len(ctx.captured_queries)
+
+    def assert_notified(self, schedule_no, user_num):
+        message = self.admin.sent_messages.get(message__contains=schedule_no)
+        self.assertEqual(message.to_users.count(), user_num)
+        self.assertFalse(Ticket.objects.filter(user__in=message.to_users.all(), is_schedule_modified=False).exists())
+        self.assertEqual(len([email for email in mail.outbox if schedule_no in email.body]), user_num)
+
+    def test_modify_query_count(self):
+        few = self.schedule_with_tickets('G1', 2)
+        many = self.schedule_with_tickets('G2', 40)
+
+        data = {'departure_time': '2023-06-01T07:00:00+00:00'}
+        self.assertEqual(self.request_queries('put', few, data), self.request_queries('put', many, data))
+        # 通知由后台任务发出
+        self.assertFalse(self.admin.sent_messages.exists())
+        run_pending()
+        self.assert_notified('G1', 2)
+        self.assert_notified('G2', 40)
+
+    def test_cancel_query_count(self):
+        few = self.schedule_with_tickets('G1', 2)
+        many = self.schedule_with_tickets('G2', 40)
+
+        self.assertEqual(self.request_queries('delete', few), self.request_queries('delete', many))
+        # 通知由后台任务发出
+        self.assertFalse(self.admin.sent_messages.exists())
+        run_pending()
+        self.assert_notified('G1', 2)
+        self.assert_notified('G2', 40)
+        self.assertFalse(Schedule.objects.exists())
+
+
+class DedupeSchedulesTestCase(TransactionTestCase):
+    """
+    the constraints are dropped for the test, rows stored before them could repeat
+    """
+    legacy = [ScheduleToStation, ScheduleToCarriage, ScheduleRoute]
+
+    def setUp(self):
+        self.set_constraints('remove_constraint')
+        self.addCleanup(self.set_constraints, 'add_constraint')
+
+        self.stations = [Station.objects.create(station_no=f'S{i}', name=f'站点{i}') for i in range(3)]
+        self.carriage = Carriage.objects.create(name='二等座', seat_num=10)
+        self.schedule = Schedule.objects.create(schedule_no='G1', departure_time='2023-06-01T08:00:00Z')
+
+    def set_constraints(self, action):
+        if action == 'add_constraint':
+            for model in self.legacy:
+                model.objects.all().delete()
+        with connection.schema_editor() as editor:
+            for model in self.legacy:
+                constraints = model._meta.constraints
+                # sqlite remakes the table from the constraints the model lists
+                with patch.object(model._meta, 'constraints', constraints if action == 'add_constraint' else []):
+                    for constraint in constraints:
+                        getattr(editor, action)(model, constraint)
+
+    def add_stop(self, station, order):
+        ScheduleToStation.objects.create(schedule=self.schedule, station=station, order=order,
+                                         arrival_time='2023-06-01T08:00:00Z')
+
+    def test_merge_and_drop_copies(self):
+        for station, order in [(0, 0), (1, 1), (1, 1), (2, 2)]:
+            self.add_stop(self.stations[station], order)
+        ScheduleToCarriage.objects.create(schedule=self.schedule, carriage=self.carriage, num=2)
+        ScheduleToCarriage.objects.create(schedule=self.schedule, carriage=self.carriage, num=3)
+        for _ in range(2):
+            ScheduleRoute.objects.create(schedule=self.schedule, ori_station=self.stations[0],
+                                         dst_station=self.stations[1], ori_order=0, dst_order=1)
+
+        out = io.StringIO()
+        call_command('dedupe_schedules', stdout=out)
+
+        self.assertIn("merged 1 repeated carriages, dropped 1 repeated stops and 1 repeated routes", out.getvalue())
+        self.assertEqual(list(self.schedule.scheduletostation_set.values_list('order', flat=True)), [0, 1, 2])
+        self.assertEqual(list(ScheduleToCarriage.objects.values_list('num', flat=True)), [5])
+        self.assertEqual(ScheduleRoute.objects.count(), 1)
+
+    def test_report_conflicting_stops(self):
+        # 同一站点出现两次、同一序号有两个站点，无法自动合并
+        for station, order in [(0, 0), (1, 1), (0, 2), (2, 2)]:
+            self.add_stop(self.stations[station], order)
+
+        err = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command('dedupe_schedules', stdout=io.StringIO(), stderr=err)
+
+        stations = [station.id for station in self.stations]
+        self.assertIn(
+            f"schedule {self.schedule.id}: station {stations[0]} at order 0, station {stations[1]} at order 1, "
+            f"station {stations[0]} at order 2, station {stations[2]} at order 2",
+            err.getvalue(),
+        )
+        self.assertEqual(ScheduleToStation.objects.count(), 4)
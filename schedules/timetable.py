@@ -0,0 +1,268 @@
+import csv
+import io
+import json
+from collections import Counter
+from datetime import datetime
+from itertools import islice
+
+from django.db import transaction, DatabaseError
+
+from schedules.models import (
+    Schedule, Station, Carriage, ScheduleToStation, ScheduleToCarriage, ScheduleRoute, MAX_STATION_NUM,
+    cumulative_distances, segment_distances,
+)
+
+TIMETABLE_FORMATS = ['csv', 'json', 'jsonl']
+
+# json arrays can't be written incrementally, so exports come as one row per line
+EXPORT_CONTENT_TYPES = {
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+TIMETABLE_FIELDS = ['schedule_no', 'departure_time', 'station_ids', 'arrival_times', 'carriage_ids', 'distances']
+
+# list columns of a csv timetable hold their items separated by this character
+CSV_LIST_SEPARATOR = ';'
+
+# a schedule with many stops expands into thousands of routes, so inserts are batched as well
+BULK_BATCH_SIZE = 1000
+
+
+class RowError(Exception):
+    pass
+
+
+def read_timetable(stream, fmt):
+    """
+    yield schedule rows of the shape ScheduleView.post accepts from a text stream,
+    csv and jsonl are read lazily, json must be an array of rows
+    """
+    if fmt == 'csv':
+        for row in csv.DictReader(stream):
+            yield {
+                key: [item for item in (value or '').split(CSV_LIST_SEPARATOR) if item]
+                if key in ('station_ids', 'arrival_times', 'carriage_ids', 'distances') else value
+                for key, value in row.items()
+            }
+    elif fmt == 'jsonl':
+        for line in stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # reported by parse_row like any other malformed row
+                    yield None
+    elif fmt == 'json':
+        yield from json.load(stream)
+    else:
+        raise ValueError(f"unknown timetable format {fmt}")
+
+
+def export_timetable(chunk_size=500):
+    """
+    yield every schedule as a row import_timetable accepts, holding at most chunk_size schedules in memory.
+    chunks are paged by id rather than through a cursor, as the mysql driver buffers whole result sets,
+    and stops and carriages are prefetched once per chunk
+    """
+    schedules = Schedule.objects.order_by('id').prefetch_related('scheduletostation_set', 'scheduletocarriage_set')
+
+    last_id = 0
+    while True:
+        chunk = list(schedules.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            break
+        last_id = chunk[-1].id
+        yield from (_export_row(schedule) for schedule in chunk)
+
+
+def _export_row(schedule):
+    stops = schedule.scheduletostation_set.all()
+    return {
+        'schedule_no': schedule.schedule_no,
+        'departure_time': schedule.departure_time.isoformat(),
+        'station_ids': [stop.station_id for stop in stops],
+        'arrival_times': [stop.arrival_time.isoformat() for stop in stops],
+        'carriage_ids': [
+            schedule2carriage.carriage_id
+            for schedule2carriage in schedule.scheduletocarriage_set.all()
+            for _ in range(schedule2carriage.num)
+        ],
+        'distances': [str(stop.distance) for stop in stops[1:]],
+    }
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def write_timetable(rows, fmt):
+    """
+    turn rows into lines of a csv or jsonl document, one at a time
+    """
+    if fmt == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(TIMETABLE_FIELDS)
+        for row in rows:
+            yield writer.writerow([
+                CSV_LIST_SEPARATOR.join(str(item) for item in row[field]) if isinstance(row[field], list) else row[field]
+                for field in TIMETABLE_FIELDS
+            ])
+    elif fmt == 'jsonl':
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False) + '\n'
+    else:
+        raise ValueError(f"unknown timetable format {fmt}")
+
+
+def read_timetable_bytes(content, fmt):
+    # decoded once the rows are read, so a file that isn't utf-8 fails where parse errors are handled
+    yield from read_timetable(io.StringIO(content.decode('utf-8-sig')), fmt)
+
+
+def parse_row(row):
+    """
+    check one row on its own,
+    returns (schedule_no, departure_time, station_ids, arrival_times, carriage_count, cumulative_distances)
+    """
+    if not isinstance(row, dict):
+        raise RowError("行格式错误")
+
+    schedule_no = row.get('schedule_no', None)
+    station_ids = row.get('station_ids', None)
+    carriage_ids = row.get('carriage_ids', None)
+    departure_time = row.get('departure_time', None)
+    arrival_times = row.get('arrival_times', None)
+
+    if (not schedule_no
+            or not station_ids or not carriage_ids
+            or not departure_time or not arrival_times):
+        raise RowError("必须设置行程编号、出发时间、各站点及其到达时间、车厢")
+
+    if not all(isinstance(ids, list) for ids in (station_ids, arrival_times, carriage_ids)):
+        raise RowError("站点、到达时间和车厢必须是列表")
+
+    if len(station_ids) > MAX_STATION_NUM:
+        raise RowError(f"行程站点数不能超过 {MAX_STATION_NUM} 个")
+
+    if len(station_ids) != len(arrival_times):
+        raise RowError("请为每个站点设置到达时间")
+
+    try:
+        departure_time = datetime.fromisoformat(departure_time)
+        station_ids = [int(station_id) for station_id in station_ids]
+        arrival_times = [datetime.fromisoformat(arrival_time) for arrival_time in arrival_times]
+        carriage_count = Counter(int(carriage_id) for carriage_id in carriage_ids)
+    except (TypeError, ValueError) as e:
+        raise RowError(f"站点、车厢或时间格式错误，{e}")
+
+    if len(set(station_ids)) != len(station_ids):
+        raise RowError("行程不能重复经过同一站点")
+
+    try:
+        # an empty csv cell reads as an empty list, both mean the default distances
+        distances = segment_distances(row.get('distances', None) or None, len(station_ids))
+    except (TypeError, ValueError, ArithmeticError) as e:
+        raise RowError(f"站点距离格式错误，{e}")
+
+    return str(schedule_no), departure_time, station_ids, arrival_times, carriage_count, cumulative_distances(distances)
+
+
+def import_timetable(rows, chunk_size=200):
+    """
+    create schedules from an iterable of rows, chunk_size rows per transaction.
+    every chunk checks its station, carriage and schedule_no references with one query each
+    and writes each table with one bulk_create, a bad row is reported and skipped instead of aborting the load.
+    returns (created, errors), errors being a list of {'row': index, 'message': ...}
+    """
+    created = 0
+    errors = []
+    seen_schedule_nos = set()
+
+    rows = enumerate(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        parsed = []
+        for index, row in chunk:
+            try:
+                parsed.append((index, parse_row(row)))
+            except RowError as e:
+                errors.append({'row': index, 'message': str(e)})
+
+        station_ids = {station_id for _, (_, _, stops, *_) in parsed for station_id in stops}
+        carriage_ids = {carriage_id for _, (_, _, _, _, count, _) in parsed for carriage_id in count}
+        schedule_nos = {schedule_no for _, (schedule_no, *_) in parsed}
+
+        known_stations = set(Station.objects.filter(id__in=station_ids).values_list('id', flat=True))
+        seat_nums = dict(Carriage.objects.filter(id__in=carriage_ids).values_list('id', 'seat_num'))
+        taken_schedule_nos = set(
+            Schedule.objects.filter(schedule_no__in=schedule_nos).values_list('schedule_no', flat=True)
+        )
+
+        valid = []
+        for index, (schedule_no, departure_time, stops, arrival_times, carriage_count, cumulative) in parsed:
+            missing_stations = set(stops) - known_stations
+            missing_carriages = set(carriage_count) - seat_nums.keys()
+            if schedule_no in taken_schedule_nos or schedule_no in seen_schedule_nos:
+                errors.append({'row': index, 'message': "行程编号已存在"})
+            elif missing_stations:
+                errors.append({'row': index, 'message': f"站点 {sorted(missing_stations)} 不存在"})
+            elif missing_carriages:
+                errors.append({'row': index, 'message': f"车厢 {sorted(missing_carriages)} 不存在"})
+            else:
+                seen_schedule_nos.add(schedule_no)
+                valid.append((index, schedule_no, departure_time, stops, arrival_times, carriage_count, cumulative))
+
+        if not valid:
+            continue
+
+        try:
+            with transaction.atomic():
+                _write_chunk(valid, seat_nums)
+        except DatabaseError as e:
+            errors.extend({'row': index, 'message': f"写入失败，{e}"} for index, *_ in valid)
+            continue
+
+        created += len(valid)
+
+    errors.sort(key=lambda error: error['row'])
+    return created, errors
+
+
+def _write_chunk(valid, seat_nums):
+    Schedule.objects.bulk_create(
+        (Schedule(schedule_no=schedule_no, departure_time=departure_time)
+         for _, schedule_no, departure_time, *_ in valid),
+        batch_size=BULK_BATCH_SIZE,
+    )
+    # not every backend returns primary keys from bulk_create, schedule_no is unique so read them back
+    schedule_ids = dict(
+        Schedule.objects.filter(schedule_no__in=[schedule_no for _, schedule_no, *_ in valid])
+        .values_list('schedule_no', 'id')
+    )
+
+    schedule2stations = []
+    routes = []
+    schedule2carriages = []
+    for _, schedule_no, _, stops, arrival_times, carriage_count, cumulative in valid:
+        schedule = Schedule(id=schedule_ids[schedule_no], schedule_no=schedule_no)
+        schedule2stations.extend(
+            ScheduleToStation(schedule=schedule, station_id=station_id, order=i, arrival_time=arrival_time,
+                              distance=cumulative[i] - cumulative[i - 1] if i else 0,
+                              cumulative_distance=cumulative[i])
+            for i, (station_id, arrival_time) in enumerate(zip(stops, arrival_times))
+        )
+        routes.extend(ScheduleRoute.for_stops(schedule, stops, cumulative))
+        # a new schedule has no tickets, so its seat inventory is just the capacity
+        schedule2carriages.extend(
+            ScheduleToCarriage(schedule=schedule, carriage_id=carriage_id, num=num, capacity=num * seat_nums[carriage_id])
+            for carriage_id, num in carriage_count.items()
+        )
+
+    ScheduleToStation.objects.bulk_create(schedule2stations, batch_size=BULK_BATCH_SIZE)
+    ScheduleRoute.objects.bulk_create(routes, batch_size=BULK_BATCH_SIZE)
+    ScheduleToCarriage.objects.bulk_create(schedule2carriages, batch_size=BULK_BATCH_SIZE)
@@ -5,6 +5,9 @@ from schedules import views
 urlpatterns = [
     path("stations", views.StationView.as_view()),
     path("carriages", views.CarriageView.as_view()),
+    path("fares", views.FareView.as_view()),
+    path("import", views.TimetableImportView.as_view()),
+    path("export", views.TimetableExportView.as_view()),
     path("<int:schedule_id>", views.ScheduleIdView.as_view()),
     path("", views.ScheduleView.as_view()),
 ]
@@ -1,12 +1,24 @@
+import csv
 from datetime import datetime
 
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.http import StreamingHttpResponse
 from rest_framework.views import APIView
 
-from schedules.models import Schedule, Station, Carriage
-from schedules.serializers import ScheduleSerializer, StationSerializer, CarriageSerializer
-from system_messages.models import Message
+from schedules.fares import quote_fares
+from schedules.models import Schedule, Station, Carriage, MAX_STATION_NUM
+from schedules.catalog import station_catalog, carriage_catalog
+from schedules.serializers import ScheduleSerializer
+from schedules.timetable import (
+    import_timetable, read_timetable_bytes, export_timetable, write_timetable, TIMETABLE_FORMATS, EXPORT_CONTENT_TYPES,
+)
+from jobs.queue import enqueue
+from system_messages.tasks import deliver_message
 from tickets.models import Ticket
 from utils import json
+from utils.pagination import keyset_page, parse_limit, InvalidPage
 from utils.perm import permission_check
 
 
@@ -16,17 +28,34 @@ class ScheduleView(APIView):
         """
         list all train schedule
         """
-        ticket_id_to_change = request.query_params.get('change', -1)
-        ticket_to_change = Ticket.objects.filter(id=ticket_id_to_change).first()
-        if ticket_id_to_change != -1 and not ticket_to_change:
-            return json.response({'result': 1, 'message': "没有找到改签之前的车票"})
-        
+        ticket_id_to_change = request.query_params.get('change', None)
         departure_time_after = request.query_params.get('after', None)
         departure_time_before = request.query_params.get('before', None)
         ori_station_id = request.query_params.get('ori', None)
         dst_station_id = request.query_params.get('dst', None)
-
-        schedules = Schedule.objects
+        fields = request.query_params.get('fields', None)
+
+        if fields:
+            fields = fields.split(',')
+            unknown = set(fields) - set(ScheduleSerializer.Meta.fields)
+            if unknown:
+                return json.response({'result': 1, 'message': f"字段 {'、'.join(sorted(unknown))} 不存在"})
+
+        schedules = Schedule.objects.passing(ori_station_id, dst_station_id)
+        span = (ori_station_id, dst_station_id)
+
+        if ticket_id_to_change:
+            ticket_to_change = Ticket.objects.filter(id=ticket_id_to_change).first()
+            if not ticket_to_change:
+                return json.response({'result': 1, 'message': "没有找到改签之前的车票"})
+            schedules = schedules.passing(ticket_to_change.ori_station_id, ticket_to_change.dst_station_id)
+            span = (ticket_to_change.ori_station_id, ticket_to_change.dst_station_id)
+
+        try:
+            span = (int(span[0]), int(span[1]))
+        except (TypeError, ValueError):
+            # carriages are priced only for a searched span
+            span = None
 
         if departure_time_after:
             schedules = schedules.filter(departure_time__gte=departure_time_after)
@@ -34,17 +63,26 @@ class ScheduleView(APIView):
         if departure_time_before:
             schedules = schedules.filter(departure_time__lte=departure_time_before)
 
-        schedules = schedules.all()
-
-        ori_station = Station.objects.filter(id=ori_station_id).first() if ori_station_id else None
-        dst_station = Station.objects.filter(id=dst_station_id).first() if dst_station_id else None
-        
-        schedules = filter(lambda elm: elm.is_option_schedule(ori_station, dst_station), schedules)
+        with_carriages = not fields or 'carriages' in fields
+        schedules = schedules.distinct().with_details(
+            # the price of a span is read from the cumulative distances of the stops
+            stations=not fields or 'stations' in fields or (with_carriages and span is not None),
+            carriages=with_carriages,
+        )
 
-        if ticket_to_change:
-            schedules = filter(lambda elm: elm.is_option_schedule(ticket_to_change.ori_station, ticket_to_change.dst_station), schedules)
+        try:
+            page, next_cursor = keyset_page(
+                schedules, ['departure_time', 'id'],
+                cursor=request.query_params.get('cursor', None),
+                limit=parse_limit(request.query_params.get('limit', None)),
+            )
+        except InvalidPage as e:
+            return json.response({'result': 1, 'message': str(e)})
 
-        return json.response({"schedules": ScheduleSerializer(schedules, many=True).data})
+        return json.response({
+            "schedules": ScheduleSerializer(page, many=True, fields=fields, context={'span': span}).data,
+            "next": next_cursor,
+        })
 
     @permission_check(['Train Admin'])
     def post(self, request):
@@ -65,26 +103,49 @@ class ScheduleView(APIView):
         if Schedule.objects.filter(schedule_no=schedule_no).exists():
             return json.response({'result': 1, 'message': "行程编号已存在"})
 
-        schedule = Schedule(schedule_no=schedule_no, departure_time=datetime.fromisoformat(departure_time))
-        schedule.save()
+        if len(station_ids) > MAX_STATION_NUM:
+            return json.response({'result': 1, 'message': f"行程站点数不能超过 {MAX_STATION_NUM} 个"})
 
         if len(station_ids) != len(arrival_times):
             return json.response({'result': 1, 'message': "请为每个站点设置到达时间"})
 
-        schedule.add_stations(station_ids, arrival_times)
+        try:
+            with transaction.atomic():
+                schedule = Schedule(schedule_no=schedule_no, departure_time=datetime.fromisoformat(departure_time))
+                schedule.save()
 
-        schedule.add_carriages(carriage_ids)
+                schedule.add_stations(station_ids, arrival_times, request.data.get('distances', None))
+
+                schedule.add_carriages(carriage_ids)
+        except ValidationError as e:
+            return json.response({'result': 1, 'message': e.message})
 
         return json.response({'result': 0, 'message': "设置行程成功"})
 
 
+def notify_ticket_holders(schedule, from_user, text):
+    """
+    flag every ticket of the schedule as modified and queue a message to their owners,
+    in a fixed number of statements whatever the number of tickets
+    """
+    with transaction.atomic():
+        tickets = Ticket.objects.filter(schedule=schedule)
+        tickets.update(is_schedule_modified=True)
+        enqueue(
+            deliver_message,
+            text=text,
+            from_user_id=from_user.id,
+            user_ids=list(tickets.values_list('user_id', flat=True).distinct()),
+        )
+
+
 class ScheduleIdView(APIView):
     @permission_check(['Common User'])
     def get(self, request, schedule_id):
         """
         get schedule by id
         """
-        schedule = Schedule.objects.filter(id=schedule_id).first()
+        schedule = Schedule.objects.with_details().filter(id=schedule_id).first()
         if not schedule:
             return json.response({'result': 1, 'message': "未找到编号对应的行程"})
         return json.response(ScheduleSerializer(schedule).data)
@@ -107,27 +168,26 @@ class ScheduleIdView(APIView):
         if station_ids and arrival_times:
             if len(station_ids) != len(arrival_times):
                 return json.response({'result': 1, 'message': "请为每个站点设置到达时间"})
-            schedule.stations.clear()
-            schedule.add_stations(station_ids, arrival_times)
+            if len(station_ids) > MAX_STATION_NUM:
+                return json.response({'result': 1, 'message': f"行程站点数不能超过 {MAX_STATION_NUM} 个"})
+
+        try:
+            with transaction.atomic():
+                if station_ids and arrival_times:
+                    schedule.stations.clear()
+                    schedule.add_stations(station_ids, arrival_times, request.data.get('distances', None))
 
-        if carriage_ids:
-            schedule.carriages.clear()
-            schedule.add_carriages(carriage_ids)
+                if carriage_ids:
+                    schedule.carriages.clear()
+                    schedule.add_carriages(carriage_ids)
+        except ValidationError as e:
+            return json.response({'result': 1, 'message': e.message})
 
         if departure_time:
             schedule.departure_time = datetime.fromisoformat(departure_time)
             schedule.save()
 
-        message = Message(
-            message=f"您购买的车次”{schedule.schedule_no}“已发生修改。您可以免费改签其他车次",
-            from_user=user,
-        )
-        message.save()
-
-        for ticket in schedule.tickets.all():
-            ticket.is_schedule_modified = True
-            ticket.save()
-            message.to_users.add(ticket.user)
+        notify_ticket_holders(schedule, user, f"您购买的车次”{schedule.schedule_no}“已发生修改。您可以免费改签其他车次")
 
         return json.response({'result': 0, 'message': "行程修改成功"})
 
@@ -139,30 +199,99 @@ class ScheduleIdView(APIView):
         schedule = Schedule.objects.filter(id=schedule_id).first()
 
         if not schedule:
-            json.response({'result': 1, 'message': "未找到要删除的行程"})
+            return json.response({'result': 1, 'message': "未找到要删除的行程"})
 
-        message = Message(
-            message=f"您购买的车次”{schedule.schedule_no}“已被取消。您可以免费改签其他车次",
-            from_user=user,
-        )
-        message.save()
+        with transaction.atomic():
+            notify_ticket_holders(schedule, user, f"您购买的车次”{schedule.schedule_no}“已被取消。您可以免费改签其他车次")
+            schedule.delete()
 
-        for ticket in schedule.tickets.all():
-            ticket.is_schedule_modified = True
-            ticket.save()
-            message.to_users.add(ticket.user)
+        return json.response({'result': 0, 'message': "行程已删除"})
 
-        schedule.delete()
 
-        return json.response({'result': 0, 'message': "行程已删除"})
+class TimetableImportView(APIView):
+    @permission_check(['Train Admin'])
+    def post(self, request):
+        """
+        add many schedules at once, either as a 'schedules' list in the body
+        or as an uploaded csv/json/jsonl 'file' with the same fields as adding a single schedule
+        """
+        upload = request.FILES.get('file', None)
+        if upload:
+            fmt = request.data.get('format', None) or upload.name.rsplit('.', 1)[-1].lower()
+            if fmt not in TIMETABLE_FORMATS:
+                return json.response({'result': 1, 'message': f"文件格式必须是 {'、'.join(TIMETABLE_FORMATS)} 之一"})
+        else:
+            rows = request.data.get('schedules', None)
+            if not isinstance(rows, list):
+                return json.response({'result': 1, 'message': "必须上传时刻表文件或设置行程列表"})
+
+        try:
+            if upload:
+                rows = read_timetable_bytes(upload.read(), fmt)
+            created, errors = import_timetable(rows)
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            return json.response({'result': 1, 'message': f"时刻表文件解析失败，{e}"})
+
+        return json.response({
+            'result': 0,
+            'message': f"导入行程 {created} 个，失败 {len(errors)} 个",
+            'created': created,
+            'errors': errors,
+        })
+
+
+class TimetableExportView(APIView):
+    @permission_check(['Train Admin'])
+    def get(self, request):
+        """
+        stream the whole timetable as csv or jsonl, in the format the import accepts
+        """
+        # 'format' is taken by rest_framework's content negotiation
+        fmt = request.query_params.get('type', 'jsonl')
+        if fmt not in EXPORT_CONTENT_TYPES:
+            return json.response({'result': 1, 'message': f"导出格式必须是 {'、'.join(EXPORT_CONTENT_TYPES)} 之一"})
+
+        response = StreamingHttpResponse(write_timetable(export_timetable(), fmt), content_type=EXPORT_CONTENT_TYPES[fmt])
+        response['Content-Disposition'] = f'attachment; filename="timetable.{fmt}"'
+        return response
+
+
+class FareView(APIView):
+    def get(self, request):
+        """
+        quote every carriage of many schedules between two stations at once
+        """
+        ori_station_id = request.query_params.get('ori', None)
+        dst_station_id = request.query_params.get('dst', None)
+        schedule_ids = request.query_params.get('schedule_ids', None)
+
+        if not ori_station_id or not dst_station_id or not schedule_ids:
+            return json.response({'result': 1, 'message': "必须设置起终站点和行程"})
+
+        try:
+            ori_station_id = int(ori_station_id)
+            dst_station_id = int(dst_station_id)
+            schedule_ids = [int(schedule_id) for schedule_id in schedule_ids.split(',')]
+        except ValueError:
+            return json.response({'result': 1, 'message': "站点和行程编号必须是整数"})
+
+        if len(schedule_ids) > settings.MAX_PAGE_SIZE:
+            return json.response({'result': 1, 'message': f"一次最多查询 {settings.MAX_PAGE_SIZE} 个行程"})
+
+        quotes = quote_fares(schedule_ids, ori_station_id, dst_station_id)
+
+        return json.response({'fares': [
+            {'schedule_id': schedule_id, 'carriages': quotes[schedule_id]}
+            for schedule_id in dict.fromkeys(schedule_ids) if schedule_id in quotes
+        ]})
 
 
 class StationView(APIView):
     def get(self, request):
         """
-        list all stations
+        list all stations, answers 304 to a client that sends the ETag of the current list
         """
-        return json.response({'stations': StationSerializer(Station.objects.all(), many=True).data})
+        return station_catalog.response(request)
 
     @permission_check(['Train Admin'])
     def post(self, request):
@@ -187,9 +316,9 @@ class StationView(APIView):
 class CarriageView(APIView):
     def get(self, request):
         """
-        list all carriages
+        list all carriages, answers 304 to a client that sends the ETag of the current list
         """
-        return json.response({'carriages': CarriageSerializer(Carriage.objects.all(), many=True).data})
+        return carriage_catalog.response(request)
 
     @permission_check(['Train Admin'])
     def post(self, request):
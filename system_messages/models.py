@@ -1,11 +1,119 @@
-from django.contrib.auth.models import User
+from django.conf import settings
+from django.contrib.auth.models import User, Group
+from django.core.cache import cache
 from django.db import models
 
+from schedules.models import Schedule
+from tickets.models import Ticket
+
 
 # Create your models here.
+class MessageQuerySet(models.QuerySet):
+    def inbox(self, user):
+        """
+        messages the user receives, whether addressed to them or to an audience they belong to,
+        without the ones they deleted. is_read is annotated from their MessageState
+        """
+        addressed = Message.to_users.through.objects.filter(user=user).values('message_id')
+        states = MessageState.objects.filter(message=models.OuterRef('pk'), user=user)
+
+        return self.filter(
+            models.Q(audience=Message.USERS, id__in=addressed)
+            | models.Q(audience=Message.ALL)
+            | models.Q(audience=Message.ROLE, audience_role__in=user.groups.values('id'))
+            | models.Q(audience=Message.SCHEDULE, audience_schedule__in=Ticket.objects.filter(user=user).values('schedule_id'))
+        ).exclude(
+            models.Exists(states.filter(is_deleted=True))
+        ).annotate(
+            is_read=models.Exists(states.filter(is_read=True))
+        )
+
+
 class Message(models.Model):
+    USERS = 'users'
+    ALL = 'all'
+    ROLE = 'role'
+    SCHEDULE = 'schedule'
+    AUDIENCE_CHOICES = [(USERS, USERS), (ALL, ALL), (ROLE, ROLE), (SCHEDULE, SCHEDULE)]
+
     message = models.TextField(max_length=500)
     send_time = models.DateTimeField(auto_now_add=True)
 
     from_user = models.ForeignKey(to=User, on_delete=models.SET_NULL, null=True, related_name='sent_messages')
     to_users = models.ManyToManyField(to=User, related_name='received_messages')
+
+    # messages to anyone but listed users are stored once and matched against the reader, see MessageQuerySet.inbox
+    audience = models.CharField(max_length=16, choices=AUDIENCE_CHOICES, default=USERS)
+    audience_role = models.ForeignKey(to=Group, on_delete=models.CASCADE, null=True, related_name='+')
+    audience_schedule = models.ForeignKey(to=Schedule, on_delete=models.CASCADE, null=True, related_name='+')
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        # inbox and outbox pages are read newest first by (send_time, id), see utils.pagination
+        indexes = [
+            models.Index(fields=['send_time', 'id']),
+            models.Index(fields=['from_user', 'send_time', 'id']),
+        ]
+
+    def add_receivers(self, user_ids, batch_size=1000):
+        """
+        add many receivers with batched inserts into the through table, repeated or existing ones are skipped
+        """
+        user_ids = set(user_ids)
+        MessageToUser = Message.to_users.through
+        MessageToUser.objects.bulk_create(
+            (MessageToUser(message_id=self.id, user_id=user_id) for user_id in user_ids),
+            batch_size=batch_size,
+            ignore_conflicts=True,
+        )
+        invalidate_unread_counts(user_ids)
+
+
+class MessageState(models.Model):
+    """
+    what a receiver did with a message, only present once they read or deleted it
+    """
+    message = models.ForeignKey(to=Message, on_delete=models.CASCADE, related_name='states')
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='message_states')
+    is_read = models.BooleanField(default=False)
+    is_deleted = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['message', 'user'], name='unique_message_state')]
+
+
+def _unread_count_key(user_id):
+    return f'inbox:unread:{user_id}'
+
+
+_INBOX_GENERATION_KEY = 'inbox:generation'
+
+
+def get_unread_count(user):
+    """
+    number of unread messages in the inbox of user, counted at most once per settings.INBOX_COUNTER_TTL.
+    the count is dropped when the user gets a listed message or reads or deletes one,
+    and every count at once when an audience message is sent or a message is withdrawn
+    """
+    generation = cache.get_or_set(_INBOX_GENERATION_KEY, 0, None)
+    cached = cache.get(_unread_count_key(user.id))
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+
+    count = Message.objects.inbox(user).filter(is_read=False).count()
+    cache.set(_unread_count_key(user.id), (generation, count), settings.INBOX_COUNTER_TTL)
+    return count
+
+
+def invalidate_unread_counts(user_ids=None):
+    """
+    drop the unread counts of the given users, or of everyone if user_ids is None
+    """
+    if user_ids is None:
+        try:
+            cache.incr(_INBOX_GENERATION_KEY)
+        except ValueError:
+            cache.set(_INBOX_GENERATION_KEY, 1, None)
+    else:
+        cache.delete_many([_unread_count_key(user_id) for user_id in user_ids])
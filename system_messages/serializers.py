@@ -12,10 +12,12 @@ class SentMessageSerializer(serializers.ModelSerializer):
 
 class ReceivedMessageSerializer(serializers.ModelSerializer):
     from_user = serializers.SerializerMethodField()
+    # annotated by Message.objects.inbox
+    is_read = serializers.BooleanField(read_only=True)
 
     class Meta:
         model = Message
-        exclude = ['to_users']
+        exclude = ['to_users', 'audience_role', 'audience_schedule']
 
     def get_from_user(self, obj):
-        return obj.from_user.username
+        return obj.from_user.username if obj.from_user else None
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils.html import escape
+
+from jobs.queue import task, enqueue_many
+from jobs.tasks import send_mail
+from system_messages.models import Message
+
+
+@task
+def deliver_message(text, from_user_id, user_ids):
+    """
+    create a system message for many users and mail a copy to each of them that has an address
+    """
+    message = Message(message=text, from_user_id=from_user_id)
+    message.save()
+    message.add_receivers(user_ids)
+
+    emails = User.objects.filter(id__in=user_ids).exclude(email='').values_list('email', flat=True)
+    enqueue_many(send_mail, (
+        {
+            'subject': "畅游中国行程变更通知",
+            'text_content': text,
+            'html_content': escape(text),
+            'from_email': settings.EMAIL_HOST_USER,
+            'to': [email],
+        }
+        for email in emails
+    ))
@@ -1,46 +1,180 @@
-from django.test import TestCase
-
+from datetime import datetime, timedelta
 import json
+import jwt
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
-from django.urls import reverse
-from models import Message, User
+from django.test.utils import CaptureQueriesContext
+from contacts.models import Contact
+from schedules.models import Carriage, Schedule, Station
+from system_messages.models import Message, MessageState
+from system_messages.serializers import SentMessageSerializer
+from tickets.models import Ticket
+from utils.pagination import encode_cursor
 # Create your tests here.
 
 class MessageViewTestCase(TestCase):
     def setUp(self):
+        cache.clear()
         # 创建测试用户
         self.user = User.objects.create(username='admin', password='admin123')
-
-    def test_get_sent_messages(self):
+        self.headers = {'HTTP_JWT': jwt.encode(
+            {'id': self.user.id, 'expire': (datetime.now() + timedelta(hours=2)).isoformat()},
+            settings.SECRET_KEY,
+        )}
         # 创建测试消息
-        message = Message.objects.create(message='Test Message', from_user=self.user)
-        message.to_users.add(self.user)
+        self.message = Message.objects.create(message='Test Message', from_user=self.user)
+        self.message.add_receivers([self.user.id])
 
+    def test_get_sent_messages(self):
         # 使用API获取发送的系统消息
-        url = reverse('/messages') + '?send=true'
-        self.client.force_authenticate(user=self.user)
-        response = self.client.get(url)
+        response = self.client.get('/messages/', {'send': 'true'}, **self.headers)
 
         # 验证响应的状态码
         self.assertEqual(response.status_code, 200)
 
         # 验证响应数据
-        expected_data = {'system_messages': [{'id': message.id, 'message': 'Test Message'}]}
+        expected_data = {'system_messages': SentMessageSerializer([self.message], many=True).data, 'next': None}
         self.assertJSONEqual(response.content, json.dumps(expected_data))
 
-    def test_get_sent_messages(self):
-        # 创建测试消息
-        message = Message.objects.create(message='Test Message', from_user=self.user)
-        message.to_users.add(self.user)
-
-        # 使用API获取发送的系统消息
-        url = reverse('/messages') + '?send=false'
-        self.client.force_authenticate(user=self.user)
-        response = self.client.get(url)
+    def test_get_received_messages(self):
+        # 使用API获取收到的系统消息
+        response = self.client.get('/messages/', {'send': 'false'}, **self.headers)
 
         # 验证响应的状态码
         self.assertEqual(response.status_code, 200)
 
         # 验证响应数据
-        expected_data = {'system_messages': [{'id': message.id, 'message': 'Test Message'}]}
-        self.assertJSONEqual(response.content, json.dumps(expected_data))
+        messages = response.json()['system_messages']
+        self.assertEqual([(message['id'], message['message'], message['from_user'], message['is_read'])
+                          for message in messages], [(self.message.id, 'Test Message', 'admin', False)])
+
+
+class InboxTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create(username='admin')
+        self.admin.groups.add(Group.objects.create(name='Train Admin'))
+        self.vip = Group.objects.create(name='VIP')
+        self.users = [User.objects.create(username=f'user{i}') for i in range(4)]
+        self.users[0].groups.add(self.vip)
+
+        self.schedule = Schedule.objects.create(schedule_no='G1', departure_time='2023-06-01T08:00:00Z')
+        station = Station.objects.create(station_no='S0', name='站点0')
+        carriage = Carriage.objects.create(name='二等座', seat_num=10)
+        contact = Contact.objects.create(name='张三', birthdate='2000-01-01', id_card='110101200001010000', user=self.users[1])
+        Ticket.objects.create(amount=10, seat_no=0, schedule=self.schedule, carriage=carriage,
+                              ori_station=station, dst_station=station, user=self.users[1], contact=contact)
+
+    def headers(self, user):
+        return {'HTTP_JWT': jwt.encode(
+            {'id': user.id, 'expire': (datetime.now() + timedelta(hours=2)).isoformat()},
+            settings.SECRET_KEY,
+        )}
+
+    def send(self, **data):
+        response = self.client.post('/messages/', dict(message='通知', **data),
+                                    content_type='application/json', **self.headers(self.admin)).json()
+        self.assertEqual(response['result'], 0)
+        return Message.objects.latest('id')
+
+    def inbox(self, user):
+        response = self.client.get('/messages/', **self.headers(user)).json()
+        return {message['id']: message['is_read'] for message in response['system_messages']}
+
+    def test_broadcast_is_one_row(self):
+        self.client.get('/messages/', **self.headers(self.admin))
+        with CaptureQueriesContext(connection) as ctx:
+            message = self.send(audience='all')
+        # 广播只写入一行，与用户数无关
+        self.assertEqual(len([query for query in ctx.captured_queries if query['sql'].startswith('INSERT')]), 1)
+        self.assertFalse(message.to_users.exists())
+
+        for user in self.users:
+            self.assertEqual(self.inbox(user), {message.id: False})
+
+    def test_audiences(self):
+        to_role = self.send(audience='role', role='VIP')
+        to_holders = self.send(audience='schedule', schedule_id=self.schedule.id)
+        to_users = self.send(to_users=[self.users[2].id, self.users[2].id, -1])
+
+        self.assertEqual(self.inbox(self.users[0]), {to_role.id: False})
+        self.assertEqual(self.inbox(self.users[1]), {to_holders.id: False})
+        self.assertEqual(self.inbox(self.users[2]), {to_users.id: False})
+        self.assertEqual(self.inbox(self.users[3]), {})
+
+    def test_read_and_delete_state_is_per_user(self):
+        message = self.send(audience='all')
+        reader, remover = self.users[0], self.users[1]
+
+        response = self.client.put(f'/messages/{message.id}', **self.headers(reader)).json()
+        self.assertEqual(response['result'], 0)
+        response = self.client.delete(f'/messages/{message.id}', **self.headers(remover)).json()
+        self.assertEqual(response['result'], 0)
+
+        self.assertEqual(self.inbox(reader), {message.id: True})
+        self.assertEqual(self.inbox(remover), {})
+        self.assertEqual(self.inbox(self.users[2]), {message.id: False})
+        # 只为有过操作的用户保存状态
+        self.assertEqual(MessageState.objects.count(), 2)
+        self.assertTrue(Message.objects.filter(id=message.id).exists())
+
+        # 发送者删除后所有人都看不到
+        self.client.delete(f'/messages/{message.id}', **self.headers(self.admin))
+        self.assertEqual(self.inbox(reader), {})
+
+    def test_inbox_pages(self):
+        reader = self.users[2]
+        messages = Message.objects.bulk_create(Message(message=f'通知{i}', from_user=self.admin) for i in range(25))
+        for message in messages:
+            message.add_receivers([reader.id])
+        # 发送时间相同的消息按编号区分
+        Message.objects.filter(id__in=[message.id for message in messages[5:15]]).update(send_time=messages[5].send_time)
+        self.client.get('/messages/unread', **self.headers(reader))
+
+        seen, cursor, query_counts = [], None, []
+        while True:
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get('/messages/', {'limit': 10, **({'cursor': cursor} if cursor else {})},
+                                           **self.headers(reader)).json()
+            query_counts.append(len(ctx.captured_queries))
+            seen.extend(message['id'] for message in response['system_messages'])
+            self.assertTrue(all(message['from_user'] == 'admin' for message in response['system_messages']))
+            cursor = response['next']
+            if not cursor:
+                break
+
+        expected = Message.objects.order_by('-send_time', '-id').values_list('id', flat=True)
+        self.assertEqual(seen, list(expected))
+        self.assertEqual(len(query_counts), 3)
+        self.assertEqual(len(set(query_counts)), 1)
+
+        response = self.client.get('/messages/', {'cursor': 'bad'}, **self.headers(reader)).json()
+        self.assertEqual(response['result'], 1)
+
+        # 能解码但内容不对的游标
+        for values in ([[], []], [{}, 1], [None, 1], ['2023-06-01', 'x'], ['x', 1], [1]):
+            response = self.client.get('/messages/', {'cursor': encode_cursor(values)}, **self.headers(reader)).json()
+            self.assertEqual(response, {'result': 1, 'message': "分页游标错误"}, values)
+
+    def test_unread_count(self):
+        reader = self.users[0]
+
+        def unread():
+            with CaptureQueriesContext(connection) as ctx:
+                count = self.client.get('/messages/unread', **self.headers(reader)).json()['unread']
+            return count, len([query for query in ctx.captured_queries if 'system_messages_message' in query['sql']])
+
+        self.assertEqual(unread(), (0, 1))
+        self.assertEqual(unread(), (0, 0))
+
+        broadcast = self.send(audience='all')
+        self.send(to_users=[reader.id])
+        self.send(to_users=[self.users[1].id])
+        self.assertEqual(unread(), (2, 1))
+        self.assertEqual(unread(), (2, 0))
+
+        self.client.put(f'/messages/{broadcast.id}', **self.headers(reader))
+        self.assertEqual(unread(), (1, 1))
@@ -3,6 +3,7 @@ from django.urls import path
 from system_messages import views
 
 urlpatterns = [
+    path("unread", views.UnreadCountView.as_view()),
     path("<int:message_id>", views.MessageIdView.as_view()),
     path("", views.MessageView.as_view()),
 ]
@@ -1,10 +1,13 @@
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group
+from django.db import transaction
 from django.shortcuts import render
 from rest_framework.views import APIView
 
-from system_messages.models import Message
+from schedules.models import Schedule
+from system_messages.models import Message, MessageState, get_unread_count, invalidate_unread_counts
 from system_messages.serializers import SentMessageSerializer, ReceivedMessageSerializer
 from utils import json
+from utils.pagination import keyset_page, parse_limit, InvalidPage
 from utils.perm import permission_check
 
 
@@ -15,38 +18,90 @@ class MessageView(APIView):
         is_send = request.query_params.get('send', 'false').lower() == 'true'
 
         if is_send:
-            return json.response({'system_messages': SentMessageSerializer(user.sent_messages.all(), many=True).data})
+            messages, serializer_class = user.sent_messages.prefetch_related('to_users'), SentMessageSerializer
         else:
-            return json.response({'system_messages': ReceivedMessageSerializer(user.received_messages.all(), many=True).data})
+            messages, serializer_class = Message.objects.inbox(user).select_related('from_user'), ReceivedMessageSerializer
+
+        try:
+            page, next_cursor = keyset_page(
+                messages, ['-send_time', '-id'],
+                cursor=request.query_params.get('cursor', None),
+                limit=parse_limit(request.query_params.get('limit', None)),
+            )
+        except InvalidPage as e:
+            return json.response({'result': 1, 'message': str(e)})
+
+        return json.response({'system_messages': serializer_class(page, many=True).data, 'next': next_cursor})
 
     @permission_check(['Train Admin', 'System Admin'], user=True)
     def post(self, request, user):
         message = request.data.get('message', "")
+        audience = request.data.get('audience', Message.USERS)
         to_users = request.data.get('to_users', None)
+        role = request.data.get('role', None)
+        schedule_id = request.data.get('schedule_id', None)
 
-        if not to_users:
-            return json.response({'result': 1, 'message': "消息必须设置接收人"})
+        msg_to_send = Message(message=message, from_user=user, audience=audience)
 
-        msg_to_send = Message(message=message, from_user=user)
+        if audience == Message.USERS:
+            if not to_users:
+                return json.response({'result': 1, 'message': "消息必须设置接收人"})
+        elif audience == Message.ROLE:
+            msg_to_send.audience_role = Group.objects.filter(name=role).first()
+            if not msg_to_send.audience_role:
+                return json.response({'result': 1, 'message': "未找到接收消息的角色"})
+        elif audience == Message.SCHEDULE:
+            msg_to_send.audience_schedule = Schedule.objects.filter(id=schedule_id).first()
+            if not msg_to_send.audience_schedule:
+                return json.response({'result': 1, 'message': "未找到接收消息的行程"})
+        elif audience != Message.ALL:
+            return json.response({'result': 1, 'message': "消息接收范围错误"})
 
-        msg_to_send.save()
+        with transaction.atomic():
+            msg_to_send.save()
 
-        for to_user_id in set(to_users):
-            to_user = User.objects.filter(id=to_user_id).first()
-            if to_user:
-                msg_to_send.to_users.add(to_user)
+            if audience == Message.USERS:
+                msg_to_send.add_receivers(User.objects.filter(id__in=set(to_users)).values_list('id', flat=True))
+            else:
+                invalidate_unread_counts()
 
         return json.response({'result': 0, 'message': "发送消息成功"})
 
 
+class UnreadCountView(APIView):
+    @permission_check(user=True)
+    def get(self, request, user):
+        return json.response({'unread': get_unread_count(user)})
+
+
 class MessageIdView(APIView):
+    @permission_check(user=True)
+    def put(self, request, message_id, user):
+        """
+        mark a received message as read
+        """
+        if not Message.objects.inbox(user).filter(id=message_id).exists():
+            return json.response({'result': 1, 'message': "未找到消息"})
+
+        MessageState.objects.update_or_create(message_id=message_id, user=user, defaults={'is_read': True})
+        invalidate_unread_counts([user.id])
+
+        return json.response({'result': 0, 'message': "消息已读"})
+
     @permission_check(user=True)
     def delete(self, request, message_id, user):
+        """
+        delete a sent message for everyone, or remove a received one from the inbox
+        """
         message = user.sent_messages.filter(id=message_id).first()
 
-        if not message:
+        if message:
+            message.delete()
+            invalidate_unread_counts()
+        elif Message.objects.inbox(user).filter(id=message_id).exists():
+            MessageState.objects.update_or_create(message_id=message_id, user=user, defaults={'is_deleted': True})
+            invalidate_unread_counts([user.id])
+        else:
             return json.response({'result': 1, 'message': "未找到要删除的消息"})
 
-        message.delete()
-
         return json.response({'result': 0, 'message': "消息已删除"})
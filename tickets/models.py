@@ -2,10 +2,11 @@ from datetime import timedelta, datetime
 
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import pre_delete
 from django.utils import timezone
 
 from contacts.models import Contact
-from schedules.models import Schedule, Carriage, Station
+from schedules.models import Schedule, Carriage, Station, ScheduleRoute, ScheduleToCarriage
 
 
 # Create your models here.
@@ -24,6 +25,14 @@ class Ticket(models.Model):
     user = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='tickets')
     contact = models.ForeignKey(to=Contact, on_delete=models.RESTRICT, related_name='tickets')
 
+    class Meta:
+        indexes = [
+            # seat inventory rebuilds, see ScheduleToCarriage.rebuild_seats
+            models.Index(fields=['schedule', 'carriage']),
+            # ticket lists of a user, newest first
+            models.Index(fields=['user', 'create_time']),
+        ]
+
     def is_expired(self):
         return not self.is_paid and (self.create_time + timedelta(days=1)) < timezone.now()
 
@@ -35,3 +44,22 @@ class Ticket(models.Model):
 
     def is_changeable(self):
         return self.is_paid and timezone.now() + timedelta(days=1) < self.schedule.departure_time
+
+    def free_seat(self):
+        """
+        give the legs of this ticket back to the seat inventory of its schedule
+        """
+        route = ScheduleRoute.objects.filter(
+            schedule_id=self.schedule_id, ori_station_id=self.ori_station_id, dst_station_id=self.dst_station_id,
+        ).first()
+
+        if route:
+            ScheduleToCarriage.free_seat(self.schedule_id, self.carriage_id, self.seat_no, route.legs)
+
+
+def _free_seat_of_deleted(sender, instance, **kwargs):
+    # tickets also go with their user or carriage, every delete path has to give the seat back
+    instance.free_seat()
+
+
+pre_delete.connect(_free_seat_of_deleted, sender=Ticket, dispatch_uid='ticket_free_seat')
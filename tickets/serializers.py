@@ -1,17 +1,13 @@
 from rest_framework import serializers
 
 from contacts.serializers import ContactSerializer
-from schedules.models import Carriage, Schedule
+from schedules.catalog import CatalogField
+from schedules.models import Schedule
+from schedules.catalog import station_catalog, carriage_catalog
 from schedules.serializers import StationSerializer
 from tickets.models import Ticket
 
 
-class CarriageSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Carriage
-        fields = ['id', 'name']
-
-
 class ScheduleSerializer(serializers.ModelSerializer):
     departure_station = serializers.SerializerMethodField()
     destination_station = serializers.SerializerMethodField()
@@ -30,10 +26,10 @@ class ScheduleSerializer(serializers.ModelSerializer):
 class TicketSerializer(serializers.ModelSerializer):
     is_expired = serializers.SerializerMethodField()
     schedule = ScheduleSerializer()
-    carriage = CarriageSerializer()
+    carriage = CatalogField(carriage_catalog, fields=['id', 'name'], source='carriage_id')
     contact = ContactSerializer()
-    ori_station = StationSerializer()
-    dst_station = StationSerializer()
+    ori_station = CatalogField(station_catalog, source='ori_station_id')
+    dst_station = CatalogField(station_catalog, source='dst_station_id')
 
     class Meta:
         model = Ticket
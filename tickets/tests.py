@@ -1,422 +1,390 @@
-from audioop import reverse
 import datetime
-from pstats import Stats, StatsProfile
-import statistics
-from telnetlib import STATUS
-from django.test import TestCase
-from psutil import _Status
-from rest_framework.test import APIRequestFactory, APITestCase
-from scipy import stats
+import io
+import random
+
+import jwt
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.core.management import call_command
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection
+from django.test import Client, TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.utils import timezone
 from accounts.models import Account
 from contacts.models import Contact
-from schedules.models import Carriage, Schedule, ScheduleToCarriage, Station
-from views import TicketView
-from models import User, Ticket
+from schedules.models import Carriage, Schedule, ScheduleToCarriage, SeatOccupancy, Station
+from tickets.models import Ticket
 
 # Create your tests here.
-class TicketViewTest(TestCase):
+class SeatInventoryMixin:
+    seat_num = 2
+
     def setUp(self):
-        self.factory = APIRequestFactory()
-        self.view = TicketView.as_view()
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.user.groups.add(Group.objects.create(name='Common User'))
+        self.contact = Contact.objects.create(
+            name='张三', birthdate='2000-01-01', id_card='110101200001010000', user=self.user)
+        self.stations = [Station.objects.create(station_no=f'S{i}', name=f'站点{i}') for i in range(3)]
+        self.carriage = Carriage.objects.create(name='二等座', seat_num=self.seat_num)
+
+        departure_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=3)
+        self.schedule = Schedule.objects.create(schedule_no='G1', departure_time=departure_time)
+        self.schedule.add_stations(
+            [station.id for station in self.stations],
+            [(departure_time + datetime.timedelta(hours=i)).isoformat() for i in range(3)],
+        )
+        self.schedule.add_carriages([self.carriage.id])
+
+        self.headers = {'HTTP_JWT': jwt.encode(
+            {'id': self.user.id, 'expire': (datetime.datetime.now() + datetime.timedelta(hours=2)).isoformat()},
+            settings.SECRET_KEY,
+        )}
+
+    def schedule2carriage(self):
+        return ScheduleToCarriage.objects.get(schedule=self.schedule, carriage=self.carriage)
+
+    def buy(self, ori=0, dst=2, client=None):
+        return (client or self.client).post('/tickets/', {
+            'schedule_id': self.schedule.id,
+            'contact_id': self.contact.id,
+            'carriage_id': self.carriage.id,
+            'ori_station_id': self.stations[ori].id,
+            'dst_station_id': self.stations[dst].id,
+        }, **self.headers).json()
+
+
+class SeatInventoryTest(SeatInventoryMixin, TestCase):
+    def test_buy_until_full(self):
+        self.assertEqual(self.schedule2carriage().get_seat_info(), (2, 0))
+
+        self.assertEqual(self.buy()['result'], 0)
+        self.assertEqual(self.buy()['result'], 0)
+        self.assertEqual(self.buy(), {'result': 1, 'message': "该类座位已满"})
+
+        self.assertEqual(self.schedule2carriage().get_seat_info(), (2, 2))
+        self.assertEqual(Ticket.objects.count(), 2)
+
+    def test_delete_frees_seat(self):
+        ticket_id = self.buy()['ticket_id']
+
+        response = self.client.delete(f'/tickets/{ticket_id}', **self.headers)
+
+        self.assertEqual(response.json()['result'], 0)
+        self.assertEqual(self.schedule2carriage().sold, 0)
+
+    def test_cascade_delete_frees_seat(self):
+        self.buy(0, 1)
+        other = User.objects.create_user(username='otheruser', password='testpassword')
+        contact = Contact.objects.create(name='李四', birthdate='2000-01-01', id_card='110101200001010001', user=other)
+        Ticket.objects.create(
+            amount=1, seat_no=0, schedule=self.schedule, carriage=self.carriage, user=other, contact=contact,
+            ori_station=self.stations[1], dst_station=self.stations[2],
+        )
+        self.schedule2carriage().take_seat(0b10)
+
+        # 删除用户时级联删除的车票同样释放座位
+        self.user.delete()
+
+        self.assertEqual(list(SeatOccupancy.objects.values_list('seat_no', 'legs')), [(0, 0b10)])
+        self.assertEqual(self.schedule2carriage().sold, 1)
+
+        other.delete()
+
+        self.assertEqual(self.schedule2carriage().sold, 0)
+        self.assertFalse(SeatOccupancy.objects.exclude(legs=0).exists())
+
+    def test_rebuild_seat_inventory(self):
+        self.buy()
+        ScheduleToCarriage.objects.update(sold=0, capacity=0)
+        SeatOccupancy.objects.all().delete()
+
+        call_command('rebuild_seat_inventory', stdout=io.StringIO())
+
+        self.assertEqual(self.schedule2carriage().get_seat_info(), (2, 1))
+        self.assertEqual(list(SeatOccupancy.objects.values_list('seat_no', 'legs')), [(0, 0b11)])
+
+    def test_rebuild_missing_seat_inventory(self):
+        self.buy()
+        # 计数字段加入之前保存的车厢组成：容量和已售都为 0，也没有座位占用
+        ScheduleToCarriage.objects.update(sold=0, capacity=0)
+        SeatOccupancy.objects.all().delete()
+        self.assertEqual(self.buy(), {'result': 1, 'message': "该类座位已满"})
+
+        out = io.StringIO()
+        call_command('rebuild_seat_inventory', '--missing', stdout=out)
+
+        self.assertIn("checked 1 ", out.getvalue())
+        self.assertEqual(self.schedule2carriage().get_seat_info(), (2, 1))
+        self.assertEqual(self.buy()['result'], 0)
+
+        # 已有容量的行不再重算
+        out = io.StringIO()
+        call_command('rebuild_seat_inventory', '--missing', stdout=out)
+        self.assertIn("checked 0 ", out.getvalue())
+
+    def test_resell_seat_on_disjoint_legs(self):
+        # 两个座位：第一段和第二段可以共用同一座位
+        self.assertEqual(self.buy(0, 1)['result'], 0)
+        self.assertEqual(self.buy(1, 2)['result'], 0)
+        self.assertEqual(self.buy(0, 2)['result'], 0)
+        self.assertEqual(self.buy(0, 1), {'result': 1, 'message': "该类座位已满"})
+        self.assertEqual(self.buy(1, 2), {'result': 1, 'message': "该类座位已满"})
+
+        seats = Ticket.objects.order_by('id').values_list('seat_no', flat=True)
+        self.assertEqual(list(seats), [0, 0, 1])
+        self.assertEqual(self.schedule2carriage().get_seat_info(), (2, 2))
+
+    def test_free_single_leg(self):
+        first_leg = self.buy(0, 1)['ticket_id']
+        self.buy(1, 2)
 
+        self.client.delete(f'/tickets/{first_leg}', **self.headers)
+
+        self.assertEqual(self.buy(0, 1)['result'], 0)
+        self.assertEqual(Ticket.objects.get(id__gt=first_leg, ori_station=self.stations[0]).seat_no, 0)
+        self.assertEqual(self.schedule2carriage().sold, 1)
+
+
+class TicketViewTest(SeatInventoryMixin, TestCase):
     def test_get_tickets(self):
         # 创建用户和票务数据
-        user = User.objects.create(username='testuser')
-        ticket1 = Ticket.objects.create(user=user, name='Ticket 1')
-        ticket2 = Ticket.objects.create(user=user, name='Ticket 2')
-
-        # 创建 GET 请求对象
-        request = self.factory.get('/tickets/')
-        request.user = user
+        self.buy(0, 1)
+        self.buy(1, 2)
 
-        # 调用视图函数
-        response = self.view(request, user=user)
+        response = self.client.get('/tickets/', **self.headers)
 
         # 断言响应状态码和数据
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data['tickets']), 2)
+        self.assertEqual(len(response.json()['tickets']), 2)
 
     def test_buy_ticket(self):
-        # 创建用户和其他必要的数据
-        user = User.objects.create(username='testuser')
-        contact = Contact.objects.create(user=user, name='Test Contact')
-        schedule = Schedule.objects.create(name='Test Schedule')
-        carriage = Carriage.objects.create(name='Test Carriage')
-        ori_station = Station.objects.create(name='Origin Station')
-        dst_station = Station.objects.create(name='Destination Station')
-        schedule2carriage = ScheduleToCarriage.objects.create(schedule=schedule, carriage=carriage)
-
-        # 创建 POST 请求对象
-        data = {
-            'schedule_id': schedule.id,
-            'contact_id': contact.id,
-            'carriage_id': carriage.id,
-            'ori_station_id': ori_station.id,
-            'dst_station_id': dst_station.id,
-        }
-        request = self.factory.post('/schedules/tickets/', data=data)
-        request.user = user
-
-        # 调用视图函数
-        response = self.view(request, user=user)
+        response = self.buy()
 
-        # 断言响应状态码和数据
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['result'], 0)
-        self.assertEqual(response.data['message'], "订票成功，请支付订单")
+        self.assertEqual(response['result'], 0)
+        self.assertEqual(response['message'], "订票成功，请支付订单")
+        ticket = Ticket.objects.get(id=response['ticket_id'])
+        self.assertEqual((ticket.user, ticket.contact, ticket.is_paid), (self.user, self.contact, False))
+
+    def test_buy_ticket_missing_data(self):
+        response = self.client.post('/tickets/', {'schedule_id': self.schedule.id}, **self.headers).json()
+
+        self.assertEqual(response, {'result': 1, 'message': "需要包含行程、联系人、座位类型和起终站点信息"})
 
-class TicketIdViewTest(APITestCase):
+
+class TicketIdViewTest(SeatInventoryMixin, TestCase):
     def setUp(self):
-        # Create a test user and authenticate
-        self.user = User.objects.create_user(username='testuser', password='testpassword')
-        self.client.force_authenticate(user=self.user)
+        super().setUp()
+        self.ticket = Ticket.objects.get(id=self.buy()['ticket_id'])
+
+    def account(self, amount):
+        return Account.objects.create(name='Test Account', card_id='1234567890', amount=amount, user=self.user)
+
+    def other_ticket(self):
+        other = User.objects.create_user(username='anotheruser', password='testpassword')
+        contact = Contact.objects.create(name='李四', birthdate='2000-01-01', id_card='110101200001010001', user=other)
+        return Ticket.objects.create(amount=200, seat_no=1, schedule=self.schedule, carriage=self.carriage,
+                                     ori_station=self.stations[0], dst_station=self.stations[2],
+                                     user=other, contact=contact)
 
-        # Create a test ticket
-        self.ticket = Ticket.objects.create(amount=100, seat_no=1, user=self.user)
+    def request(self, method, ticket_id, data=None):
+        return getattr(self.client, method)(f'/tickets/{ticket_id}', data or {}, content_type='application/json',
+                                            **self.headers).json()
+
+    def pay(self, ticket_id, amount=200):
+        return self.request('patch', ticket_id, {'account_id': self.account(amount).id})
 
     def test_get_ticket(self):
-        # Send GET request to retrieve the ticket
-        url = reverse('schedules\tickets\id', args=[self.ticket.id])
-        response = self.client.get(url)
+        response = self.request('get', self.ticket.id)
 
-        # Verify the response
-        self.assertEqual(response.status_code, statistics.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 0)
-        self.assertEqual(response.data['message'], "Success")
-        self.assertEqual(response.data['ticket']['id'], self.ticket.id)
-        # Add more assertions to verify other fields of the ticket
+        self.assertEqual(response['id'], self.ticket.id)
+        self.assertEqual(response['seat_no'], self.ticket.seat_no)
 
     def test_get_nonexistent_ticket(self):
-        # Send GET request with a non-existent ticket ID
-        url = reverse('schedules\tickets\id', args=[9999])
-        response = self.client.get(url)
-
-        # Verify the response
-        self.assertEqual(response.status_code, Stats.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "车票未找到")
+        self.assertEqual(self.request('get', 9999), {'result': 1, 'message': "车票未找到"})
 
     def test_get_ticket_unauthorized(self):
-        # Create a new ticket with a different user
-        another_user = User.objects.create_user(username='anotheruser', password='testpassword')
-        ticket = Ticket.objects.create(amount=200, seat_no=2, user=another_user)
+        # 其他用户的车票
+        self.assertEqual(self.request('get', self.other_ticket().id), {'result': 1, 'message': "车票未找到"})
+
+    def new_schedule(self):
+        departure_time = self.schedule.departure_time + datetime.timedelta(hours=2)
+        schedule = Schedule.objects.create(schedule_no='G2', departure_time=departure_time)
+        schedule.add_stations(
+            [station.id for station in self.stations],
+            [(departure_time + datetime.timedelta(hours=i)).isoformat() for i in range(3)],
+        )
+        schedule.add_carriages([self.carriage.id])
+        return schedule
 
-        # Send GET request to retrieve the ticket using unauthorized user
-        url = reverse('schedules\tickets\id', args=[ticket.id])
-        response = self.client.get(url)
+    def test_change_ticket(self):
+        self.pay(self.ticket.id)
+        new_schedule = self.new_schedule()
 
-        # Verify the response
-        self.assertEqual(response.status_code, StatsProfile.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "车票未找到")
+        response = self.request('put', self.ticket.id, {'new_schedule_id': new_schedule.id, 'carriage_id': self.carriage.id})
 
-    def test_change_ticket(self):
-        # Prepare request data for ticket change
-        new_schedule_id = 2
-        carriage_id = 3
-        data = {
-            'new_schedule_id': new_schedule_id,
-            'carriage_id': carriage_id,
-        }
-
-        # Send PUT request to change the ticket
-        url = reverse('/schedules/tickets/<id>', args=[self.ticket.id])
-        response = self.client.put(url, data=data)
-
-        # Verify the response
-        self.assertEqual(response.status_code, _Status.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 0)
-        self.assertEqual(response.data['message'], "车票已改签")
-        # Add more assertions to verify the updated ticket details
+        self.assertEqual(response, {'result': 0, 'message': "车票已改签"})
+        self.ticket.refresh_from_db()
+        self.assertEqual((self.ticket.schedule, self.ticket.is_paid), (new_schedule, False))
+        # 原行程的座位已释放
+        self.assertEqual(self.schedule2carriage().get_seat_info(), (2, 0))
 
     def test_change_ticket_invalid_data(self):
-        # Send PUT request with invalid request data
-        data = {}
+        response = self.request('put', self.ticket.id)
 
-        url = reverse('/schedules/tickets/<id>', args=[self.ticket.id])
-        response = self.client.put(url, data=data)
-
-        # Verify the response
-        self.assertEqual(response.status_code, _Status.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "改签必须指定目标车票和座位号")
+        self.assertEqual(response, {'result': 1, 'message': "改签必须指定目标车票和座位号"})
 
     def test_change_nonexistent_ticket(self):
-        # Send PUT request with a non-existent ticket ID
-        new_schedule_id = 2
-        carriage_id = 3
-        data = {
-            'new_schedule_id': new_schedule_id,
-            'carriage_id': carriage_id,
-        }
-
-        url = reverse('/schedules/tickets/<id>', args=[9999])
-        response = self.client.put(url, data=data)
-
-        # Verify the response
-        self.assertEqual(response.status_code, _Status.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "车票未找到")
-
-    def test_change_ticket_unauthorized(self):
-        # Create a new ticket with a different user
-        another_user = User.objects.create_user(username='anotheruser', password='testpassword')
-        ticket = Ticket.objects.create(amount=200, seat_no=2, user=another_user)
-
-        # Prepare request data for ticket change
-        new_schedule_id = 2
-        carriage_id = 3
-        data = {
-            'new_schedule_id': new_schedule_id,
-            'carriage_id': carriage_id,
-        }
-
-        # Send PUT request to change the ticket using unauthorized user
-        url = reverse('/schedules/tickets/<id>', args=[ticket.id])
-        response = self.client.put(url, data=data)
-
-        # Verify the response
-        self.assertEqual(response.status_code, _Status.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "车票未找到")
+        new_schedule = self.new_schedule()
 
-    def test_pay_for_ticket(self):
-        # Create a test account for payment
-        account = Account.objects.create(user=self.user, amount=200)
+        response = self.request('put', 9999, {'new_schedule_id': new_schedule.id, 'carriage_id': self.carriage.id})
 
-        # Prepare request data for ticket payment
-        account_id = account.id
-        data = {
-            'account_id': account_id,
-        }
+        self.assertEqual(response, {'result': 1, 'message': "车票未找到"})
 
-        # Send PATCH request to pay for the ticket
-        url = reverse('/schedules/tickets/<id>', args=[self.ticket.id])
-        response = self.client.patch(url, data=data)
+    def test_change_ticket_unauthorized(self):
+        new_schedule = self.new_schedule()
 
-        # Verify the response
-        self.assertEqual(response.status_code, STATUS.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 0)
-        self.assertEqual(response.data['message'], "车票订单支付成功")
-        # Add more assertions to verify the updated ticket and account details
+        response = self.request('put', self.other_ticket().id,
+                                {'new_schedule_id': new_schedule.id, 'carriage_id': self.carriage.id})
 
-    def test_pay_for_ticket_invalid_data(self):
-        # Send PATCH request with invalid request data
-        data = {}
+        self.assertEqual(response, {'result': 1, 'message': "车票未找到"})
 
-        url = reverse('/schedules/tickets/<id>', args=[self.ticket.id])
-        response = self.client.patch(url, data=data)
+    def test_pay_for_ticket(self):
+        account = self.account(self.ticket.amount + 50)
 
-        # Verify the response
-        self.assertEqual(response.status_code, STATUS.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "必须选择支付账户")
+        response = self.request('patch', self.ticket.id, {'account_id': account.id})
 
-    def test_pay_for_nonexistent_ticket(self):
-        # Send PATCH request with a non-existent ticket ID
-        account_id = 1
-        data = {
-            'account_id': account_id,
-        }
+        self.assertEqual(response, {'result': 0, 'message': "车票订单支付成功"})
+        account.refresh_from_db()
+        self.ticket.refresh_from_db()
+        self.assertEqual(account.amount, 50)
+        self.assertTrue(self.ticket.is_paid)
 
-        url = reverse('/schedules/tickets/<id>', args=[9999])
-        response = self.client.patch(url, data=data)
+    def test_pay_for_ticket_invalid_data(self):
+        self.assertEqual(self.request('patch', self.ticket.id), {'result': 1, 'message': "必须选择支付账户"})
 
-        # Verify the response
-        self.assertEqual(response.status_code, STATUS.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "未找到要支付的车票")
+    def test_pay_for_nonexistent_ticket(self):
+        self.assertEqual(self.pay(9999), {'result': 1, 'message': "未找到要支付的车票"})
 
     def test_pay_for_paid_ticket(self):
         # Mark the ticket as already paid
         self.ticket.is_paid = True
         self.ticket.save()
 
-        # Create a test account for payment
-        account = Account.objects.create(user=self.user, amount=200)
-
-        # Prepare request data for ticket payment
-        account_id = account.id
-        data = {
-            'account_id': account_id,
-        }
-
-        # Send PATCH request to pay for the ticket
-        url = reverse('/schedules/tickets/<id>', args=[self.ticket.id])
-        response = self.client.patch(url, data=data)
-
-        # Verify the response
-        self.assertEqual(response.status_code, STATUS.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "车票已支付")
+        self.assertEqual(self.pay(self.ticket.id), {'result': 1, 'message': "车票已支付"})
 
     def test_pay_for_modified_ticket(self):
         # Mark the ticket as having modified schedule
         self.ticket.is_schedule_modified = True
         self.ticket.save()
 
-        # Create a test account for payment
-        account = Account.objects.create(user=self.user, amount=200)
-
-        # Prepare request data for ticket payment
-        account_id = account.id
-        data = {
-            'account_id': account_id,
-        }
-
-        # Send PATCH request to pay for the ticket
-        url = reverse('/schedules/tickets/<id>', args=[self.ticket.id])
-        response = self.client.patch(url, data=data)
-
-        # Verify the response
-        self.assertEqual(response.status_code, STATUS.HTTP_200)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "所购列车行程已更改，请重新购票")
+        self.assertEqual(self.pay(self.ticket.id), {'result': 1, 'message': "所购列车行程已更改，请重新购票"})
 
     def test_pay_for_expired_ticket(self):
         # Expire the ticket
-        self.ticket.create_time = datetime.now() - datetime.timedelta(days=2)
+        self.ticket.create_time = timezone.now() - datetime.timedelta(days=2)
         self.ticket.save()
 
-        # Create a test account for payment
-        account = Account.objects.create(user=self.user, amount=200)
-
-        # Prepare request data for ticket payment
-        account_id = account.id
-        data = {
-            'account_id': account_id,
-        }
-
-        # Send PATCH request to pay for the ticket
-        url = reverse('/schedules/tickets/<id>', args=[self.ticket.id])
-        response = self.client.patch(url, data=data)
-
-        # Verify the response
-        self.assertEqual(response.status_code, STATUS.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "车票订单已过期，请删除订单")
+        self.assertEqual(self.pay(self.ticket.id), {'result': 1, 'message': "车票订单已过期，请删除订单"})
 
     def test_pay_with_insufficient_balance(self):
-        # Create a test account with insufficient balance for payment
-        account = Account.objects.create(user=self.user, amount=50)
+        response = self.pay(self.ticket.id, amount=self.ticket.amount - 1)
 
-        # Prepare request data for ticket payment
-        account_id = account.id
-        data = {
-            'account_id': account_id,
-        }
+        self.assertEqual(response, {'result': 1, 'message': "账户余额不足"})
+        self.ticket.refresh_from_db()
+        self.assertFalse(self.ticket.is_paid)
 
-        # Send PATCH request to pay for the ticket
-        url = reverse('/schedules/tickets/<id>', args=[self.ticket.id])
-        response = self.client.patch(url, data=data)
+    def test_delete_unpaid_ticket_order(self):
+        self.assertEqual(self.request('delete', self.ticket.id), {'result': 0, 'message': "订单已删除"})
+        self.assertFalse(Ticket.objects.filter(id=self.ticket.id).exists())
+        self.assertEqual(self.schedule2carriage().get_seat_info(), (2, 0))
 
-        # Verify the response
-        self.assertEqual(response.status_code, STATUS.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "账户余额不足")
+    def test_delete_paid_ticket(self):
+        self.pay(self.ticket.id, amount=self.ticket.amount)
+        account = self.account(0)
 
-    def test_delete_unpaid_ticket_order(self):
-        # Send DELETE request to delete an unpaid ticket order
-        url = reverse('/schedules/tickets/<id>', args=[self.ticket.id])
-        response = self.client.delete(url)
+        response = self.request('delete', self.ticket.id, {'account_id': account.id})
 
-        # Verify the response
-        self.assertEqual(response.status_code, STATUS.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 0)
-        self.assertEqual(response.data['message'], "订单已删除")
-        # Add more assertions to verify that the ticket is deleted
+        # 退款到选择的账户
+        self.assertEqual(response, {'result': 0, 'message': "订单已取消"})
+        account.refresh_from_db()
+        self.assertEqual(account.amount, self.ticket.amount)
+        self.assertFalse(Ticket.objects.filter(id=self.ticket.id).exists())
 
-    def test_delete_paid_ticket(self):
-        # Mark the ticket as paid
-        self.ticket.is_paid = True
-        self.ticket.save()
+    def test_delete_paid_ticket_no_account_selected(self):
+        self.pay(self.ticket.id)
 
-        # Send DELETE request to cancel a paid ticket
-        account = Account.objects.create(user=self.user, amount=200)
-        account_id = account.id
-        data = {
-            'account_id': account_id,
-        }
+        self.assertEqual(self.request('delete', self.ticket.id), {'result': 1, 'message': "取消车票必须选择退款账户"})
 
-        url = reverse('/schedules/tickets/<id>', args=[self.ticket.id])
-        response = self.client.delete(url, data=data)
+    def test_delete_nonexistent_ticket(self):
+        self.assertEqual(self.request('delete', 9999, {'account_id': 1}), {'result': 1, 'message': "订单未找到"})
 
-        # Verify the response
-        self.assertEqual(response.status_code, STATUS.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 0)
-        self.assertEqual(response.data['message'], "订单已取消")
-        # Add more assertions to verify the refunded amount and updated account details
+    def test_delete_uncancelable_ticket(self):
+        # 已支付且距离发车不足一小时
+        self.pay(self.ticket.id)
+        self.schedule.departure_time = timezone.now() + datetime.timedelta(minutes=30)
+        self.schedule.save()
 
-    def test_delete_paid_ticket_no_account_selected(self):
-        # Mark the ticket as paid
-        self.ticket.is_paid = True
+        self.assertEqual(self.request('delete', self.ticket.id, {'account_id': self.account(0).id}),
+                         {'result': 1, 'message': "订单不可取消"})
+
+    def test_delete_expired_ticket(self):
+        # 过期未支付的订单可以直接删除
+        self.ticket.create_time = timezone.now() - datetime.timedelta(days=2)
         self.ticket.save()
 
-        # Send DELETE request to cancel a paid ticket without selecting an account
-        data = {}
+        self.assertEqual(self.request('delete', self.ticket.id), {'result': 0, 'message': "订单已删除"})
 
-        url = reverse('/schedules/tickets/<id>', args=[self.ticket.id])
-        response = self.client.delete(url, data=data)
 
-        # Verify the response
-        self.assertEqual(response.status_code, STATUS.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "取消车票必须选择退款账户")
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentPurchaseTest(SeatInventoryMixin, TransactionTestCase):
+    """
+    sqlite locks whole tables and fails concurrent writers instead of making them wait,
+    the row lock in take_seat is only exercised on a database that has one
+    """
+    seat_num = 20
+    purchase_num = 300
 
-    def test_delete_nonexistent_ticket(self):
-        # Send DELETE request with a non-existent ticket ID
-        account_id = 1
-        data = {
-            'account_id': account_id,
-        }
-
-        url = reverse('/schedules/tickets/<id>', args=[9999])
-        response = self.client.delete(url, data=data)
-
-        # Verify the response
-        self.assertEqual(response.status_code, STATUS.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "订单未找到")
-
-    def test_delete_unmodifiable_ticket(self):
-        # Mark the ticket as unmodifiable
-        self.ticket.is_schedule_modified = True
-        self.ticket.save()
+    def buy_in_thread(self, ori, dst):
+        try:
+            return self.buy(ori, dst, client=Client())
+        finally:
+            connection.close()
 
-        # Send DELETE request to delete an unmodifiable ticket
-        url = reverse('/schedules/tickets/<id>', args=[self.ticket.id])
-        response = self.client.delete(url)
+    def buy_concurrently(self, spans):
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(lambda span: self.buy_in_thread(*span), spans))
 
-        # Verify the response
-        self.assertEqual(response.status_code, STATUS.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "订单不可删除")
+        # 除座位已满外不能有其它失败
+        for result in results:
+            if result['result'] != 0:
+                self.assertEqual(result['message'], "该类座位已满")
+        return results
 
-    def test_delete_uncancelable_ticket(self):
-        # Mark the ticket as uncancelable
-        self.ticket.is_schedule_modified = False
-        self.ticket.is_paid = False
-        self.ticket.save()
+    def test_no_oversell(self):
+        results = self.buy_concurrently([(0, 2)] * self.purchase_num)
 
-        # Send DELETE request to delete an uncancelable ticket
-        url = reverse('/schedules/tickets/<id>', args=[self.ticket.id])
-        response = self.client.delete(url)
+        # 恰好卖出全部座位，每个座位只卖一次
+        self.assertEqual(sum(result['result'] == 0 for result in results), self.seat_num)
+        self.assertEqual(sorted(Ticket.objects.values_list('seat_no', flat=True)), list(range(self.seat_num)))
+        self.assertEqual(self.schedule2carriage().get_seat_info(), (self.seat_num, self.seat_num))
 
-        # Verify the response
-        self.assertEqual(response.status_code, STATUS.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "订单不可取消")
+    def test_no_duplicate_seats(self):
+        rand = random.Random(0)
+        spans = [rand.choice([(0, 1), (1, 2), (0, 2)]) for _ in range(self.purchase_num)]
 
-    def test_delete_expired_ticket(self):
-        # Expire the ticket
-        self.ticket.create_time = datetime.now() - datetime.timedelta(days=2)
-        self.ticket.save()
+        results = self.buy_concurrently(spans)
+
+        self.assertEqual(sum(result['result'] == 0 for result in results), Ticket.objects.count())
 
-        # Send DELETE request to delete an expired ticket
-        url = reverse('/schedules/tickets/<id>', args=[self.ticket.id])
-        response = self.client.delete(url)
+        # 同一座位上的车票不能占用相同的区段
+        legs_of_seat = {}
+        for ticket in Ticket.objects.select_related('ori_station', 'dst_station'):
+            legs = self.schedule.get_route(ticket.ori_station, ticket.dst_station).legs
+            self.assertLess(ticket.seat_no, self.seat_num)
+            self.assertFalse(legs_of_seat.get(ticket.seat_no, 0) & legs)
+            legs_of_seat[ticket.seat_no] = legs_of_seat.get(ticket.seat_no, 0) | legs
 
-        # Verify the response
-        self.assertEqual(response.status_code, STATUS.HTTP_200_OK)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "订单已过期，请删除订单")
\ No newline at end of file
+        self.assertEqual(dict(SeatOccupancy.objects.exclude(legs=0).values_list('seat_no', 'legs')), legs_of_seat)
+        self.assertEqual(self.schedule2carriage().sold, len(legs_of_seat))
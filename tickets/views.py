@@ -46,21 +46,18 @@ class TicketView(APIView):
         if not ori_station or not dst_station:
             return json.response({'result': 1, 'message': "未找到起终站点"})
         
-        if not schedule2carriage.schedule.is_option_schedule(ori_station, dst_station):
+        route = schedule2carriage.schedule.get_route(ori_station, dst_station)
+
+        if not route:
             return json.response({'result': 1, 'message': "该行程和起终站点不匹配"})
 
         with transaction.atomic():  # must guarantee that tickets number won't change after check
-            max_seat, now_seat = schedule2carriage.get_seat_info()
-
-            if now_seat >= max_seat:
-                return json.response({'result': 1, 'message': "该类座位已满"})
-
             contact = user.contacts.filter(id=contact_id).first()
 
             if not contact:
                 return json.response({'result': 1, 'message': "未找到联系人"})
 
-            amount = schedule2carriage.calc_cost(ori_station, dst_station)
+            amount = schedule2carriage.calc_cost(ori_station, dst_station, route)
 
             if only_get_price:
                 if amount is not None:
@@ -68,9 +65,14 @@ class TicketView(APIView):
                 else:
                     return json.response({'result': 1, 'message': "获得金额失败", 'price': amount})
 
+            seat_no = schedule2carriage.take_seat(route.legs)
+
+            if seat_no is None:
+                return json.response({'result': 1, 'message': "该类座位已满"})
+
             ticket = Ticket(
                 amount=amount,
-                seat_no=now_seat,
+                seat_no=seat_no,
                 schedule=schedule2carriage.schedule,
                 carriage=schedule2carriage.carriage,
                 contact=contact,
@@ -120,22 +122,26 @@ class TicketIdView(APIView):
         if not ticket.is_schedule_modified and not ticket.is_changeable():
             return json.response({'result': 1, 'message': "该车票不可改签"})
 
-        if not new_schedule2carriage.schedule.is_option_schedule(ticket.ori_station, ticket.dst_station):
+        new_route = new_schedule2carriage.schedule.get_route(ticket.ori_station, ticket.dst_station)
+
+        if not new_route:
             return json.response({'result': 1, 'message': "改签行程必须和原行程起始点相同"})
 
         if ticket.schedule and new_schedule2carriage.schedule.departure_time > ticket.schedule.departure_time + timedelta(hours=24):
             return json.response({'result': 1, 'message': "改签的新时间不能超过原始时间的24小时"})
 
         with transaction.atomic():  # must guarantee that tickets number won't change after check
-            max_seat, now_seat = new_schedule2carriage.get_seat_info()
+            amount = new_schedule2carriage.calc_cost(ticket.ori_station, ticket.dst_station, new_route)
+
+            seat_no = new_schedule2carriage.take_seat(new_route.legs)
 
-            if now_seat >= max_seat:
+            if seat_no is None:
                 return json.response({'result': 1, 'message': "该类座位已满"})
 
-            amount = new_schedule2carriage.calc_cost(ticket.ori_station, ticket.dst_station)
+            ticket.free_seat()
 
             ticket.create_time = timezone.now()
-            ticket.seat_no = now_seat
+            ticket.seat_no = seat_no
             ticket.schedule = new_schedule2carriage.schedule
             ticket.carriage = new_schedule2carriage.carriage
             ticket.is_schedule_modified = False
@@ -200,7 +206,9 @@ class TicketIdView(APIView):
             return json.response({'result': 1, 'message': "订单未找到"})
         
         if ticket.is_deletable():
-            ticket.delete()
+            # the seat is given back by the pre_delete handler of Ticket
+            with transaction.atomic():
+                ticket.delete()
             return json.response({'result': 0, 'message': "订单已删除"})
 
         if ticket.is_cancelable():
@@ -212,9 +220,10 @@ class TicketIdView(APIView):
             if not account:
                 return json.response({'result': 1, 'message': "未找到账户"})
             
-            account.amount += ticket.amount
-            account.save()
-            ticket.delete()
+            with transaction.atomic():
+                account.amount += ticket.amount
+                account.save()
+                ticket.delete()
 
             return json.response({'result': 0, 'message': "订单已取消"})
 
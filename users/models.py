@@ -1,3 +1,15 @@
+from django.contrib.auth.models import User
 from django.db import models
 
+
 # Create your models here.
+class RoleVersion(models.Model):
+    """
+    bumped whenever the groups of a user change, tokens carrying an older version must not be trusted for roles
+    """
+    user = models.OneToOneField(to=User, on_delete=models.CASCADE, related_name='role_version')
+    version = models.IntegerField(default=0)
+
+    @staticmethod
+    def bump(user_id):
+        RoleVersion.objects.filter(user_id=user_id).update(version=models.F('version') + 1)
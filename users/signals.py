@@ -0,0 +1,34 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import m2m_changed
+
+from users.models import RoleVersion
+from utils.perm import invalidate_user
+
+
+def _groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    tokens carry the role names of their user, so whoever changes groups (views, the admin, a shell)
+    bumps the RoleVersion of the users concerned and drops them from the permission cache
+    """
+    if action == 'pre_clear' and reverse:
+        # group.user_set.clear() gives no ids afterwards
+        instance._cleared_user_ids = list(instance.user_set.values_list('id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        user_ids = [instance.pk]
+    elif action == 'post_clear':
+        user_ids = instance.__dict__.pop('_cleared_user_ids', [])
+    else:
+        user_ids = list(pk_set)
+
+    for user_id in user_ids:
+        RoleVersion.bump(user_id)
+        # after the commit, a request reading the groups meanwhile would cache the old ones again
+        transaction.on_commit(lambda user_id=user_id: invalidate_user(user_id))
+
+
+m2m_changed.connect(_groups_changed, sender=User.groups.through, dispatch_uid='users_groups_changed')
@@ -1,15 +1,40 @@
-from audioop import reverse
 import datetime
-import mailbox
+import json
+import socketserver
+import tempfile
+import threading
+from unittest.mock import patch
 from django.conf import settings
-from django.test import TestCase
+from django.core import mail
+from django.core.cache import caches
+from django.core.mail import get_connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
 from datetime import timedelta
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Group, User
 import jwt
-from rest_framework.test import APIClient, APIRequestFactory
-
-from users.views import UserIdView, UserView, get_current_user
+from rest_framework.test import APIRequestFactory
+
+import utils.mail
+from jobs.models import Job
+from jobs.queue import run_pending
+from users.models import RoleVersion
+from utils.mail import ConnectionPool, build_mail
+from utils.perm import get_user_and_roles, permission_check
 # Create your tests here.
+def login_headers(user):
+    return {'HTTP_JWT': jwt.encode(
+        {'id': user.id, 'expire': (datetime.datetime.now() + timedelta(hours=2)).isoformat()},
+        settings.SECRET_KEY,
+    )}
+
+
+def system_admin():
+    admin = User.objects.create_user(username='admin', password='admin123')
+    admin.groups.add(Group.objects.get_or_create(name='System Admin')[0])
+    return admin
+
+
 class StartRegisterTestCase(TestCase):
     def test_start_register(self):
         # 准备测试数据
@@ -17,7 +42,7 @@ class StartRegisterTestCase(TestCase):
         passwd = 'testpassword'
         email = 'test@example.com'
         host = 'localhost'
-        
+
         # 模拟请求数据
         request_data = {
             'name': name,
@@ -27,84 +52,69 @@ class StartRegisterTestCase(TestCase):
         }
 
         # 发送请求
-        url = reverse('/users/register')  # 假设URL名称为'start-register'
-        response = self.client.post(url, data=request_data)
-
-        # 验证响应的状态码
-        self.assertEqual(response.status_code, 200)
-
-        # 验证用户是否被成功创建
-        self.assertTrue(User.objects.filter(username=name).exists())
-
-        # 验证邮件发送是否成功
-        self.assertEqual(len(mailbox.outbox), 1)
-        self.assertEqual(mailbox.outbox[0].subject, '畅游中国用户注册')
-        self.assertEqual(mailbox.outbox[0].to, [email])
+        response = self.client.post('/users/register', data=request_data)
 
         # 验证响应数据
         expected_data = {'result': 0, 'message': "已发送认证邮件"}
         self.assertJSONEqual(response.content, expected_data)
 
+        # 用户在认证之后才创建
+        self.assertFalse(User.objects.filter(username=name).exists())
+
+        # 验证邮件发送是否成功
+        run_pending()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, '畅游中国用户注册')
+        self.assertEqual(mail.outbox[0].to, [email])
+        self.assertIn(f"http://{host}:8000/users/register/", mail.outbox[0].alternatives[0][0])
+
         # 验证已存在用户无法再次注册
-        user_exists_response = self.client.post(url, data=request_data)
+        User.objects.create_user(username=name, email='other@example.com', password=passwd)
+        user_exists_response = self.client.post('/users/register', data=request_data)
         expected_error_data = {'result': 1, 'message': "用户名已被注册"}
         self.assertJSONEqual(user_exists_response.content, expected_error_data)
 
-    def test_verify_register(self):
-        # 准备测试数据
-        name = 'testuser'
-        passwd = 'testpassword'
-        email = 'test@example.com'
-        expire = (datetime.now() + datetime.timedelta(hours=2)).isoformat()
+    def verify(self, name, email, expire):
         code = jwt.encode(
             {
                 'name': name,
-                'passwd': passwd,
+                'passwd': 'testpassword',
                 'email': email,
-                'expire': expire
+                'expire': expire.isoformat()
             },
             settings.SECRET_KEY,
         )
+        return self.client.get(f"/users/register/{code}")
 
-        # 构造URL
-        url = f"/users/register/{code}"
-        # 发送GET请求
-        response = self.client.get(url)
+    def test_verify_register(self):
+        # 准备测试数据
+        name = 'testuser'
+        email = 'test@example.com'
+        expire = datetime.datetime.now() + timedelta(hours=2)
 
-        # 验证响应的状态码
-        self.assertEqual(response.status_code, 200)
+        response = self.verify(name, email, expire)
+        self.assertContains(response, "注册成功！")
 
         # 验证用户是否被成功创建
-        self.assertTrue(User.objects.filter(username=name, email=email).exists())
+        user = User.objects.get(username=name, email=email)
+        self.assertTrue(user.check_password('testpassword'))
+        self.assertEqual(list(user.groups.values_list('name', flat=True)), ['Common User'])
 
         # 验证已注册的邮箱无法再次注册
-        existing_email_response = self.client.get(url)
-        self.assertEqual(existing_email_response.status_code, 200)
-        self.assertContains(existing_email_response, "用户已被注册")
+        self.assertContains(self.verify(name, email, expire), "用户已被注册")
 
         # 验证已过期的认证码无法注册
-        expired_code = jwt.encode(
-            {
-                'name': 'expireduser',
-                'passwd': 'expiredpassword',
-                'email': 'expired@example.com',
-                'expire': (datetime.now() - timedelta(hours=2)).isoformat()
-            },
-            settings.SECRET_KEY,
-        )
-        expired_code_url = reverse(f"/users/register/{code}", args=[expired_code])
-        expired_response = self.client.get(expired_code_url)
-        self.assertEqual(expired_response.status_code, 200)
+        expired_response = self.verify('expireduser', 'expired@example.com', datetime.datetime.now() - timedelta(hours=2))
         self.assertContains(expired_response, "认证已过期")
+        self.assertFalse(User.objects.filter(username='expireduser').exists())
+
 
 class LoginTestCase(TestCase):
     def setUp(self):
-        self.client = APIClient()
-
-    def test_login_with_valid_credentials(self):
         # 创建一个用户对象
-        user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
 
+    def test_login_with_valid_credentials(self):
         # 构建登录请求数据
         data = {
             'name': 'testuser',
@@ -113,26 +123,27 @@ class LoginTestCase(TestCase):
         }
 
         # 发送登录请求
-        response = self.client.post(reverse('/users/login'), data, format='json')
+        response = self.client.post('/users/login', data).json()
 
-        # 断言响应状态码和返回结果
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['result'], 0)
-        self.assertEqual(response.data['message'], "登陆成功")
+        # 断言返回结果
+        self.assertEqual(response['result'], 0)
+        self.assertEqual(response['message'], "登陆成功")
 
         # 验证JWT令牌
-        decoded_token = jwt.decode(response.data['jwt'], settings.SECRET_KEY, algorithms=['HS256'])
-        self.assertEqual(decoded_token['id'], user.id)
+        decoded_token = jwt.decode(response['jwt'], settings.SECRET_KEY, algorithms=['HS256'])
+        self.assertEqual(decoded_token['id'], self.user.id)
 
         # 验证令牌过期时间
-        expire = datetime.fromisoformat(decoded_token['expire'])
-        expected_expire = datetime.now() + timedelta(hours=2)
+        expire = datetime.datetime.fromisoformat(decoded_token['expire'])
+        expected_expire = datetime.datetime.now() + timedelta(hours=2)
         self.assertAlmostEqual(expire, expected_expire, delta=timedelta(seconds=5))
 
-    def test_login_with_invalid_credentials(self):
-        # 创建一个用户对象
-        User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
+    def test_login_with_email(self):
+        response = self.client.post('/users/login', {'email': 'test@example.com', 'passwd': 'testpassword'}).json()
 
+        self.assertEqual(response['result'], 0)
+
+    def test_login_with_invalid_credentials(self):
         # 构建登录请求数据（密码错误）
         data = {
             'name': 'testuser',
@@ -140,13 +151,9 @@ class LoginTestCase(TestCase):
             'passwd': 'incorrectpassword'
         }
 
-        # 发送登录请求
-        response = self.client.post(reverse('/users/login'), data, format='json')
+        response = self.client.post('/users/login', data).json()
 
-        # 断言响应状态码和返回结果
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "密码不正确")
+        self.assertEqual(response, {'result': 1, 'message': "密码不正确"})
 
     def test_login_with_invalid_user(self):
         # 构建登录请求数据（用户不存在）
@@ -156,37 +163,28 @@ class LoginTestCase(TestCase):
             'passwd': 'testpassword'
         }
 
-        # 发送登录请求
-        response = self.client.post(reverse('/users/login'), data, format='json')
+        response = self.client.post('/users/login', data).json()
+
+        self.assertEqual(response, {'result': 1, 'message': "未找到用户，请检查邮箱或用户名是否正确"})
 
-        # 断言响应状态码和返回结果
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "未找到用户，请检查邮箱或用户名是否正确")
 
 class UserViewTestCase(TestCase):
     def setUp(self):
-        self.factory = APIRequestFactory()
+        self.headers = login_headers(system_admin())
 
     def test_get_users(self):
         # Create some test users
-        user1 = User.objects.create(username='user1', email='user1@example.com')
-        user2 = User.objects.create(username='user2', email='user2@example.com')
-
-        # Create a GET request
-        request = self.factory.get('/users/')
+        User.objects.create(username='user1', email='user1@example.com')
+        User.objects.create(username='user2', email='user2@example.com')
 
-        # Instantiate the UserView and call the get method
-        view = UserView.as_view()
-        response = view(request)
+        response = self.client.get('/users/', **self.headers)
 
         # Assert the response status code and data
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data['users']), 2)
+        self.assertEqual([user['username'] for user in response.json()['users']], ['admin', 'user1', 'user2'])
 
-        # Clean up the test users
-        user1.delete()
-        user2.delete()
+        response = self.client.get('/users/', {'name': 'user', 'role': 'System Admin'}, **self.headers)
+        self.assertEqual(response.json()['users'], [])
 
     def test_add_user(self):
         # Create a POST request with user data
@@ -196,31 +194,28 @@ class UserViewTestCase(TestCase):
             'email': 'newuser@example.com',
             'role': ['Common User', 'Train Admin'],
         }
-        request = self.factory.post('/users/', data)
+        response = self.client.post('/users/', data, content_type='application/json', **self.headers)
 
-        # Instantiate the UserView and call the post method
-        view = UserView.as_view()
-        response = view(request)
-
-        # Assert the response status code and data
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['result'], 0)
-        self.assertEqual(response.data['message'], "添加用户成功")
+        # Assert the response data
+        self.assertEqual(response.json(), {'result': 0, 'message': "添加用户成功"})
 
         # Check if the user was created and assigned to the correct groups
         user = User.objects.get(username='newuser')
         self.assertEqual(user.email, 'newuser@example.com')
-        self.assertEqual(user.groups.count(), 2)
-        self.assertTrue(user.groups.filter(name='Common User').exists())
-        self.assertTrue(user.groups.filter(name='Train Admin').exists())
+        self.assertTrue(user.check_password('password'))
+        self.assertEqual(set(user.groups.values_list('name', flat=True)), {'Common User', 'Train Admin'})
+
+    def test_add_user_without_permission(self):
+        user = User.objects.create_user(username='testuser', password='testpassword')
+        response = self.client.post('/users/', {'name': 'newuser'}, content_type='application/json',
+                                    **login_headers(user))
+
+        self.assertEqual(response.json(), {'result': 1, 'message': "无权访问"})
 
-        # Clean up the test user
-        user.delete()
 
 class UserIdViewTest(TestCase):
     def setUp(self):
-        self.factory = APIRequestFactory()
-        self.view = UserIdView.as_view()
+        self.headers = login_headers(system_admin())
         self.user = User.objects.create(username='testuser', email='test@example.com')
 
     def test_put_user_exists(self):
@@ -230,67 +225,271 @@ class UserIdViewTest(TestCase):
             'email': 'updated_email@example.com',
             'role': ['Role1', 'Role2'],
         }
-        request = self.factory.put('/users/10', data=request_data)
-        response = self.view(request, user_id=10)
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['result'], 0)
-        self.assertEqual(response.data['message'], "更新用户数据成功")
+        response = self.client.put(f'/users/{self.user.id}', request_data, content_type='application/json',
+                                   **self.headers)
+        self.assertEqual(response.json(), {'result': 0, 'message': "更新用户数据成功"})
 
         # Assert user fields are updated
-        updated_user = User.objects.get(id=10)
+        updated_user = User.objects.get(id=self.user.id)
         self.assertEqual(updated_user.username, 'updated_user')
-        self.assertEqual(updated_user.check_password('updated_password'), True)
+        self.assertTrue(updated_user.check_password('updated_password'))
         self.assertEqual(updated_user.email, 'updated_email@example.com')
         self.assertEqual(updated_user.groups.count(), 2)
 
     def test_put_user_not_found(self):
-        request_data = {
-            'name': 'updated_user',
-            'passwd': 'updated_password',
-            'email': 'updated_email@example.com',
-            'role': ['Role1', 'Role2'],
-        }
-        request = self.factory.put('/users/999', data=request_data)
-        response = self.view(request, user_id=999)
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "用户不存在")
+        response = self.client.put('/users/999', {'name': 'updated_user'}, content_type='application/json',
+                                   **self.headers)
+        self.assertEqual(response.json(), {'result': 1, 'message': "用户不存在"})
 
     def test_delete_user_exists(self):
-        request = self.factory.delete('/users/10')
-        response = self.view(request, user_id=10)
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['result'], 0)
-        self.assertEqual(response.data['message'], "用户已删除")
+        response = self.client.delete(f'/users/{self.user.id}', **self.headers)
+        self.assertEqual(response.json(), {'result': 0, 'message': "用户已删除"})
 
         # Assert user is deleted
-        with self.assertRaises(User.DoesNotExist):
-            deleted_user = User.objects.get(id=10)
+        self.assertFalse(User.objects.filter(id=self.user.id).exists())
 
     def test_delete_user_not_found(self):
-        request = self.factory.delete('/users/999')
-        response = self.view(request, user_id=999)
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['result'], 1)
-        self.assertEqual(response.data['message'], "用户不存在")
+        response = self.client.delete('/users/999', **self.headers)
+        self.assertEqual(response.json(), {'result': 1, 'message': "用户不存在"})
+
+    def test_get_user_not_found(self):
+        response = self.client.get('/users/999', **self.headers)
+        self.assertEqual(response.json(), {'result': 1, 'message': "用户不存在"})
 
-class GetCurrentUserTest(TestCase):
-    def setUp(self):
-        self.factory = APIRequestFactory()
-        self.view = get_current_user
 
+class GetCurrentUserTest(TestCase):
     def test_get_current_user(self):
         user = User.objects.create(username='testuser', email='test@example.com')
-        request = self.factory.get('/users/me')
-        request.user = user
-        response = self.view(request, user=user)
+
+        response = self.client.get('/users/me', **login_headers(user))
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data, {'username': 'testuser', 'email': 'test@example.com'})
+        self.assertEqual(response.json(),
+                         {'id': user.id, 'username': 'testuser', 'email': 'test@example.com', 'groups': [], 'accounts': []})
 
     def test_get_current_user_unauthenticated(self):
-        request = self.factory.get('/users/me')
-        response = self.view(request, user=None)
+        response = self.client.get('/users/me')
+
+        self.assertEqual(response.json(), {'result': 1, 'message': "无法解析 JWT"})
+
+
+# a file based cache is shared by the processes of one host, unlike the default locmem cache
+SHARED_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': tempfile.mkdtemp()},
+}
+
 
-        self.assertEqual(response.status_code, 401)
-        self.assertEqual(response.data, {'detail': 'Authentication credentials were not provided.'})
+@override_settings(CACHES=SHARED_CACHES, PERMISSION_CACHE='shared')
+class PermissionCacheTest(TestCase):
+    def setUp(self):
+        caches['shared'].clear()
+        self.admin = User.objects.create_user(username='admin', password='admin123')
+        self.admin.groups.add(Group.objects.create(name='System Admin'))
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.user.groups.add(Group.objects.create(name='Common User'))
+
+    def headers(self, user):
+        return {'HTTP_JWT': jwt.encode(
+            {'id': user.id, 'expire': (datetime.datetime.now() + timedelta(hours=2)).isoformat()},
+            settings.SECRET_KEY,
+        )}
+
+    def test_cached_user_costs_no_query(self):
+        with self.assertNumQueries(2):
+            user, roles = get_user_and_roles(self.user.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_and_roles(self.user.id), (user, {'Common User'}))
+
+        self.assertEqual(get_user_and_roles(-1), (None, None))
+
+    def test_process_local_cache_is_refused(self):
+        # 只在本进程内的缓存无法让其它进程失效，每次都读数据库
+        for alias in [None, 'default']:
+            with self.settings(PERMISSION_CACHE=alias):
+                get_user_and_roles(self.user.id)
+                with self.assertNumQueries(2):
+                    get_user_and_roles(self.user.id)
+
+    def test_role_change_invalidates_cache(self):
+        self.assertEqual(self.client.get('/tickets/', **self.headers(self.user)).json(), {'tickets': []})
+
+        response = self.client.put(
+            f'/users/{self.user.id}', {'role': ['Train Admin']}, content_type='application/json',
+            **self.headers(self.admin),
+        )
+        self.assertEqual(response.json()['result'], 0)
+
+        response = self.client.get('/tickets/', **self.headers(self.user))
+        self.assertEqual(response.json(), {'result': 1, 'message': "无权访问"})
+
+    def test_delete_invalidates_cache(self):
+        get_user_and_roles(self.user.id)
+
+        self.client.delete(f'/users/{self.user.id}', **self.headers(self.admin))
+
+        response = self.client.get('/tickets/', **self.headers(self.user))
+        self.assertEqual(response.json(), {'result': 1, 'message': "找不到用户"})
+
+
+@permission_check(['Common User'])
+def common_user_only(request):
+    return None
+
+
+@override_settings(CACHES=SHARED_CACHES, PERMISSION_CACHE='shared')
+class RoleClaimsTest(TestCase):
+    def setUp(self):
+        caches['shared'].clear()
+        self.admin = User.objects.create_user(username='admin', password='admin123')
+        self.admin.groups.add(Group.objects.create(name='System Admin'))
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.user.groups.add(Group.objects.create(name='Common User'))
+        self.factory = APIRequestFactory()
+
+    def login(self, name, passwd):
+        return self.client.post('/users/login', {'name': name, 'passwd': passwd}).json()['jwt']
+
+    def test_login_signs_roles(self):
+        info = jwt.decode(self.login('testuser', 'testpassword'), settings.SECRET_KEY, "HS256")
+
+        self.assertEqual(info['roles'], ['Common User'])
+        self.assertEqual(info['role_version'], 0)
+
+    def test_authorize_from_token(self):
+        request = self.factory.get('/', HTTP_JWT=self.login('testuser', 'testpassword'))
+
+        self.assertIsNone(common_user_only(request))
+        with self.assertNumQueries(0):
+            self.assertIsNone(common_user_only(request))
+
+    def test_stale_role_version_falls_back_to_database(self):
+        user_jwt = self.login('testuser', 'testpassword')
+        admin_jwt = self.login('admin', 'admin123')
+
+        self.client.put(
+            f'/users/{self.user.id}', {'role': ['Train Admin']}, content_type='application/json',
+            HTTP_JWT=admin_jwt,
+        )
+
+        response = common_user_only(self.factory.get('/', HTTP_JWT=user_jwt))
+        self.assertEqual(json.loads(response.content), {'result': 1, 'message': "无权访问"})
+
+    def test_group_changes_outside_views_bump_version(self):
+        user_jwt = self.login('testuser', 'testpassword')
+        common_user = Group.objects.get(name='Common User')
+        self.assertIsNone(common_user_only(self.factory.get('/', HTTP_JWT=user_jwt)))
+
+        # 在管理后台或 shell 中修改用户组，旧令牌中的角色同样失效
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.groups.remove(common_user)
+        response = common_user_only(self.factory.get('/', HTTP_JWT=user_jwt))
+        self.assertEqual(json.loads(response.content), {'result': 1, 'message': "无权访问"})
+
+        user_jwt = self.login('testuser', 'testpassword')
+        with self.captureOnCommitCallbacks(execute=True):
+            common_user.user_set.add(self.user)
+        self.assertEqual(RoleVersion.objects.get(user=self.user).version, 2)
+        self.assertIsNone(common_user_only(self.factory.get('/', HTTP_JWT=self.login('testuser', 'testpassword'))))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            common_user.user_set.clear()
+        self.assertEqual(RoleVersion.objects.get(user=self.user).version, 3)
+        response = common_user_only(self.factory.get('/', HTTP_JWT=user_jwt))
+        self.assertEqual(json.loads(response.content), {'result': 1, 'message': "无权访问"})
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    just enough of SMTP for smtplib, every accepted message is kept on the server
+    """
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 stub")
+        while line := self.rfile.readline():
+            command = line.decode().strip().upper()
+            if command == 'DATA':
+                self.reply("354 go ahead")
+                data = b''
+                while (line := self.rfile.readline()) != b'.\r\n':
+                    data += line
+                self.server.messages.append(data)
+                self.reply("250 queued")
+            elif command == 'QUIT':
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+
+class MailPoolTest(TestCase):
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StubSMTPHandler)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.messages = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def smtp_connection(self, **kwargs):
+        return get_connection('django.core.mail.backends.smtp.EmailBackend',
+                              host='127.0.0.1', port=self.server.server_address[1], **kwargs)
+
+    def message(self, i):
+        return build_mail("注册", "正文", "<p>正文</p>", from_email='noreply@example.com', to=[f'user{i}@example.com'])
+
+    def test_messages_share_one_connection(self):
+        pool = ConnectionPool(idle_timeout=10, connection_factory=self.smtp_connection)
+        for i in range(25):
+            pool.send(self.message(i))
+        pool.close()
+
+        self.assertEqual(len(self.server.messages), 25)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(pool.metrics(), {'sent': 25, 'failed': 0, 'connections': 1})
+
+    def test_idle_and_dropped_connections_are_replaced(self):
+        pool = ConnectionPool(idle_timeout=0, connection_factory=self.smtp_connection)
+        pool.send(self.message(0))
+        pool.send(self.message(1))
+        self.assertEqual(pool.metrics()['connections'], 2)
+
+        # 服务器断开的连接在发送失败时被发现，换新连接重发一次
+        pool.idle_timeout = 10
+        pool.local.connection.connection.close()
+        pool.send(self.message(2))
+        pool.close()
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(pool.metrics(), {'sent': 3, 'failed': 0, 'connections': 3})
+
+    def test_start_register_queues_mail(self):
+        response = self.client.post('/users/register', {
+            'name': 'newuser', 'passwd': 'password', 'email': 'newuser@example.com',
+        }, content_type='application/json').json()
+        self.assertEqual(response['result'], 0)
+
+        # 邮件在任务队列中，由后台任务发送
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(mail.outbox[-1].to, ['newuser@example.com'])
+
+    def test_failed_mail_stays_queued(self):
+        self.client.post('/users/register', {
+            'name': 'newuser', 'passwd': 'password', 'email': 'newuser@example.com',
+        }, content_type='application/json')
+
+        # 邮件服务器不可用时任务保留下来，之后重试
+        with patch.object(utils.mail.pool, 'connection_factory', side_effect=ConnectionRefusedError):
+            self.assertEqual(run_pending(), 1)
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (Job.PENDING, 1))
+        self.assertIn('ConnectionRefusedError', job.last_error)
+
+        Job.objects.update(run_at=timezone.now())
+        self.assertEqual(run_pending(), 1)
+        self.assertFalse(Job.objects.exists())
+        self.assertEqual(mail.outbox[-1].to, ['newuser@example.com'])
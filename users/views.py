@@ -1,5 +1,4 @@
 from datetime import datetime, timedelta
-from smtplib import SMTPException
 
 import jwt
 from django.conf import settings
@@ -11,10 +10,12 @@ from jwt import DecodeError
 from rest_framework.decorators import api_view
 from rest_framework.views import APIView
 
-import utils.mail
+from jobs.queue import enqueue
+from jobs.tasks import send_mail
+from users.models import RoleVersion
 from users.serializers import UserSerializer
 from utils import json
-from utils.perm import permission_check
+from utils.perm import permission_check, invalidate_user
 
 
 # Create your views here.
@@ -41,16 +42,14 @@ def start_register(request):
         settings.SECRET_KEY,
     )
 
-    try:
-        utils.mail.send_mail(
-            "畅游中国用户注册",
-            "请按提示完成注册验证",
-            render_to_string("verify_link.html", {'url': f"http://{host}:8000/users/register/{code}"}),
-            from_email=settings.EMAIL_HOST_USER,
-            to=[email],
-        )
-    except SMTPException as e:
-        return json.response({'result': 1, 'message': f"邮件发送失败，{e}"})
+    enqueue(
+        send_mail,
+        subject="畅游中国用户注册",
+        text_content="请按提示完成注册验证",
+        html_content=render_to_string("verify_link.html", {'url': f"http://{host}:8000/users/register/{code}"}),
+        from_email=settings.EMAIL_HOST_USER,
+        to=[email],
+    )
 
     return json.response({'result': 0, 'message': "已发送认证邮件"})
 
@@ -68,7 +67,7 @@ def verify_register(request, code):
     expire = datetime.fromisoformat(info['expire'])
 
     if expire < datetime.now():
-        HttpResponse("认证已过期")
+        return HttpResponse("认证已过期")
 
     if User.objects.filter(email=email).exists():
         return HttpResponse("用户已被注册")
@@ -96,13 +95,17 @@ def login(request):
     if not user.check_password(passwd):
         return json.response({'result': 1, 'message': "密码不正确"})
 
-    user_jwt = jwt.encode(
-        {
-            'id': user.id,
-            'expire': (datetime.now() + timedelta(hours=2)).isoformat(),
-        },
-        settings.SECRET_KEY,
-    )
+    claims = {
+        'id': user.id,
+        'expire': (datetime.now() + timedelta(hours=2)).isoformat(),
+    }
+
+    if settings.JWT_ROLE_CLAIMS:
+        # read the version before the roles, so a concurrent role change leaves the token stale instead of wrong
+        claims['role_version'] = RoleVersion.objects.get_or_create(user=user)[0].version
+        claims['roles'] = list(user.groups.values_list('name', flat=True))
+
+    user_jwt = jwt.encode(claims, settings.SECRET_KEY)
 
     return json.response({'result': 0, 'message': "登陆成功", 'jwt': user_jwt})
 
@@ -163,14 +166,14 @@ class UserIdView(APIView):
     def get(self, request, user_id):
         user = User.objects.filter(id=user_id).first()
         if not user:
-            json.response({'result': 1, 'message': "用户不存在"})
+            return json.response({'result': 1, 'message': "用户不存在"})
 
         return json.response(UserSerializer(user).data)
 
     @permission_check(['System Admin'])
     def put(self, request, user_id):
         if not User.objects.filter(id=user_id).exists():
-            json.response({'result': 1, 'message': "用户不存在"})
+            return json.response({'result': 1, 'message': "用户不存在"})
 
         user = User.objects.get(id=user_id)
 
@@ -189,7 +192,7 @@ class UserIdView(APIView):
             user.username = name
 
         if passwd:
-            user.password = passwd
+            user.set_password(passwd)
 
         if email:
             user.email = email
@@ -204,6 +207,8 @@ class UserIdView(APIView):
             user.save()
         except ValidationError as e:
             return json.response({'result': 1, 'message': f"更新用户数据失败，{e}"})
+        finally:
+            invalidate_user(user.id)
 
         return json.response({'result': 0, 'message': "更新用户数据成功"})
 
@@ -215,6 +220,7 @@ class UserIdView(APIView):
         user = User.objects.get(id=user_id)
 
         user.delete()
+        invalidate_user(user_id)
 
         return json.response({'result': 0, 'message': "用户已删除"})
 
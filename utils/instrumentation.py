@@ -0,0 +1,200 @@
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.db.models import Count
+from django.http import Http404, HttpResponse
+
+from jobs.models import Job
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the request duration histogram
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+_NUMBER = re.compile(r'\b\d+\b')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_SPACE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """
+    the shape of a statement: parameters are placeholders already, IN lists of any length and literals fold together
+    """
+    sql = _IN_LIST.sub('IN (...)', sql)
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+class QueryRecorder:
+    """
+    connection.execute_wrapper hook keeping the count, total time and fingerprints of the statements of one request
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.count += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def duplicates(self):
+        """
+        statements run more than once in the request, the usual sign of an N+1 pattern, most repeated first
+        """
+        return [(sql, count) for sql, count in self.fingerprints.most_common() if count > 1]
+
+
+class Aggregates:
+    """
+    in-process totals per (method, route, status), rendered in the prometheus text format by metrics.
+    every process keeps its own, so scrape each worker
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, method, route, status, seconds, recorder):
+        duplicated = sum(count - 1 for _, count in recorder.duplicates())
+        with self.lock:
+            series = self.series.setdefault((method, route, str(status)), {
+                'requests': 0,
+                'seconds': 0.0,
+                'buckets': [0] * len(self.buckets),
+                'queries': 0,
+                'db_seconds': 0.0,
+                'duplicate_queries': 0,
+            })
+            series['requests'] += 1
+            series['seconds'] += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series['buckets'][i] += 1
+            series['queries'] += recorder.count
+            series['db_seconds'] += recorder.seconds
+            series['duplicate_queries'] += duplicated
+
+    def render(self):
+        with self.lock:
+            series = {labels: dict(values, buckets=list(values['buckets'])) for labels, values in self.series.items()}
+
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+
+        def labels(method, route, status, **extra):
+            pairs = dict(method=method, route=route, status=status, **extra)
+            return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs.items()) + '}'
+
+        family('http_requests_total', 'counter', "requests served", [
+            f"http_requests_total{labels(*key)} {values['requests']}" for key, values in series.items()
+        ])
+
+        histogram = []
+        for key, values in series.items():
+            histogram.extend(
+                f"http_request_duration_seconds_bucket{labels(*key, le=bound)} {count}"
+                for bound, count in zip(self.buckets, values['buckets'])
+            )
+            histogram.append(f"http_request_duration_seconds_bucket{labels(*key, le='+Inf')} {values['requests']}")
+            histogram.append(f"http_request_duration_seconds_sum{labels(*key)} {values['seconds']}")
+            histogram.append(f"http_request_duration_seconds_count{labels(*key)} {values['requests']}")
+        family('http_request_duration_seconds', 'histogram', "wall time of requests", histogram)
+
+        family('http_request_db_queries_total', 'counter', "sql statements issued by requests", [
+            f"http_request_db_queries_total{labels(*key)} {values['queries']}" for key, values in series.items()
+        ])
+        family('http_request_db_seconds_total', 'counter', "time requests spent in sql statements", [
+            f"http_request_db_seconds_total{labels(*key)} {values['db_seconds']}" for key, values in series.items()
+        ])
+        family('http_request_duplicate_queries_total', 'counter', "sql statements repeating one of the same request", [
+            f"http_request_duplicate_queries_total{labels(*key)} {values['duplicate_queries']}"
+            for key, values in series.items()
+        ])
+
+        # mail is sent by the job workers, a backlog or failures of it show up in the job queue
+        jobs = dict(Job.objects.order_by().values('status').annotate(num=Count('id')).values_list('status', 'num'))
+        family('jobs', 'gauge', "queued background jobs", [
+            f'jobs{{status="{status}"}} {jobs.get(status, 0)}' for status in (Job.PENDING, Job.RUNNING, Job.FAILED)
+        ])
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+aggregates = Aggregates()
+
+
+class InstrumentationMiddleware:
+    """
+    time every request, count its sql statements and their time, and spot statements it repeats.
+    the numbers go to a Server-Timing header, a json log line and the /metrics aggregates.
+    enabled by settings.REQUEST_INSTRUMENTATION, put it first in MIDDLEWARE so that it sees the whole request
+    """
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_INSTRUMENTATION:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+        seconds = time.perf_counter() - start
+
+        # routes rather than paths, so that ids don't split the series
+        route = request.resolver_match.route if request.resolver_match else 'unmatched'
+        duplicates = recorder.duplicates()
+        aggregates.observe(request.method, route, response.status_code, seconds, recorder)
+
+        response['Server-Timing'] = (
+            f'app;dur={seconds * 1000:.2f}, '
+            f'db;dur={recorder.seconds * 1000:.2f};desc="{recorder.count} queries, {len(duplicates)} repeated"'
+        )
+
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'route': route,
+            'status': response.status_code,
+            'ms': round(seconds * 1000, 2),
+            'queries': recorder.count,
+            'db_ms': round(recorder.seconds * 1000, 2),
+            'duplicates': [{'sql': sql, 'count': count} for sql, count in duplicates],
+        }, ensure_ascii=False))
+
+        return response
+
+
+def metrics(request):
+    """
+    the aggregates of this process in the prometheus text format
+    """
+    if not settings.REQUEST_INSTRUMENTATION:
+        raise Http404()
+    return HttpResponse(aggregates.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,7 +1,95 @@
-from django.core.mail import EmailMultiAlternatives
+import logging
+import threading
+import time
 
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
 
-def send_mail(subject, text_content, html_content, **email_kwargs):
+logger = logging.getLogger(__name__)
+
+
+def build_mail(subject, text_content, html_content, **email_kwargs):
     msg = EmailMultiAlternatives(subject, text_content, **email_kwargs)
     msg.attach_alternative(html_content, "text/html")
-    msg.send(fail_silently=False)
+    return msg
+
+
+def send_mail(subject, text_content, html_content, **email_kwargs):
+    build_mail(subject, text_content, html_content, **email_kwargs).send(fail_silently=False)
+
+
+class ConnectionPool:
+    """
+    one mail connection per thread, kept open between messages and closed once it was idle for idle_timeout.
+    long lived threads such as the job workers send through it instead of connecting for every message
+    """
+
+    def __init__(self, idle_timeout=5.0, connection_factory=get_connection):
+        self.idle_timeout = idle_timeout
+        self.connection_factory = connection_factory
+        self.local = threading.local()
+
+        self.lock = threading.Lock()
+        self.counters = {
+            'sent': 0,
+            'failed': 0,
+            'connections': 0,
+        }
+
+    def send(self, message):
+        """
+        send a message on the connection of the calling thread. a connection the server dropped is noticed
+        by the failure, the message is then retried once on a new one and the error raised if that fails too
+        """
+        for attempt in range(2):
+            try:
+                connection = self._connection()
+                self._count('sent', connection.send_messages([message]))
+                self.local.used_at = time.monotonic()
+                return
+            except Exception:
+                self.close()
+                if attempt:
+                    self._count('failed')
+                    raise
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        self.local.connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                logger.exception("could not close mail connection")
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and time.monotonic() - self.local.used_at > self.idle_timeout:
+            self.close()
+            connection = None
+
+        if connection is None:
+            connection = self.connection_factory(fail_silently=False)
+            connection.open()
+            self.local.connection = connection
+            self.local.used_at = time.monotonic()
+            self._count('connections')
+        return connection
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+
+pool = ConnectionPool(settings.MAIL_IDLE_TIMEOUT)
+
+
+def send_mail_pooled(subject, text_content, html_content, **email_kwargs):
+    """
+    like send_mail, but on the kept connection of the calling thread
+    """
+    pool.send(build_mail(subject, text_content, html_content, **email_kwargs))
@@ -2,12 +2,77 @@ from datetime import datetime
 
 import jwt
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
 from jwt import DecodeError
 
+from users.models import RoleVersion
 from utils import json
 
 
+def _shared_cache():
+    """
+    the cache alias named by settings.PERMISSION_CACHE, None if unset or if it only lives in this process,
+    as invalidate_user must reach every process before a revoked or deleted user is refused
+    """
+    if not settings.PERMISSION_CACHE:
+        return None
+    shared = caches[settings.PERMISSION_CACHE]
+    if isinstance(shared, (LocMemCache, DummyCache)):
+        return None
+    return shared
+
+
+def get_user_and_roles(user_id):
+    """
+    the user and the names of their groups, cached for settings.PERMISSION_CACHE_TTL seconds in a shared cache.
+    returns (None, None) if the user does not exist
+    """
+    shared = _shared_cache()
+    key = f"perm:user:{user_id}"
+    cached = shared.get(key) if shared is not None else None
+
+    if cached is None:
+        user = User.objects.filter(id=user_id).first()
+        if not user:
+            return None, None
+        roles = frozenset(Group.objects.filter(user=user).values_list('name', flat=True))
+        cached = (user, roles)
+        if shared is not None:
+            shared.set(key, cached, settings.PERMISSION_CACHE_TTL)
+
+    return cached
+
+
+def get_role_version(user_id):
+    """
+    the current RoleVersion of the user, cached like get_user_and_roles. None if the user has none
+    """
+    shared = _shared_cache()
+    key = f"perm:role_version:{user_id}"
+    version = shared.get(key) if shared is not None else None
+
+    if version is None:
+        version = RoleVersion.objects.filter(user_id=user_id).values_list('version', flat=True).first()
+        if version is None:
+            return None
+        if shared is not None:
+            shared.set(key, version, settings.PERMISSION_CACHE_TTL)
+
+    return version
+
+
+def invalidate_user(user_id):
+    """
+    must be called whenever a user is changed or deleted, so that permission_check reloads it
+    """
+    shared = _shared_cache()
+    if shared is not None:
+        shared.delete_many([f"perm:user:{user_id}", f"perm:role_version:{user_id}"])
+
+
 class permission_check:
     def __init__(self, roles: list = None, user: bool = False):
         self.roles = roles
@@ -28,12 +93,17 @@ class permission_check:
             if expire < datetime.now():
                 return json.response({'result': 1, 'message': "登陆已过期，请重新登录"})
 
-            id = info['id']
-            if not User.objects.filter(id=id).exists():
-                return json.response({'result': 1, 'message': "找不到用户"})
-            user = User.objects.get(id=id)
+            user_id = info['id']
+            if (not self.set_user and 'roles' in info
+                    and info.get('role_version') == get_role_version(user_id)):
+                # the roles signed into the token are still current, no need to load the user
+                user, roles = None, frozenset(info['roles'])
+            else:
+                user, roles = get_user_and_roles(user_id)
+                if not user:
+                    return json.response({'result': 1, 'message': "找不到用户"})
 
-            if not (self.roles is None or user.groups.filter(name__in=self.roles).exists()):
+            if not (self.roles is None or roles.intersection(self.roles)):
                 return json.response({'result': 1, 'message': "无权访问"})
 
             if self.set_user:
@@ -0,0 +1,81 @@
+import io
+import json
+import logging
+
+from django.db import connection
+from django.test import TestCase, override_settings
+
+from schedules.catalog import carriage_catalog, station_catalog
+from schedules.models import Carriage, Schedule, Station
+from utils.instrumentation import QueryRecorder, fingerprint
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        self.stations = [Station.objects.create(station_no=f'S{i}', name=f'站点{i}') for i in range(3)]
+        self.carriages = [Carriage.objects.create(name=f'车厢{i}', seat_num=10) for i in range(2)]
+        for i in range(2):
+            schedule = Schedule.objects.create(schedule_no=f'G{i}', departure_time='2023-06-01T08:00:00Z')
+            schedule.add_stations(
+                [station.id for station in self.stations],
+                ['2023-06-01T08:00:00+00:00', '2023-06-01T09:00:00+00:00', '2023-06-01T10:00:00+00:00'],
+            )
+            schedule.add_carriages([carriage.id for carriage in self.carriages])
+        # 目录先加载好，请求里不再查询
+        station_catalog.invalidate()
+        carriage_catalog.invalidate()
+        station_catalog.get(self.stations[0].id)
+        carriage_catalog.get(self.carriages[0].id)
+
+    @override_settings(REQUEST_INSTRUMENTATION=True)
+    def test_instrumentation(self):
+        with self.assertLogs('utils.instrumentation', 'INFO') as logs:
+            response = self.client.get('/schedules/', {'ori': self.stations[0].id, 'dst': self.stations[2].id})
+            metrics = self.client.get('/metrics').content.decode()
+        self.assertIn('desc="3 queries, 0 repeated"', response['Server-Timing'])
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['route'], 'schedules/')
+        self.assertEqual(line['queries'], 3)
+        self.assertEqual(line['duplicates'], [])
+
+        self.assertIn('http_requests_total{method="GET",route="schedules/",status="200"}', metrics)
+        self.assertIn('http_request_db_queries_total{method="GET",route="schedules/",status="200"}', metrics)
+
+        # 邮件由后台任务发送，积压和失败体现在任务队列里
+        self.assertIn('# TYPE jobs gauge', metrics)
+        self.assertIn('jobs{status="pending"} 0', metrics)
+        self.assertIn('jobs{status="failed"} 0', metrics)
+
+    @override_settings(REQUEST_INSTRUMENTATION=True)
+    def test_log_line_is_written(self):
+        # assertLogs 会临时打开日志，这里检查配置本身是否把 INFO 行写出
+        logger = logging.getLogger('utils.instrumentation')
+        self.assertTrue(logger.isEnabledFor(logging.INFO))
+        stream = io.StringIO()
+        for handler in logger.handlers:
+            self.addCleanup(handler.setStream, handler.setStream(stream))
+
+        self.client.get('/schedules/', {'ori': self.stations[0].id, 'dst': self.stations[2].id})
+
+        line = json.loads(stream.getvalue().splitlines()[-1])
+        self.assertEqual((line['route'], line['queries']), ('schedules/', 3))
+
+    def test_repeated_queries(self):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            for station in self.stations:
+                Station.objects.filter(id=station.id).first()
+            list(Station.objects.filter(id__in=[station.id for station in self.stations[:2]]))
+            list(Station.objects.filter(id__in=[station.id for station in self.stations]))
+
+        # 逐个查询站点是典型的 N+1，不同长度的 IN 列表也算同一条语句
+        self.assertEqual(recorder.count, 5)
+        self.assertEqual([count for _, count in recorder.duplicates()], [3, 2])
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint("SELECT * FROM t WHERE a IN (%s, %s) AND b = 'x'  AND c = 3"),
+                         "SELECT * FROM t WHERE a IN (...) AND b = ? AND c = ?")
+
+    def test_metrics_disabled(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)